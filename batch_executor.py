@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from profiling import PROFILER
+
+def resolve_workers(workers):
+    """
+    Turn a --workers value into a worker count (0 or None means all cores)
+    """
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+def add_workers_argument(parser, opencv_threads=True):
+    """Add the shared --workers (and --opencv-threads) options to an argparse parser"""
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (0 = all cores, default 1)")
+    if opencv_threads:
+        parser.add_argument('--opencv-threads', type=int, default=None,
+                            help="OpenCV threads per worker (default 1 when --workers > 1)")
+    return parser
+
+def _init_worker(opencv_threads, profile_memory=None):
+    """
+    Pool initializer: limit OpenCV threading inside each worker process,
+    and profile the worker if the parent process is profiling
+    """
+    import cv2
+    if opencv_threads is not None:
+        cv2.setNumThreads(opencv_threads)
+    if profile_memory is not None:
+        PROFILER.enable(profile_memory)
+
+def _task_label(task):
+    """Name a task in profiling records: its first element, usually the input path"""
+    label = task[0] if isinstance(task, tuple) and task else task
+    return getattr(label, 'name', label)
+
+def _safe_call(func, task):
+    """
+    Run func(task) and turn an exception into an error message
+    
+    Returns:
+        tuple: (result, error, profiling records made by the call)
+    """
+    if not PROFILER.enabled:
+        try:
+            return func(task), None, None
+        except Exception as e:
+            return None, str(e) or repr(e), None
+    with PROFILER.image(_task_label(task)):
+        try:
+            result, error = func(task), None
+        except Exception as e:
+            result, error = None, str(e) or repr(e)
+    return result, error, PROFILER.take_records()
+
+def run_batch(func, tasks, workers=1, chunksize=None, opencv_threads=None):
+    """
+    Run func over tasks, serially or in a process pool
+    
+    Results are yielded in task order whatever the worker count, so drivers
+    print progress and count errors in the same way for any number of
+    workers. An exception raised by func is caught and reported for that
+    task only.
+    
+    Args:
+        func (callable): Picklable top-level function taking one task
+        tasks (list): Task arguments, one per unit of work
+        workers (int): Number of worker processes (0 or None = all cores)
+        chunksize (int): Tasks sent to a worker at a time (default: about
+            four chunks per worker)
+        opencv_threads (int): cv2.setNumThreads value in each worker
+            (default 1 when more than one worker is used)
+    
+    Yields:
+        tuple: (task, result, error) where error is None on success
+    """
+    tasks = list(tasks)
+    workers = min(resolve_workers(workers), max(1, len(tasks)))
+    call = partial(_safe_call, func)
+    
+    if workers == 1:
+        if opencv_threads is not None:
+            _init_worker(opencv_threads)
+        for task in tasks:
+            result, error, records = call(task)
+            if records:
+                PROFILER.records.extend(records)
+            yield task, result, error
+        return
+    
+    if opencv_threads is None:
+        opencv_threads = 1
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (workers * 4))
+    
+    profile_memory = PROFILER.memory if PROFILER.enabled else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(opencv_threads, profile_memory)) as executor:
+        for task, (result, error, records) in zip(tasks, executor.map(call, tasks, chunksize=chunksize)):
+            if records:
+                PROFILER.records.extend(records)
+            yield task, result, error
@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+import cv2
+import numpy as np
+from batch_executor import run_batch
+from synthetic_oct import make_annotation, make_bscan
+from enhance_image import process_directory as enhance_directory
+from split_and_enhance import split_image
+from reassemble_images import reassemble_tiles
+from concat_images import concat_images_with_same_prefix
+from process_labelme import create_mask, split_image_and_mask
+
+def _parse_size(text):
+    """Parse a 'HEIGHTxWIDTH' size"""
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+class _Dataset:
+    """
+    Synthetic inputs for one image size, generated once and shared by the
+    stages: B-scans, their 512 px tiles, LabelMe shapes and a copy named
+    like the enhanced images concat_images groups
+    """
+    def __init__(self, root, height, width, count, seed=0):
+        self.root = Path(root) / f"{height}x{width}"
+        self.height = height
+        self.width = width
+        self.count = count
+        self.images = self.root / 'images'
+        self.tiles = self.root / 'tiles'
+        self.concat = self.root / 'concat' / 'enhanced'
+        self.images.mkdir(parents=True, exist_ok=True)
+        self.concat.mkdir(parents=True, exist_ok=True)
+        
+        self.paths = []
+        self.shapes = []
+        for i in range(count):
+            img = make_bscan(height, width, seed + i)
+            path = self.images / f"bscan_{i}.png"
+            cv2.imwrite(str(path), img)
+            self.paths.append(path)
+            self.shapes.append(make_annotation(height, width, seed + i))
+            split_image(path, self.tiles / path.stem, 512)
+            # Three scans per prefix group, as concat_images expects
+            prefix = f"05-1_{i // 3}_12-03-15-26-16"
+            cv2.imwrite(str(self.concat / f"{prefix}_res_processed_x{i % 3}.png"), img)
+    
+    @property
+    def megapixels(self):
+        return self.count * self.height * self.width / 1e6
+
+def _split_task(task):
+    """Worker task: split one image into 512 px tiles"""
+    image_path, output_dir = task
+    return len(split_image(image_path, output_dir, 512))
+
+def _create_mask_task(task):
+    """Worker task: rasterise the shapes of one image"""
+    shapes, height, width = task
+    return int(create_mask(shapes, (width, height)).max())
+
+def _split_mask_task(task):
+    """Worker task: rasterise the shapes of one image and cut image and mask into tiles"""
+    image_path, shapes = task
+    image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+    mask = create_mask(shapes, (image.shape[1], image.shape[0]))
+    return len(split_image_and_mask(image, mask, 512)[0])
+
+def _drain(func, tasks, workers):
+    """Run tasks through run_batch and raise the first error"""
+    for _, _, error in run_batch(func, tasks, workers):
+        if error is not None:
+            raise RuntimeError(error)
+
+def _stage_enhance(data, workers, scratch):
+    enhance_directory(data.images, scratch / 'enhanced', workers)
+
+def _stage_split(data, workers, scratch):
+    _drain(_split_task, [(path, scratch / 'split' / path.stem) for path in data.paths], workers)
+
+def _stage_reassemble(data, workers, scratch):
+    reassemble_tiles(data.tiles, scratch / 'reassembled', 512, workers=workers)
+
+def _stage_concat(data, workers, scratch):
+    concat_images_with_same_prefix(str(data.concat), workers)
+
+def _stage_create_mask(data, workers, scratch):
+    _drain(_create_mask_task, [(shapes, data.height, data.width) for shapes in data.shapes], workers)
+
+def _stage_split_mask(data, workers, scratch):
+    _drain(_split_mask_task, list(zip(data.paths, data.shapes)), workers)
+
+# Benchmarked stages: name -> function(dataset, workers, scratch_dir)
+STAGES = {
+    'enhance_image': _stage_enhance,
+    'split_image': _stage_split,
+    'reassemble_tiles': _stage_reassemble,
+    'concat_images': _stage_concat,
+    'create_mask': _stage_create_mask,
+    'split_image_and_mask': _stage_split_mask,
+}
+
+def run_benchmarks(sizes=((1024, 1024),), workers=(1,), count=4, repeat=3, stages=None, seed=0, work_dir=None):
+    """
+    Time the pipeline stages on synthetic OCT-like B-scans
+    
+    Every (stage, size, workers) case is run `repeat` times on `count`
+    images and the fastest run is kept; the driver output is suppressed.
+    
+    Args:
+        sizes (list): (height, width) image sizes
+        workers (list): Worker counts to run each stage with
+        count (int): Images per case
+        repeat (int): Runs per case
+        stages (list): Stage names from STAGES (default: all)
+        seed (int): Seed of the synthetic data
+        work_dir (str or Path): Directory for the data (default: a temporary one)
+    
+    Returns:
+        list: One dict per case with the stage, size, workers, images,
+            megapixels, best and median seconds and megapixels per second
+    """
+    stages = list(stages or STAGES)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        for height, width in sizes:
+            data = _Dataset(tmp, height, width, count, seed)
+            for stage in stages:
+                for n_workers in workers:
+                    times = []
+                    for run in range(repeat):
+                        scratch = Path(tmp) / 'scratch' / f"{stage}_{n_workers}_{run}"
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            start = time.perf_counter()
+                            STAGES[stage](data, n_workers, scratch)
+                            times.append(time.perf_counter() - start)
+                    best = min(times)
+                    result = {
+                        'stage': stage, 'size': f"{height}x{width}", 'workers': n_workers, 'images': count,
+                        'megapixels': data.megapixels, 'seconds': best, 'median_seconds': float(np.median(times)),
+                        'mp_per_s': data.megapixels / best,
+                    }
+                    results.append(result)
+                    print(f"{stage:22s} {result['size']:>11s} workers={n_workers:<3d} "
+                          f"{best:8.3f} s {result['mp_per_s']:9.1f} MP/s")
+    return results
+
+def _case_key(result):
+    return f"{result['stage']}/{result['size']}/w{result['workers']}"
+
+def compare_to_baseline(results, baseline, threshold=0.1):
+    """
+    Compare throughput with a baseline run
+    
+    Args:
+        results (list): Results of run_benchmarks
+        baseline (list): Earlier results, e.g. loaded from a results file
+        threshold (float): Relative slowdown that counts as a regression
+    
+    Returns:
+        list: (case, baseline MP/s, current MP/s, ratio) of every regression
+    """
+    previous = {_case_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        key = _case_key(result)
+        if key not in previous:
+            continue
+        ratio = result['mp_per_s'] / previous[key]['mp_per_s']
+        flag = "REGRESSION" if ratio < 1 - threshold else ""
+        print(f"{key:45s} {previous[key]['mp_per_s']:9.1f} -> {result['mp_per_s']:9.1f} MP/s "
+              f"({ratio - 1:+.1%}) {flag}")
+        if flag:
+            regressions.append((key, previous[key]['mp_per_s'], result['mp_per_s'], ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic OCT B-scans")
+    parser.add_argument('--sizes', default="1024x1024,2048x4096",
+                        help="Comma-separated HEIGHTxWIDTH image sizes (default 1024x1024,2048x4096)")
+    parser.add_argument('--workers', default="1",
+                        help="Comma-separated worker counts (0 = all cores, default 1)")
+    parser.add_argument('--count', type=int, default=4, help="Images per case (default 4)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the fastest is kept (default 3)")
+    parser.add_argument('--stages', default=None,
+                        help=f"Comma-separated stages (default all: {', '.join(STAGES)})")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Save the results as JSON")
+    parser.add_argument('--baseline', default=None, help="Compare with a results file from an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Slowdown that counts as a regression (default 0.1 = 10%%)")
+    parser.add_argument('--work-dir', default=None, help="Directory for the synthetic data")
+    args = parser.parse_args()
+    
+    results = run_benchmarks([_parse_size(s) for s in args.sizes.split(',')],
+                             [int(w) for w in args.workers.split(',')], args.count, args.repeat,
+                             args.stages.split(',') if args.stages else None, args.seed, args.work_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+            sys.exit(1)
+        print("No regressions")
@@ -0,0 +1,302 @@
+import argparse
+import json
+from pathlib import Path
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from concat_images import _image_geometry, concat_layout, group_by_prefix
+from image_io import list_images, read_image
+from profiling import add_profile_argument, profile_step, profiling
+from split_and_enhance import tile_positions
+
+# Interior lines compared with each seam, on either side of it
+SEAM_BAND = 16
+# Columns averaged on each side when measuring an intensity step
+STEP_WIDTH = 4
+# Rows (or columns) gathered per chunk when profiling seams
+_CHUNK = 2048
+# Lowest interior level a seam is compared with, so flat regions do not give huge ratios
+_FLOOR = 0.5
+# Fewest seams whose spread is used to find outliers
+_MIN_SEAMS = 8
+
+def grid_seams(height, width, tile_size=1024, overlap=0):
+    """
+    Seams of an image reassembled from split_image tiles
+    
+    Tiles are pasted in order, so a later tile covers the end of the one
+    before it and the visible edge is where each tile starts, including
+    the last tile of a row or column that split_image shifts back to end
+    on the image border.
+    
+    Returns:
+        list: (axis, position, start, end) seams; axis 'x' is the vertical
+            line between columns position-1 and position, spanning rows
+            start..end, and axis 'y' the horizontal line between rows
+    """
+    boxes = tile_positions(height, width, tile_size, overlap)
+    xs = sorted({x1 for x1, _, _, _ in boxes} - {0})
+    ys = sorted({y1 for _, y1, _, _ in boxes} - {0})
+    return [('x', x, 0, height) for x in xs] + [('y', y, 0, width) for y in ys]
+
+def concat_seams(geometry):
+    """
+    Seams of an image made by concat_images from images of the given
+    (height, width, channels); each spans only the rows both images cover
+    """
+    _, offsets = concat_layout(geometry)
+    seams = []
+    for (x_left, y_left), (x, y), (h_left, _, _), (h, _, _) in zip(offsets, offsets[1:], geometry, geometry[1:]):
+        start, end = max(y_left, y), min(y_left + h_left, y + h)
+        if end > start:
+            seams.append(('x', x, start, end))
+    return seams
+
+def _vertical_profiles(img, seams, band, step_width):
+    """
+    Gradient and intensity-step statistics around vertical seams
+    
+    The 2 * band + 2 columns around every seam are gathered into one
+    (rows, seams, columns) block per chunk of rows, so all seams of the
+    image are measured with a few array operations; rows outside a seam's
+    span are masked out.
+    
+    Returns:
+        tuple: (gradient, step) arrays of shape (seams, 2 * band + 1); entry
+            band is the seam itself, NaN marks lines outside the image
+    """
+    height, width = img.shape
+    positions = np.array([pos for _, pos, _, _ in seams])
+    spans = np.array([(start, end) for _, _, start, end in seams])
+    cols = positions[:, None] + np.arange(-band - 1, band + 1)[None, :]
+    inside = (cols >= 0) & (cols < width)
+    cols = np.clip(cols, 0, width - 1)
+    
+    diff_sum = np.zeros(cols.shape[0:1] + (cols.shape[1] - 1,))
+    mean_sum = np.zeros(cols.shape)
+    for y in range(spans[:, 0].min(), spans[:, 1].max(), _CHUNK):
+        rows = np.arange(y, min(y + _CHUNK, height))
+        weight = ((rows[:, None] >= spans[None, :, 0]) & (rows[:, None] < spans[None, :, 1])).astype(np.float32)
+        block = img[rows[0]:rows[-1] + 1][:, cols].astype(np.float32)
+        diff_sum += np.einsum('rs,rsk->sk', weight, np.abs(np.diff(block, axis=2)))
+        mean_sum += np.einsum('rs,rsk->sk', weight, block)
+    count = (spans[:, 1] - spans[:, 0])[:, None]
+    gradient = diff_sum / count
+    gradient[~(inside[:, 1:] & inside[:, :-1])] = np.nan
+    
+    # Step at each boundary: mean of step_width columns on the right minus on the left
+    means = mean_sum / count
+    zero = np.zeros((len(means), 1))
+    cumulative = np.concatenate([zero, np.cumsum(means, axis=1)], axis=1)
+    outside = np.concatenate([zero, np.cumsum(~inside, axis=1)], axis=1)
+    boundaries = np.arange(1, means.shape[1])
+    left = np.clip(boundaries - step_width, 0, None)
+    right = np.clip(boundaries + step_width, None, means.shape[1])
+    step = np.abs((cumulative[:, right] - cumulative[:, boundaries]) / (right - boundaries) -
+                  (cumulative[:, boundaries] - cumulative[:, left]) / (boundaries - left))
+    # Steps whose windows run off the profile or the image are not comparable
+    step[:, (boundaries < step_width) | (boundaries > means.shape[1] - step_width)] = np.nan
+    step[outside[:, right] - outside[:, left] > 0] = np.nan
+    return gradient, step
+
+def seam_statistics(img, seams, band=SEAM_BAND, step_width=STEP_WIDTH):
+    """
+    Compare every seam line with the interior lines next to it
+    
+    Args:
+        img (np.ndarray): 2-D uint8 image
+        seams (list): (axis, position, start, end) from grid_seams or concat_seams
+        band (int): Interior lines used on each side of a seam
+        step_width (int): Lines averaged on each side for the intensity step
+    
+    Returns:
+        list: One dict per seam with its axis and position, the mean
+            absolute difference across it ('gradient'), the median of the
+            same over the interior lines ('interior_gradient'), their ratio,
+            and likewise for the step in mean intensity
+    """
+    results = []
+    offsets = np.arange(-band, band + 1)
+    for axis, view in (('x', img), ('y', img.T)):
+        axis_seams = [seam for seam in seams if seam[0] == axis]
+        if not axis_seams:
+            continue
+        gradient, step = _vertical_profiles(view, axis_seams, band, step_width)
+        interior_gradient = np.nanmedian(np.where(np.abs(offsets) > 1, gradient, np.nan), axis=1)
+        interior_step = np.nanmedian(np.where(np.abs(offsets) >= step_width, step, np.nan), axis=1)
+        for i, (_, pos, start, end) in enumerate(axis_seams):
+            results.append({
+                'axis': axis, 'position': int(pos), 'start': int(start), 'end': int(end),
+                'gradient': float(gradient[i, band]),
+                'interior_gradient': float(interior_gradient[i]),
+                'gradient_ratio': float(gradient[i, band] / max(interior_gradient[i], _FLOOR)),
+                'step': float(step[i, band]),
+                'interior_step': float(interior_step[i]),
+                'step_ratio': float(step[i, band] / max(interior_step[i], _FLOOR)),
+            })
+    return results
+
+def check_image(image_path, seams=None, tile_size=1024, overlap=0, band=SEAM_BAND, step_width=STEP_WIDTH):
+    """
+    Measure the seams of one image
+    
+    Args:
+        image_path (str or Path): Reassembled or concatenated image
+        seams (list): Its seams, or None for the split_image grid of
+            tile_size and overlap
+        tile_size (int): Tile size of the split
+        overlap (int): Overlap of the split
+        band (int): Interior lines used on each side of a seam
+        step_width (int): Lines averaged on each side for the intensity step
+    
+    Returns:
+        list: Seam statistics, see seam_statistics
+    """
+    img = read_image(image_path, grayscale=True)
+    if img is None:
+        raise ValueError(f"Could not read image {image_path}")
+    if seams is None:
+        seams = grid_seams(img.shape[0], img.shape[1], tile_size, overlap)
+    if not seams:
+        return []
+    with profile_step('seams'):
+        return seam_statistics(img, seams, band, step_width)
+
+def _check_task(task):
+    """Worker task: measure the seams of one image"""
+    image_path, seams, options = task
+    return check_image(image_path, seams, **options)
+
+def _robust_z(values):
+    """Distance of each value above the median in units of the scaled median absolute deviation"""
+    values = np.asarray(values, dtype=np.float64)
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    if mad == 0:
+        return np.where(values > median, np.inf, 0.0)
+    return (values - median) / mad
+
+def flag_outliers(records, z_threshold=3.5, min_ratio=1.5):
+    """
+    Flag the seams that stand out across the corpus
+    
+    A seam is flagged when its gradient or step ratio is both a robust
+    outlier among all seams (z above z_threshold) and at least min_ratio,
+    so a corpus without visible seams flags nothing. With fewer than
+    _MIN_SEAMS seams there is no meaningful spread, and min_ratio alone
+    decides.
+    
+    Args:
+        records (list): Seam dicts of all images; 'flagged' is set on each
+        z_threshold (float): Robust z-score above which a ratio is an outlier
+        min_ratio (float): Smallest ratio ever flagged
+    
+    Returns:
+        list: The flagged records
+    """
+    if not records:
+        return []
+    for name in ('gradient_ratio', 'step_ratio'):
+        ratios = [record[name] for record in records]
+        scores = _robust_z(ratios) if len(records) >= _MIN_SEAMS else np.full(len(records), np.inf)
+        for record, z in zip(records, scores):
+            record[f"{name}_z"] = float(z) if np.isfinite(z) else None
+            record['flagged'] = record.get('flagged', False) or bool(z > z_threshold and record[name] >= min_ratio)
+    return [record for record in records if record['flagged']]
+
+def concat_jobs(image_dir, source_dir):
+    """
+    Pair the outputs of concat_images with the seams of their source groups
+    
+    Returns:
+        list: (image path, seams) for every "<prefix>_combined.png" whose
+            group is found in source_dir
+    """
+    groups = group_by_prefix(list_images(source_dir))
+    jobs = []
+    for image_path in list_images(image_dir, "*_combined.png"):
+        prefix = image_path.stem[:-len("_combined")]
+        if prefix in groups:
+            jobs.append((image_path, concat_seams([_image_geometry(path) for path in groups[prefix]])))
+        else:
+            print(f"No source images for {image_path.name}")
+    return jobs
+
+def check_seams(image_dir, layout='grid', source_dir=None, tile_size=1024, overlap=0, band=SEAM_BAND,
+                step_width=STEP_WIDTH, z_threshold=3.5, min_ratio=1.5, output_path=None, workers=1):
+    """
+    Check reassembled or concatenated images for visible seams (step 2.2 of Plan.md)
+    
+    Args:
+        image_dir (str or Path): Output directory of reassemble_tiles or concat_images
+        layout (str): 'grid' for images reassembled from split_image tiles,
+            'concat' for images made by concat_images
+        source_dir (str or Path): For 'concat', the directory of the
+            enhanced images that were concatenated
+        tile_size (int): Tile size of the split ('grid')
+        overlap (int): Overlap of the split ('grid')
+        band (int): Interior lines used on each side of a seam
+        step_width (int): Lines averaged on each side for the intensity step
+        z_threshold (float): Robust z-score above which a seam is an outlier
+        min_ratio (float): Smallest seam/interior ratio ever flagged
+        output_path (str or Path): Optional JSON report
+        workers (int): Number of worker processes (0 = all cores)
+    
+    Returns:
+        dict: Image name -> list of seam statistics, each with 'flagged'
+    """
+    if layout == 'concat':
+        if source_dir is None:
+            raise ValueError("The concat layout needs the source directory of the concatenated images")
+        jobs = concat_jobs(image_dir, source_dir)
+    else:
+        jobs = [(image_path, None) for image_path in list_images(image_dir)]
+    options = {'tile_size': tile_size, 'overlap': overlap, 'band': band, 'step_width': step_width}
+    tasks = [(image_path, seams, options) for image_path, seams in jobs]
+    print(f"Checking {len(tasks)} images")
+    
+    report = {}
+    errors = 0
+    for (image_path, _, _), seams, error in run_batch(_check_task, tasks, workers):
+        if error is None:
+            report[Path(image_path).name] = seams
+        else:
+            errors += 1
+            print(f"Error checking {image_path}: {error}")
+    
+    flagged = flag_outliers([seam for seams in report.values() for seam in seams], z_threshold, min_ratio)
+    for name, seams in report.items():
+        for seam in seams:
+            if seam['flagged']:
+                line = "column" if seam['axis'] == 'x' else "row"
+                print(f"Seam at {line} {seam['position']} of {name}: gradient x{seam['gradient_ratio']:.2f}, "
+                      f"step x{seam['step_ratio']:.2f}")
+    print(f"\n{len(flagged)} of {sum(map(len, report.values()))} seams flagged in {len(report)} images")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {output_path}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check reassembled or concatenated images for visible seams")
+    parser.add_argument('image_dir', help="Output directory of reassemble_tiles or concat_images")
+    parser.add_argument('--layout', choices=('grid', 'concat'), default='grid',
+                        help="Seams of the split_image tile grid, or of concat_images groups")
+    parser.add_argument('--source-dir', default=None, help="Enhanced images that were concatenated (concat layout)")
+    parser.add_argument('--tile-size', type=int, default=1024, help="Tile size of the split (grid layout)")
+    parser.add_argument('--overlap', type=int, default=0, help="Overlap of the split (grid layout)")
+    parser.add_argument('--band', type=int, default=SEAM_BAND, help="Interior lines compared on each side of a seam")
+    parser.add_argument('--z-threshold', type=float, default=3.5,
+                        help="Robust z-score across the corpus above which a seam is flagged")
+    parser.add_argument('--min-ratio', type=float, default=1.5, help="Smallest seam/interior ratio ever flagged")
+    parser.add_argument('--output', default=None, help="Save the per-seam statistics as JSON")
+    add_workers_argument(parser, opencv_threads=False)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    with profiling(args.profile):
+        check_seams(args.image_dir, args.layout, args.source_dir, args.tile_size, args.overlap, args.band,
+                    STEP_WIDTH, args.z_threshold, args.min_ratio, args.output, args.workers)
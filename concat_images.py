@@ -1,18 +1,73 @@
+import argparse
 import os
 import re
+import tempfile
+from pathlib import Path
+import numpy as np
 from PIL import Image
-import glob
+from batch_executor import add_workers_argument, run_batch
+from image_io import list_images, read_image, read_png_size, write_image
+from manifest import add_manifest_argument, code_version, open_manifest
+from profiling import add_profile_argument, profile_step, profiling
 
-def concat_images_with_same_prefix(input_dir):
-    # Get all images
-    image_files = glob.glob(os.path.join(input_dir, '*.png'))
+# Version of the concatenation code, recorded in incremental-rebuild manifests
+CONCAT_CODE_VERSION = code_version(__file__)
+
+# Canvases larger than this many bytes are kept in a disk-backed memmap
+DEFAULT_MEMORY_LIMIT = 1 << 30
+
+# Timestamp prefix of an enhanced image (e.g., '05-1_1_12-03-15-26-16')
+_PREFIX_RE = re.compile(r'([\d-]+_\d+_[\d-]+-[\d-]+-[\d-]+)_res_processed')
+_RESOLUTION_RE = re.compile(r'x(\d+)')
+
+def _resolution(path):
+    """Sort key of an image within its group: the number after 'x' in its path"""
+    match = _RESOLUTION_RE.search(path)
+    return int(match.group(1)) if match else 0
+
+def _image_geometry(path):
+    """Return (height, width, channels) from the file header, without decoding the pixels"""
+    size = read_png_size(path)
+    if size is None:
+        # PIL only reads the header when opening
+        with Image.open(path) as img:
+            size = (img.height, img.width, 1 if img.mode == 'L' else 3)
+    return size
+
+def concat_layout(geometry):
+    """
+    Plan the canvas of one group from the (height, width, channels) of its images
     
-    # Group images by timestamp prefix
+    Returns:
+        tuple: (canvas shape, list of (x, y) offsets of the images)
+    """
+    max_height = max(h for h, _, _ in geometry)
+    total_width = sum(w for _, w, _ in geometry)
+    shape = (max_height, total_width) + ((3,) if any(c > 1 for _, _, c in geometry) else ())
+    offsets = []
+    x_offset = 0
+    for height, width, _ in geometry:
+        # Calculate vertical position to center the image
+        offsets.append((x_offset, (max_height - height) // 2))
+        x_offset += width
+    return shape, offsets
+
+def group_by_prefix(image_files, pattern=_PREFIX_RE):
+    """
+    Group enhanced images by timestamp prefix
+    
+    Args:
+        image_files (list): Paths of the enhanced images
+        pattern (re.Pattern): Regex matching a file name, its first group is the prefix
+    
+    Returns:
+        dict: Prefix -> paths (str) sorted by resolution
+    """
     prefix_groups = {}
-    for img_path in image_files:
+    for img_path in map(str, image_files):
         basename = os.path.basename(img_path)
         # Extract the timestamp prefix (e.g., '05-1_1_12-03-15-26-16')
-        match = re.match(r'([\d-]+_\d+_[\d-]+-[\d-]+-[\d-]+)_res_processed', basename)
+        match = pattern.match(basename)
         if match:
             prefix = match.group(1)
             if prefix not in prefix_groups:
@@ -21,43 +76,115 @@ def concat_images_with_same_prefix(input_dir):
     
     # Sort images within each group by resolution
     for prefix in prefix_groups:
-        prefix_groups[prefix].sort(key=lambda x: int(re.search(r'x(\d+)', x).group(1)) if re.search(r'x(\d+)', x) else 0)
+        prefix_groups[prefix].sort(key=_resolution)
+    return prefix_groups
+
+def concat_group(image_paths, output_path, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None):
+    """
+    Concatenate one group of images side by side, vertically centred
     
-    # Create output directory if it doesn't exist
-    output_dir = os.path.join(os.path.dirname(input_dir), 'concatenated_enhanced')
-    os.makedirs(output_dir, exist_ok=True)
+    The layout is planned from the image headers, then the images are
+    decoded one at a time straight into a preallocated canvas, so the peak
+    memory is about one output image plus one input. The canvas is
+    single-channel when all sources are grey, and kept in a memmap in
+    scratch_dir when it is larger than memory_limit bytes.
     
-    # Process each group
-    for prefix, image_paths in prefix_groups.items():
-        if not image_paths:
-            continue
-            
-        # Open all images
-        images = [Image.open(path) for path in image_paths]
-        
-        # Get dimensions
-        max_height = max(img.height for img in images)
-        total_width = sum(img.width for img in images)
-        
-        # Create new image
-        combined = Image.new('RGB', (total_width, max_height))
+    Args:
+        image_paths (list): Paths of the images, left to right
+        output_path (str): Path of the combined image
+        memory_limit (int): Largest canvas in bytes kept in memory
+        scratch_dir (str or Path): Directory for the canvas memmap
+    """
+    # Get dimensions
+    geometry = [_image_geometry(path) for path in image_paths]
+    shape, offsets = concat_layout(geometry)
+    
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        if np.prod(shape) <= memory_limit:
+            combined = np.zeros(shape, dtype=np.uint8)
+        else:
+            combined = np.memmap(Path(tmp) / 'canvas.u8', dtype=np.uint8, mode='w+', shape=shape)
         
         # Paste images
-        x_offset = 0
-        for img in images:
-            # Calculate vertical position to center the image
-            y_offset = (max_height - img.height) // 2
-            combined.paste(img, (x_offset, y_offset))
-            x_offset += img.width
-            img.close()
+        for path, (height, width, _), (x_offset, y_offset) in zip(image_paths, geometry, offsets):
+            img = read_image(path)
+            if img is None:
+                raise ValueError(f"Could not read image {path}")
+            with profile_step('concat'):
+                region = combined[y_offset:y_offset + height, x_offset:x_offset + width]
+                region[...] = img[:, :, None] if img.ndim < combined.ndim else img
+            del img
         
         # Save combined image
+        write_image(output_path, combined)
+        del combined
+
+def _concat_group_task(task):
+    """Worker task: concatenate one (prefix, image_paths, output_path) group"""
+    _, image_paths, output_path, memory_limit, scratch_dir = task
+    concat_group(image_paths, output_path, memory_limit, scratch_dir)
+
+def concat_images_with_same_prefix(input_dir, workers=1, manifest=None, memory_limit=DEFAULT_MEMORY_LIMIT,
+                                   scratch_dir=None):
+    """
+    Concatenate enhanced images that share a timestamp prefix
+    
+    Args:
+        input_dir (str): Directory containing the enhanced images
+        workers (int): Number of worker processes (0 = all cores)
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            groups whose combined image is up to date are skipped
+        memory_limit (int): Largest canvas in bytes kept in memory; larger
+            ones are kept in a memmap in scratch_dir
+        scratch_dir (str or Path): Directory for canvas memmaps
+    
+    Returns:
+        tuple: (processed, errors) counts of prefix groups
+    """
+    manifest, own_manifest = open_manifest(manifest)
+    
+    # Group images by timestamp prefix
+    prefix_groups = group_by_prefix(list_images(input_dir))
+    
+    # Create output directory if it doesn't exist
+    output_dir = os.path.join(os.path.dirname(input_dir), 'concatenated_enhanced')
+    os.makedirs(output_dir, exist_ok=True)
+    
+    tasks = []
+    for prefix, image_paths in prefix_groups.items():
         output_path = os.path.join(output_dir, f'{prefix}_combined.png')
-        combined.save(output_path)
-        combined.close()
-        
-        print(f'Concatenated {len(image_paths)} images with prefix {prefix}')
+        if manifest is not None and manifest.is_up_to_date(output_path, image_paths, None, CONCAT_CODE_VERSION):
+            continue
+        tasks.append((prefix, image_paths, output_path, memory_limit, scratch_dir))
+    processed = 0
+    errors = 0
+    
+    # Process each group
+    for (prefix, image_paths, output_path, _, _), _, error in run_batch(_concat_group_task, tasks, workers):
+        if error is None:
+            processed += 1
+            print(f'Concatenated {len(image_paths)} images with prefix {prefix}')
+            if manifest is not None:
+                manifest.record(output_path, 'concat', image_paths, [output_path], None, CONCAT_CODE_VERSION)
+        else:
+            errors += 1
+            print(f'Error concatenating images with prefix {prefix}: {error}')
+    
+    if own_manifest:
+        manifest.close()
+    
+    return processed, errors
 
 if __name__ == '__main__':
-    input_dir = os.path.join(os.path.dirname(__file__), 'enhanced_images')
-    concat_images_with_same_prefix(input_dir)
+    parser = argparse.ArgumentParser(description="Concatenate images sharing a timestamp prefix")
+    parser.add_argument('input_dir', nargs='?', default=os.path.join(os.path.dirname(__file__), 'enhanced_images'))
+    parser.add_argument('--memory-limit', type=int, default=DEFAULT_MEMORY_LIMIT,
+                        help="Largest canvas in bytes kept in memory; larger ones use a disk-backed memmap")
+    parser.add_argument('--scratch-dir', default=None, help="Directory for canvas memmaps")
+    add_workers_argument(parser, opencv_threads=False)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with profiling(args.profile):
+        concat_images_with_same_prefix(args.input_dir, args.workers, args.manifest, args.memory_limit,
+                                       args.scratch_dir)
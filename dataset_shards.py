@@ -0,0 +1,322 @@
+import argparse
+import hashlib
+import io
+import json
+import tarfile
+from pathlib import Path
+import cv2
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from manifest import add_manifest_argument, code_version, open_manifest
+from image_io import read_image
+from process_labelme import load_labelme_json, create_mask, annotated_tiles, LABELME_CODE_VERSION
+from profiling import add_profile_argument, profile_step, profiling
+
+# Version of the shard writer, recorded in incremental-rebuild manifests
+SHARDS_CODE_VERSION = code_version(__file__, depends=(LABELME_CODE_VERSION,))
+
+INDEX_NAME = "index.json"
+
+def split_of(source, val_fraction=0.0, seed=0):
+    """
+    Assign a source image to 'train' or 'val'
+    
+    The assignment depends only on the source name and the seed, so all
+    tiles of an image land in the same split and reruns (or new images)
+    never move an image between splits.
+    """
+    if val_fraction <= 0:
+        return 'train'
+    digest = hashlib.sha1(f"{seed}:{source}".encode('utf-8')).hexdigest()
+    return 'val' if int(digest[:8], 16) / 2**32 < val_fraction else 'train'
+
+class ShardWriter:
+    """
+    Write (image, mask, metadata) samples into size-bounded tar shards
+    
+    Each sample is stored as three tar members sharing a key, the layout
+    WebDataset-style loaders read: "<key>.image.png", "<key>.mask.png" and
+    "<key>.json" with the source image, tile position and whether the tile
+    is annotated. A new shard ("<prefix>-000000.tar", ...) is started when
+    the current one would exceed max_shard_bytes. The data offsets of
+    every member are kept for the index, so a sample can also be read with
+    two small reads instead of scanning the tar.
+    
+    Args:
+        output_dir (str or Path): Directory for the shards
+        prefix (str): Shard name prefix, usually the split name
+        max_shard_bytes (int): Size limit of a shard
+        shuffle_buffer (int): Shuffle samples through a buffer of this many
+            samples before writing (0 = keep the input order)
+        seed (int): Seed of the shuffle
+    """
+    def __init__(self, output_dir, prefix='train', max_shard_bytes=256 << 20, shuffle_buffer=0, seed=0):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = np.random.default_rng(seed)
+        self.shards = []
+        self.samples = []
+        self._buffer = []
+        self._tar = None
+        self._shard_bytes = 0
+    
+    def add(self, sample):
+        """
+        Add a sample: a dict with 'source', 'x', 'y', 'positive' and the
+        PNG-encoded 'image' and 'mask' bytes
+        """
+        if self.shuffle_buffer <= 1:
+            self._write(sample)
+            return
+        self._buffer.append(sample)
+        if len(self._buffer) >= self.shuffle_buffer:
+            # Write a random buffered sample (swap-remove)
+            i = int(self.rng.integers(len(self._buffer)))
+            self._buffer[i], self._buffer[-1] = self._buffer[-1], self._buffer[i]
+            self._write(self._buffer.pop())
+    
+    def _open_shard(self):
+        self._close_shard()
+        name = f"{self.prefix}-{len(self.shards):06d}.tar"
+        self._tar = tarfile.open(self.output_dir / name, 'w', format=tarfile.PAX_FORMAT)
+        self._shard_bytes = 0
+        self.shards.append({'name': name, 'samples': 0, 'bytes': 0})
+    
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self.shards[-1]['bytes'] = (self.output_dir / self.shards[-1]['name']).stat().st_size
+            self._tar = None
+    
+    def _add_member(self, name, data):
+        """Add one member and return the offset of its data in the shard"""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        header = info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+        offset = self._tar.offset + len(header)
+        self._tar.addfile(info, io.BytesIO(data))
+        return offset
+    
+    def _write(self, sample):
+        key = f"{sample['source']}_{sample['x']}_{sample['y']}".replace('.', '_')
+        meta = {'source': sample['source'], 'x': sample['x'], 'y': sample['y'], 'positive': sample['positive']}
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+        size = len(sample['image']) + len(sample['mask']) + len(meta_bytes) + 3 * 1024
+        if self._tar is None or (self._shard_bytes and self._shard_bytes + size > self.max_shard_bytes):
+            self._open_shard()
+        
+        with profile_step('shards.write'):
+            image_offset = self._add_member(f"{key}.image.png", sample['image'])
+            mask_offset = self._add_member(f"{key}.mask.png", sample['mask'])
+            self._add_member(f"{key}.json", meta_bytes)
+        self._shard_bytes += size
+        self.shards[-1]['samples'] += 1
+        self.samples.append(dict(meta, key=key, shard=len(self.shards) - 1,
+                                 image=[image_offset, len(sample['image'])], mask=[mask_offset, len(sample['mask'])]))
+    
+    def close(self):
+        """Flush the shuffle buffer and close the last shard"""
+        self.rng.shuffle(self._buffer)
+        for sample in self._buffer:
+            self._write(sample)
+        self._buffer = []
+        self._close_shard()
+
+class ShardDataset:
+    """
+    Random-access reader for shards written by write_dataset_shards
+    
+    Only the index is read up front; a sample costs two small reads from
+    its (memory-mapped) shard and two PNG decodes. Shards can equally be
+    streamed sequentially as plain tar files.
+    
+    Args:
+        dataset_dir (str or Path): Directory with the shards and index.json
+        split (str): 'train' or 'val'
+    """
+    def __init__(self, dataset_dir, split='train'):
+        self.dataset_dir = Path(dataset_dir)
+        with open(self.dataset_dir / INDEX_NAME) as f:
+            index = json.load(f)
+        self.labels = index.get('labels')
+        self.shards = index['splits'].get(split, {}).get('shards', [])
+        self.samples = index['splits'].get(split, {}).get('samples', [])
+        self._maps = {}
+    
+    def __len__(self):
+        return len(self.samples)
+    
+    def _read(self, shard, offset, size):
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(self.dataset_dir / self.shards[shard]['name'], dtype=np.uint8, mode='r')
+        return self._maps[shard][offset:offset + size]
+    
+    def __getitem__(self, i):
+        """Return (image tile, mask tile, metadata dict) of sample i"""
+        sample = self.samples[i]
+        image = cv2.imdecode(self._read(sample['shard'], *sample['image']), cv2.IMREAD_UNCHANGED)
+        mask = cv2.imdecode(self._read(sample['shard'], *sample['mask']), cv2.IMREAD_UNCHANGED)
+        return image, mask, {key: sample[key] for key in ('source', 'x', 'y', 'positive')}
+
+def _encode_png(img):
+    ok, data = cv2.imencode('.png', img)
+    if not ok:
+        raise ValueError("Could not encode tile")
+    return data.tobytes()
+
+def _annotation_samples(task):
+    """
+    Worker task: tile one annotated image
+    
+    Returns:
+        list: Samples of the annotated tiles plus the sampled negative tiles
+    """
+    image_path, json_path, tile_size, label_ids, negative_ratio, seed = task
+    image = read_image(image_path)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+    shapes = load_labelme_json(json_path)['shapes']
+    with profile_step('labelme.mask'):
+        mask = create_mask(shapes, (image.shape[1], image.shape[0]), label_ids)
+    tiles = annotated_tiles(image, mask, shapes, tile_size, label_ids)
+    
+    source = Path(image_path).stem
+    positives = [tile for tile in tiles if tile[3]]
+    negatives = [tile for tile in tiles if not tile[3]]
+    n_negative = min(len(negatives), int(round(negative_ratio * len(positives))))
+    if n_negative:
+        # Deterministic per source image
+        rng = np.random.default_rng(int(hashlib.sha1(f"{seed}:{source}".encode('utf-8')).hexdigest()[:8], 16))
+        chosen = sorted(rng.choice(len(negatives), n_negative, replace=False))
+        negatives = [negatives[i] for i in chosen]
+    else:
+        negatives = []
+    
+    with profile_step('shards.encode'):
+        return [{'source': source, 'x': int(pos[0]), 'y': int(pos[1]), 'positive': positive,
+                 'image': _encode_png(tile_img), 'mask': _encode_png(tile_mask)}
+                for tile_img, tile_mask, pos, positive in positives + negatives]
+
+def write_dataset_shards(input_dir, output_dir, tile_size=512, max_shard_bytes=256 << 20, shuffle_buffer=0,
+                         val_fraction=0.0, negative_ratio=0.0, seed=0, labels=None, workers=1, opencv_threads=None,
+                         manifest=None):
+    """
+    Pack the LabelMe-annotated images of a directory into training shards
+    
+    Produces the same image/mask tiles as process_labelme.process_directory,
+    but packed into tar shards per split with an index.json describing
+    every shard and sample.
+    
+    Args:
+        input_dir (str or Path): Directory of images with LabelMe JSON files
+        output_dir (str or Path): Directory for the shards and index
+        tile_size (int): Size of the square tiles
+        max_shard_bytes (int): Size limit of a shard
+        shuffle_buffer (int): Shuffle samples at write time through a buffer
+            of this many samples (0 = keep source order)
+        val_fraction (float): Fraction of source images assigned to 'val',
+            chosen deterministically from the image name
+        negative_ratio (float): Unannotated tiles to include per annotated
+            tile of the same image (0 = only annotated tiles)
+        seed (int): Seed of the shuffle, split and negative sampling
+        labels (list): Class names for multi-class masks (IDs 1..N); None
+            for binary 0/255 masks
+        workers (int): Number of worker processes (0 = all cores)
+        opencv_threads (int): OpenCV threads per worker process
+        manifest (str, Path or Manifest): Optional incremental-rebuild
+            manifest; the shards are only rebuilt when an input or option changed
+    
+    Returns:
+        dict: The index, or None if the shards were up to date
+    """
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    label_ids = {label: i for i, label in enumerate(labels, 1)} if labels else None
+    manifest, own_manifest = open_manifest(manifest)
+    stage_params = {'tile_size': tile_size, 'max_shard_bytes': max_shard_bytes, 'shuffle_buffer': shuffle_buffer,
+                    'val_fraction': val_fraction, 'negative_ratio': negative_ratio, 'seed': seed, 'labels': label_ids}
+    
+    pairs = [(png, png.with_suffix('.json')) for png in sorted(input_dir.glob('*.png'))
+             if png.with_suffix('.json').exists()]
+    inputs = [path for pair in pairs for path in pair]
+    index_path = output_dir / INDEX_NAME
+    if manifest is not None and manifest.is_up_to_date(index_path, inputs, stage_params, SHARDS_CODE_VERSION):
+        print(f"Shards are up to date: {output_dir}")
+        if own_manifest:
+            manifest.close()
+        return None
+    
+    # Remove shards of an earlier run, which may have had more of them
+    for old_shard in output_dir.glob('*-[0-9][0-9][0-9][0-9][0-9][0-9].tar'):
+        old_shard.unlink()
+    
+    writers = {}
+    tasks = [(png, json_file, tile_size, label_ids, negative_ratio, seed) for png, json_file in pairs]
+    errors = 0
+    for i, (task, samples, error) in enumerate(run_batch(_annotation_samples, tasks, workers,
+                                                          opencv_threads=opencv_threads), 1):
+        if error is not None:
+            errors += 1
+            print(f"Error processing {task[0]}: {error}")
+            continue
+        split = split_of(task[0].stem, val_fraction, seed)
+        if split not in writers:
+            writers[split] = ShardWriter(output_dir, split, max_shard_bytes, shuffle_buffer, seed)
+        for sample in samples:
+            writers[split].add(sample)
+        print(f"Processed {i}/{len(tasks)}: {task[0].name} ({len(samples)} samples, {split})")
+    
+    index = {'tile_size': tile_size, 'labels': label_ids, 'splits': {}}
+    for split, writer in writers.items():
+        writer.close()
+        index['splits'][split] = {'shards': writer.shards, 'samples': writer.samples}
+    with open(index_path, 'w') as f:
+        json.dump(index, f, ensure_ascii=False)
+    
+    if manifest is not None and errors == 0:
+        shard_paths = [output_dir / shard['name'] for writer in writers.values() for shard in writer.shards]
+        manifest.record(index_path, 'shards', inputs, [index_path] + shard_paths, stage_params, SHARDS_CODE_VERSION)
+    if own_manifest:
+        manifest.close()
+    
+    for split, entry in index['splits'].items():
+        print(f"{split}: {len(entry['samples'])} samples in {len(entry['shards'])} shards")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    return index
+
+def add_shard_arguments(parser):
+    """Add the shard-writer options to an argparse parser"""
+    parser.add_argument('--shard-size', type=int, default=256 << 20,
+                        help="Size limit of a shard in bytes (default 256 MiB)")
+    parser.add_argument('--shuffle-buffer', type=int, default=0,
+                        help="Shuffle samples at write time through a buffer of this many samples")
+    parser.add_argument('--val-fraction', type=float, default=0.0,
+                        help="Fraction of source images put in the 'val' split (by image name)")
+    parser.add_argument('--negative-ratio', type=float, default=0.0,
+                        help="Unannotated tiles to include per annotated tile")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack LabelMe-annotated images into training shards")
+    parser.add_argument('input_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/concatenated_enhanced")
+    parser.add_argument('output_dir', nargs='?', default="dataset_shards")
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--labels', default=None,
+                        help="Comma-separated class names for multi-class masks (IDs 1, 2, ...)")
+    add_shard_arguments(parser)
+    add_workers_argument(parser)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    with profiling(args.profile):
+        write_dataset_shards(args.input_dir, args.output_dir, args.tile_size, args.shard_size, args.shuffle_buffer,
+                             args.val_fraction, args.negative_ratio, args.seed,
+                             args.labels.split(',') if args.labels else None, args.workers, args.opencv_threads,
+                             args.manifest)
@@ -1,14 +1,276 @@
+import argparse
 import cv2
+import functools
 import numpy as np
 import os
+import threading
 from pathlib import Path
+from batch_executor import add_workers_argument, run_batch
+from io_pipeline import add_pipeline_arguments, pipeline_from_args, pipeline_options, run_pipeline
+from manifest import add_manifest_argument, code_version, open_manifest
+from profiling import add_profile_argument, profile_step, profiling
+from image_io import read_image, write_image
 
-def enhance_image(image_path, output_path=None):
-    # Read the image
-    img = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise ValueError(f"Could not read the image: {image_path}")
+# Parameters of the enhancement. The defaults reproduce the original
+# algorithm exactly (see enhance_array_reference).
+DEFAULT_PARAMS = {
+    # Step 2: first CLAHE pass
+    'clip_limit': 8.0,
+    'tile_grid_size': 8,
+    # Step 3: gamma correction
+    'gamma': 0.6,
+    # Step 4: bilateral filter
+    'bilateral_d': 9,
+    'bilateral_sigma': 75,
+    # Steps 5-6: region masks and brightness boosts
+    'very_dark_threshold': 80,
+    'mid_threshold': 120,
+    'bright_threshold': 180,
+    'dilate_size': 5,
+    'very_dark_boost': 60,
+    'mid_boost': 30,
+    # Step 7: second CLAHE pass
+    'second_clip_limit': 3.0,
+    # Step 8: percentile contrast stretching
+    'low_percentile': 2,
+    'high_percentile': 98,
+    'stretch_max': 230.0,
+    # Step 9: unsharp mask
+    'blur_sigma': 3,
+    'sharpen_amount': 0.7,
+    # Step 10: final bilateral filter
+    'final_d': 5,
+    'final_sigma': 50,
+}
+
+def enhancement_params(params=None):
+    """
+    Merge user parameters with DEFAULT_PARAMS
+    
+    Args:
+        params (dict): Parameters to override, may be None
+    
+    Returns:
+        dict: Complete parameter set
+    """
+    merged = dict(DEFAULT_PARAMS)
+    if params:
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError(f"Unknown enhancement parameters: {sorted(unknown)}")
+        merged.update(params)
+    return merged
+
+def add_params_argument(parser):
+    """Add the shared --param NAME=VALUE option to an argparse parser"""
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help=f"Override an enhancement parameter, one of: {', '.join(DEFAULT_PARAMS)}")
+    return parser
+
+def parse_params(overrides):
+    """
+    Parse NAME=VALUE strings into a parameter dict, converting each value
+    to the type of its default
+    """
+    params = {}
+    for item in overrides or []:
+        name, sep, value = item.partition('=')
+        if not sep or name not in DEFAULT_PARAMS:
+            raise ValueError(f"Invalid enhancement parameter: {item}")
+        params[name] = type(DEFAULT_PARAMS[name])(value)
+    return params
+
+# Lookup tables for the point-wise steps of the enhancement. Every table is
+# computed with exactly the same numpy expression the original per-pixel code
+# used, so indexing with a uint8 image gives bit-identical results.
+_RAMP = np.arange(256, dtype=np.uint8)
+
+@functools.lru_cache(maxsize=64)
+def _gamma_lut(gamma):
+    """Step 3: gamma correction"""
+    return np.array(255 * (_RAMP / 255) ** gamma, dtype=np.uint8)
+
+@functools.lru_cache(maxsize=64)
+def _mid_lut(mid_threshold, bright_threshold):
+    """Step 5: mid-tone mask (above mid_threshold and not above bright_threshold)"""
+    return np.where((_RAMP > mid_threshold) & (_RAMP <= bright_threshold), 255, 0).astype(np.uint8)
+
+@functools.lru_cache(maxsize=64)
+def _boost_lut(bright_threshold, very_dark_boost, mid_boost):
+    """
+    Step 6: combined region boosts, indexed by
+    [2 * in_dilated_very_dark + in_dilated_mid, filtered_value]
+    """
+    ramp = _RAMP.astype(np.int32)
+    lut = np.empty((4, 256), dtype=np.uint8)
+    for code in range(4):
+        total = np.where(ramp > bright_threshold, ramp, 0)
+        if code & 2:
+            total += np.minimum(ramp + very_dark_boost, 255)
+        if code & 1:
+            total += np.minimum(ramp + mid_boost, 255)
+        lut[code] = np.minimum(total, 255)
+    return lut
+
+# CLAHE objects keep internal buffers, so they are cached per thread
+_local = threading.local()
 
+def _get_clahe(clip_limit, tile_grid_size=(8, 8)):
+    """Return a cached CLAHE object for the calling thread"""
+    cache = getattr(_local, 'clahe', None)
+    if cache is None:
+        cache = _local.clahe = {}
+    key = (clip_limit, tile_grid_size)
+    if key not in cache:
+        cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    return cache[key]
+
+def _percentile_from_hist(cdf, q):
+    """
+    Compute np.percentile(img, q) (linear method) from the cumulative histogram
+    of a uint8 image, reproducing numpy's interpolation arithmetic exactly.
+    
+    Args:
+        cdf (np.ndarray): Cumulative 256-bin histogram of the image
+        q (float): Percentile in the range [0, 100]
+    
+    Returns:
+        np.float64: The percentile value
+    """
+    n = int(cdf[-1])
+    virtual_index = (n - 1) * (q / 100)
+    if virtual_index >= n - 1:
+        previous_index = next_index = n - 1
+    else:
+        previous_index = int(np.floor(virtual_index))
+        next_index = previous_index + 1
+    # The k-th sorted value is the first bin whose cumulative count exceeds k
+    a = int(np.searchsorted(cdf, previous_index, side='right'))
+    b = int(np.searchsorted(cdf, next_index, side='right'))
+    t = virtual_index - np.floor(virtual_index)
+    diff_b_a = b - a
+    if t >= 0.5:
+        return np.float64(b - diff_b_a * (1 - t))
+    return np.float64(a + diff_b_a * t)
+
+def _normalize_lut(min_val, max_val):
+    """
+    Step 1 as a lookup table: cv2.normalize is a linear map fixed by the
+    image min/max, so it is evaluated once per grey level on a ramp clipped
+    to the same range.
+    """
+    return cv2.normalize(np.clip(_RAMP, int(min_val), int(max_val)), None,
+                         alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
+
+def _stretch_lut(cdf, params):
+    """Step 8 as a lookup table, from the cumulative histogram of the image"""
+    p_low = _percentile_from_hist(cdf, params['low_percentile'])
+    p_high = _percentile_from_hist(cdf, params['high_percentile'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip((_RAMP - p_low) * (params['stretch_max'] / (p_high - p_low)),
+                       0, 255).astype(np.uint8)
+
+def _stage_normalize(img, params):
+    # Step 1: Apply initial contrast normalization
+    min_val, max_val = cv2.minMaxLoc(img)[:2]
+    return cv2.LUT(img, _normalize_lut(min_val, max_val))
+
+def _stage_clahe(img, params):
+    # Step 2: Apply CLAHE with moderate settings to enhance local contrast
+    grid = params['tile_grid_size']
+    return _get_clahe(params['clip_limit'], (grid, grid)).apply(img)
+
+def _stage_gamma(img, params):
+    # Step 3: Apply gamma correction to boost dark regions
+    return cv2.LUT(img, _gamma_lut(params['gamma']))
+
+def _stage_bilateral(img, params):
+    # Step 4: Apply bilateral filter to reduce noise while preserving edges
+    sigma = params['bilateral_sigma']
+    return cv2.bilateralFilter(img, params['bilateral_d'], sigma, sigma)
+
+def _stage_region_boost(img, params):
+    # Step 5: Region masks. Dilating the "<= very dark" mask is the same as
+    # thresholding the eroded image, so no separate mask image is needed.
+    kernel = np.ones((params['dilate_size'], params['dilate_size']), np.uint8)
+    in_very_dark = cv2.erode(img, kernel) <= params['very_dark_threshold']
+    mid_lut = _mid_lut(params['mid_threshold'], params['bright_threshold'])
+    in_mid = cv2.dilate(cv2.LUT(img, mid_lut), kernel) > 0
+    
+    # Step 6: Apply all region boosts in a single table lookup
+    code = in_very_dark.view(np.uint8) << 1
+    code |= in_mid.view(np.uint8)
+    boost_lut = _boost_lut(params['bright_threshold'], params['very_dark_boost'], params['mid_boost'])
+    return boost_lut[code, img]
+
+def _stage_second_clahe(img, params):
+    # Step 7: Apply a second CLAHE pass with conservative settings
+    grid = params['tile_grid_size']
+    return _get_clahe(params['second_clip_limit'], (grid, grid)).apply(img)
+
+def _stage_stretch(img, params):
+    # Step 8: Apply contrast stretching between two percentiles
+    hist = cv2.calcHist([img], [0], None, [256], [0, 256])
+    cdf = np.cumsum(hist.ravel().astype(np.int64))
+    return cv2.LUT(img, _stretch_lut(cdf, params))
+
+def _stage_sharpen(img, params):
+    # Step 9: Apply moderate edge enhancement
+    amount = params['sharpen_amount']
+    blurred = cv2.GaussianBlur(img, (0, 0), params['blur_sigma'])
+    return cv2.addWeighted(img, 1 + amount, blurred, -amount, 0)
+
+def _stage_final_bilateral(img, params):
+    # Step 10: Apply a final bilateral filter to smooth the result while preserving edges
+    sigma = params['final_sigma']
+    return cv2.bilateralFilter(img, params['final_d'], sigma, sigma)
+
+# The enhancement as an ordered list of (name, function, parameter names).
+# Each function takes (image, params) and returns a new image; the output of
+# a stage depends only on its input and the listed parameters.
+ENHANCE_STAGES = [
+    ('normalize', _stage_normalize, ()),
+    ('clahe', _stage_clahe, ('clip_limit', 'tile_grid_size')),
+    ('gamma', _stage_gamma, ('gamma',)),
+    ('bilateral', _stage_bilateral, ('bilateral_d', 'bilateral_sigma')),
+    ('region_boost', _stage_region_boost, ('very_dark_threshold', 'mid_threshold', 'bright_threshold',
+                                           'dilate_size', 'very_dark_boost', 'mid_boost')),
+    ('second_clahe', _stage_second_clahe, ('second_clip_limit', 'tile_grid_size')),
+    ('stretch', _stage_stretch, ('low_percentile', 'high_percentile', 'stretch_max')),
+    ('sharpen', _stage_sharpen, ('blur_sigma', 'sharpen_amount')),
+    ('final_bilateral', _stage_final_bilateral, ('final_d', 'final_sigma')),
+]
+
+def enhance_array(img, params=None):
+    """
+    Enhance a single-channel uint8 image.
+    
+    This is the fast engine behind enhance_image: the point-wise steps run as
+    256-entry lookup tables, the region masks and boosts are fused into one
+    table lookup and the percentiles come from a histogram. With the default
+    parameters the output is pixel-identical to enhance_array_reference.
+    
+    Args:
+        img (np.ndarray): 2-D uint8 image
+        params (dict): Overrides for DEFAULT_PARAMS
+    
+    Returns:
+        np.ndarray: The enhanced image
+    """
+    params = enhancement_params(params)
+    with profile_step('enhance'):
+        for name, stage, _ in ENHANCE_STAGES:
+            with profile_step(f"enhance.{name}"):
+                img = stage(img, params)
+    return img
+
+def enhance_array_reference(img):
+    """
+    Original, step-by-step implementation of the enhancement.
+    
+    Kept as the ground truth that enhance_array is checked against
+    (see verify_enhance.py). Do not optimise this function.
+    """
     # Step 1: Apply initial contrast normalization
     normalized = cv2.normalize(img, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
     
@@ -33,7 +295,7 @@ def enhance_image(image_path, output_path=None):
     bright_mask = cv2.threshold(filtered, 180, 255, cv2.THRESH_BINARY)[1]
     
     # Create a mask for mid-tone regions
-    mid_mask = cv2.bitwise_xor(cv2.bitwise_or(moderately_dark_mask, bright_mask), 
+    mid_mask = cv2.bitwise_xor(cv2.bitwise_or(moderately_dark_mask, bright_mask),
                                np.ones_like(moderately_dark_mask) * 255)
     
     # Dilate the masks to include surrounding areas
@@ -80,20 +342,71 @@ def enhance_image(image_path, output_path=None):
     # Step 10: Apply a final bilateral filter to smooth the result while preserving edges
     final_enhanced = cv2.bilateralFilter(edge_enhanced, 5, 50, 50)
     
+    return final_enhanced
+
+def enhance_image(image_path, output_path=None, params=None):
+    # Read the image
+    img = read_image(image_path, grayscale=True)
+    if img is None:
+        raise ValueError(f"Could not read the image: {image_path}")
+    
+    final_enhanced = enhance_array(img, params)
+    
     # Save the result if output path is provided
     if output_path:
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        cv2.imwrite(str(output_path), final_enhanced)
+        write_image(output_path, final_enhanced)
     
     return final_enhanced
 
-def process_directory(input_dir, output_dir):
+# Version of the enhancement code, recorded in incremental-rebuild manifests
+ENHANCE_CODE_VERSION = code_version(__file__)
+
+def _read_file(task):
+    """Pipeline reader: decode the input of an (input, output, params) task"""
+    img = read_image(task[0], grayscale=True)
+    if img is None:
+        raise ValueError(f"Could not read the image: {task[0]}")
+    return img
+
+def _enhance_data(task, img):
+    """Pipeline compute stage: enhance a decoded image"""
+    return enhance_array(img, task[2])
+
+def _write_file(task, img):
+    """Pipeline writer: save the enhanced image of a task"""
+    os.makedirs(os.path.dirname(task[1]), exist_ok=True)
+    write_image(task[1], img)
+
+# Reader, compute and writer of (input, output, params) tasks, for io_pipeline.run_pipeline
+ENHANCE_FILE_STAGES = (_read_file, _enhance_data, _write_file)
+
+def _enhance_file(task):
+    """Worker task: enhance one (input, output, params) file pair"""
+    _write_file(task, _enhance_data(task, _read_file(task)))
+
+def process_directory(input_dir, output_dir, workers=1, opencv_threads=None, params=None, manifest=None,
+                      pipeline=None):
     """
     Process all images in the input directory and save enhanced versions to the output directory
+    
+    Args:
+        input_dir (str or Path): Directory containing the images
+        output_dir (str or Path): Directory to save the enhanced images
+        workers (int): Number of worker processes (0 = all cores)
+        opencv_threads (int): OpenCV threads per worker process
+        params (dict): Overrides for the enhancement parameters
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            images whose output is up to date are skipped
+        pipeline (dict or bool): Options of io_pipeline.run_pipeline (True
+            for the defaults); reads, enhances and writes in threads of this
+            process instead of using worker processes
     """
     # Convert string paths to Path objects
     input_path = Path(input_dir)
     output_path = Path(output_dir)
+    params = enhancement_params(params)
+    manifest, own_manifest = open_manifest(manifest)
     
     # Create output directory if it doesn't exist
     output_path.mkdir(parents=True, exist_ok=True)
@@ -105,31 +418,52 @@ def process_directory(input_dir, output_dir):
     processed = 0
     errors = 0
     
-    # Process all images in the directory
-    for img_file in input_path.iterdir():
+    # Output path maintains the same filename
+    tasks = []
+    for img_file in sorted(input_path.iterdir()):
         if img_file.suffix.lower() in image_extensions:
-            try:
-                # Create output path maintaining the same filename
-                output_file = output_path / img_file.name
-                
-                # Process the image
-                enhance_image(img_file, output_file)
-                processed += 1
-                print(f"Processed: {img_file.name}")
-            
-            except Exception as e:
-                errors += 1
-                print(f"Error processing {img_file.name}: {str(e)}")
+            output_file = output_path / img_file.name
+            if manifest is not None and manifest.is_up_to_date(output_file, [img_file], params, ENHANCE_CODE_VERSION):
+                continue
+            tasks.append((img_file, output_file, params))
+    
+    # Process all images in the directory
+    pipeline = pipeline_options(pipeline)
+    if pipeline is not None:
+        results = run_pipeline(*ENHANCE_FILE_STAGES, tasks, **pipeline)
+    else:
+        results = run_batch(_enhance_file, tasks, workers, opencv_threads=opencv_threads)
+    for (img_file, output_file, _), _, error in results:
+        if error is None:
+            processed += 1
+            print(f"Processed: {img_file.name}")
+            if manifest is not None:
+                manifest.record(output_file, 'enhance', [img_file], [output_file], params, ENHANCE_CODE_VERSION)
+        else:
+            errors += 1
+            print(f"Error processing {img_file.name}: {error}")
+    
+    if own_manifest:
+        manifest.close()
     
     return processed, errors
 
 if __name__ == "__main__":
-    # Example usage
-    input_dir = "./images"  # Replace with your input directory
-    output_dir = "enhanced_images"  # Replace with your output directory
+    parser = argparse.ArgumentParser(description="Enhance all images in a directory")
+    parser.add_argument('input_dir', nargs='?', default="./images")
+    parser.add_argument('output_dir', nargs='?', default="enhanced_images")
+    add_workers_argument(parser)
+    add_pipeline_arguments(parser)
+    add_params_argument(parser)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
     
     try:
-        processed, errors = process_directory(input_dir, output_dir)
+        with profiling(args.profile):
+            processed, errors = process_directory(args.input_dir, args.output_dir, args.workers,
+                                                  args.opencv_threads, parse_params(args.param), args.manifest,
+                                                  pipeline_from_args(args))
         print(f"\nProcessing complete!")
         print(f"Successfully processed: {processed} images")
         if errors > 0:
@@ -0,0 +1,383 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from image_io import read_image
+from process_labelme import create_mask, load_labelme_json, tile_positions
+from profiling import add_profile_argument, profile_step, profiling
+
+# Suffix stitch_predictions gives its outputs
+STITCHED_SUFFIX = "_stitched"
+
+# Regions every image is scored on: the whole image, the bands along the
+# tile seams and the rest
+REGIONS = ('all', 'seam', 'interior')
+
+def seam_lines(length, tile_size, overlap=0, band=16):
+    """
+    Mark the rows (or columns) within `band` pixels of a tile edge
+    
+    The tile edges are those of tile_positions, i.e. of the tiles the
+    predictions were made on; the image border is not a seam.
+    
+    Args:
+        length (int): Height (or width) of the image
+        tile_size (int): Tile size of the split
+        overlap (int): Overlap of the split
+        band (int): Half width of the seam band in pixels
+    
+    Returns:
+        np.ndarray: Boolean array of the given length
+    """
+    starts = sorted({x for x, _ in tile_positions(tile_size, length, tile_size, overlap)})
+    edges = {edge for x in starts for edge in (x, x + tile_size)} - {0, length}
+    marked = np.zeros(length, dtype=bool)
+    for edge in edges:
+        marked[max(0, edge - band):edge + band] = True
+    return marked
+
+# How single-channel predictions are read: probabilities (thresholded),
+# masks (non-zero is foreground) or label maps of class IDs; 'auto' decides
+# per image, see prediction_kind. (H, W, C) scores are always reduced by argmax.
+PREDICTION_KINDS = ('auto', 'prob', 'mask', 'labels')
+
+def prediction_kind(pred, num_classes, kind='auto', strip_rows=1024):
+    """
+    Resolve how a whole prediction is read
+    
+    With 'auto', (H, W, C) scores are 'scores', floats are probabilities
+    and integer maps whose values are all class IDs (below num_classes) are
+    label maps, e.g. the argmax map stitch_predictions writes for a
+    2-channel softmax. Other integer maps are 8-bit probabilities in binary
+    mode (a 0/255 mask thresholds the same) and label maps otherwise. The
+    maximum is taken over the whole image, one strip at a time, because a
+    dark strip of a probability map can look like a label map.
+    
+    Returns:
+        str: 'scores', 'prob', 'mask' or 'labels'
+    """
+    if pred.ndim == 3:
+        return 'scores'
+    if kind != 'auto':
+        return kind
+    if pred.dtype.kind == 'f':
+        return 'prob'
+    peak = max((int(np.max(pred[y:y + strip_rows])) for y in range(0, pred.shape[0], strip_rows)), default=0)
+    if peak < num_classes or num_classes > 2:
+        return 'labels'
+    return 'prob'
+
+def _prediction_classes(pred, kind, threshold):
+    """Class map of a prediction strip of a resolved kind (see prediction_kind)"""
+    if kind == 'scores':
+        return np.argmax(pred, axis=2).astype(np.uint8)
+    if kind == 'prob':
+        if threshold is None:
+            # stitch_predictions stores round(p * 255), so p >= 0.5 is 128 and up
+            threshold = 0.5 if pred.dtype.kind == 'f' else 128
+        # The same comparison as PredictionStitcher.result
+        return (pred >= threshold).view(np.uint8)
+    if kind == 'mask':
+        return (pred > 0).view(np.uint8)
+    return pred.astype(np.uint8, copy=False)
+
+def confusion_matrices(pred, truth, num_classes, seam_rows, seam_cols, threshold=None, strip_rows=1024,
+                       kind='auto'):
+    """
+    Confusion matrices of a prediction against the ground truth, inside and
+    outside the seam bands
+    
+    The image is scanned in strips of rows, and every strip is counted with
+    a single bincount over a combined (seam, truth, prediction) index, so
+    only one strip of indices exists at a time; the prediction may be a
+    memory-mapped .npy file.
+    
+    Args:
+        pred (np.ndarray): Probability map, mask, label map or (H, W, C) scores
+        truth (np.ndarray): (H, W) uint8 class IDs (binary: 0 or non-zero)
+        num_classes (int): Number of classes including the background
+        seam_rows (np.ndarray): Boolean seam flag of every row, see seam_lines
+        seam_cols (np.ndarray): Boolean seam flag of every column
+        threshold (float): Probability threshold of binary predictions
+        strip_rows (int): Rows per strip
+        kind (str): One of PREDICTION_KINDS, see prediction_kind
+    
+    Returns:
+        np.ndarray: (2, num_classes, num_classes) int64 counts, [interior,
+            seam][truth][prediction]
+    """
+    n = num_classes
+    counts = np.zeros(2 * n * n, dtype=np.int64)
+    with profile_step('evaluate.confusion'):
+        kind = prediction_kind(pred, n, kind, strip_rows)
+        for y in range(0, truth.shape[0], strip_rows):
+            gt = truth[y:y + strip_rows]
+            if n == 2:
+                gt = (gt > 0).view(np.uint8)
+            pr = _prediction_classes(np.asarray(pred[y:y + strip_rows]), kind, threshold)
+            seam = seam_rows[y:y + strip_rows, None] | seam_cols[None, :]
+            # IDs above the last class are counted as the last class
+            index = seam.astype(np.intp) * (n * n)
+            index += np.minimum(gt, n - 1).astype(np.intp) * n
+            index += np.minimum(pr, n - 1)
+            counts += np.bincount(index.ravel(), minlength=2 * n * n)
+    return counts.reshape(2, n, n)
+
+def confusion_metrics(confusion):
+    """
+    Pixel accuracy and per-class IoU and Dice of a confusion matrix
+    
+    Classes that are absent from both truth and prediction get None.
+    
+    Returns:
+        dict: pixels, accuracy, iou and dice lists, mean_iou and mean_dice
+            over the foreground classes
+    """
+    confusion = np.asarray(confusion, dtype=np.int64)
+    tp = np.diag(confusion)
+    fp = confusion.sum(axis=0) - tp
+    fn = confusion.sum(axis=1) - tp
+    total = int(confusion.sum())
+    iou = [int(t) / int(t + p + n) if t + p + n else None for t, p, n in zip(tp, fp, fn)]
+    dice = [2 * int(t) / int(2 * t + p + n) if t + p + n else None for t, p, n in zip(tp, fp, fn)]
+    foreground_iou = [v for v in iou[1:] if v is not None]
+    foreground_dice = [v for v in dice[1:] if v is not None]
+    return {
+        'pixels': total,
+        'accuracy': int(tp.sum()) / total if total else None,
+        'iou': iou,
+        'dice': dice,
+        'mean_iou': float(np.mean(foreground_iou)) if foreground_iou else None,
+        'mean_dice': float(np.mean(foreground_dice)) if foreground_dice else None,
+    }
+
+def _region_confusions(counts):
+    """Split [interior, seam] counts into the REGIONS"""
+    return {'all': counts[0] + counts[1], 'seam': counts[1], 'interior': counts[0]}
+
+def _load_prediction(path):
+    path = Path(path)
+    if path.suffix == '.npy':
+        # Read strip by strip from the page cache
+        return np.load(path, mmap_mode='r')
+    pred = read_image(path, grayscale=True)
+    if pred is None:
+        raise ValueError(f"Could not read prediction {path}")
+    return pred
+
+def evaluate_image(pred_path, json_path, label_ids=None, threshold=None, tile_size=512, overlap=0, seam_band=16,
+                   strip_rows=1024, kind='auto'):
+    """
+    Compare one stitched prediction with its LabelMe annotation
+    
+    Args:
+        pred_path (str or Path): Stitched prediction (.png probability map,
+            mask or label map, or .npy probabilities/scores)
+        json_path (str or Path): LabelMe annotation of the image
+        label_ids (dict): Class name -> ID for multi-class evaluation;
+            None compares binary masks
+        threshold (float): Probability threshold of binary predictions
+            (default 0.5 for .npy, 128 for 8-bit maps)
+        tile_size (int): Tile size the predictions were made on
+        overlap (int): Overlap of those tiles
+        seam_band (int): Half width in pixels of the band scored as seam
+        strip_rows (int): Rows per strip of the streaming pass
+        kind (str): How the prediction is read, one of PREDICTION_KINDS
+    
+    Returns:
+        np.ndarray: (2, C, C) confusion counts, see confusion_matrices
+    """
+    pred = _load_prediction(pred_path)
+    height, width = pred.shape[:2]
+    data = load_labelme_json(json_path)
+    if (data.get('imageHeight'), data.get('imageWidth')) not in ((None, None), (height, width)):
+        raise ValueError(f"Prediction is {height}x{width}, "
+                         f"annotation is {data['imageHeight']}x{data['imageWidth']}")
+    with profile_step('evaluate.mask'):
+        truth = create_mask(data['shapes'], (width, height), label_ids)
+    num_classes = len(label_ids) + 1 if label_ids else 2
+    seam_rows = seam_lines(height, tile_size, overlap, seam_band)
+    seam_cols = seam_lines(width, tile_size, overlap, seam_band)
+    return confusion_matrices(pred, truth, num_classes, seam_rows, seam_cols, threshold, strip_rows, kind)
+
+def _evaluate_task(task):
+    """Worker task: evaluate one (prediction, annotation) pair"""
+    _, pred_path, json_path, options = task
+    return evaluate_image(pred_path, json_path, **options)
+
+def find_pairs(pred_dir, annotation_dir):
+    """
+    Pair stitched predictions with annotations by image name
+    
+    "<name>_stitched.png" (or "<name>.png"/".npy") is paired with "<name>.json";
+    a .npy prediction is preferred over the PNG of the same image.
+    
+    Returns:
+        list: Sorted (name, prediction path, annotation path)
+    """
+    predictions = {}
+    for path in sorted(Path(pred_dir).iterdir()):
+        if path.suffix not in ('.png', '.npy'):
+            continue
+        name = path.stem
+        for suffix in (STITCHED_SUFFIX, "_prob"):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        if name not in predictions or path.suffix == '.npy':
+            predictions[name] = path
+    pairs = []
+    for name, pred_path in sorted(predictions.items()):
+        json_path = Path(annotation_dir) / f"{name}.json"
+        if json_path.exists():
+            pairs.append((name, pred_path, json_path))
+    return pairs
+
+def _fmt(value):
+    return "n/a" if value is None else f"{value:.4f}"
+
+def evaluate_predictions(pred_dir, annotation_dir, output_path=None, labels=None, threshold=None, tile_size=512,
+                         overlap=0, seam_band=16, strip_rows=1024, workers=1, kind='auto'):
+    """
+    Evaluate the stitched predictions against the annotations (step 4.4 of Plan.md)
+    
+    Images are evaluated in parallel; each returns only its small confusion
+    matrices, which are summed into the corpus totals.
+    
+    Args:
+        pred_dir (str or Path): Output directory of stitch_predictions
+        annotation_dir (str or Path): Directory of the LabelMe JSON files
+        output_path (str or Path): Optional JSON report
+        labels (list): Class names (ID i+1 for the i-th) for multi-class
+            evaluation; None compares binary masks
+        threshold (float): Probability threshold of binary predictions
+        tile_size (int): Tile size the predictions were made on
+        overlap (int): Overlap of those tiles
+        seam_band (int): Half width in pixels of the band scored as seam
+        strip_rows (int): Rows per strip of the streaming pass
+        workers (int): Number of worker processes (0 = all cores)
+        kind (str): How the predictions are read, one of PREDICTION_KINDS
+    
+    Returns:
+        dict: Report with the per-image and corpus metrics of every region,
+            the confusion matrices and the number of errors
+    """
+    label_ids = {label: i for i, label in enumerate(labels, 1)} if labels else None
+    classes = ['background'] + (list(labels) if labels else ['foreground'])
+    options = {'label_ids': label_ids, 'threshold': threshold, 'tile_size': tile_size, 'overlap': overlap,
+               'seam_band': seam_band, 'strip_rows': strip_rows, 'kind': kind}
+    pairs = find_pairs(pred_dir, annotation_dir)
+    print(f"Found {len(pairs)} predictions with annotations")
+    
+    report = {'classes': classes, 'seam_band': seam_band, 'tile_size': tile_size, 'overlap': overlap, 'images': {}}
+    total = np.zeros((2, len(classes), len(classes)), dtype=np.int64)
+    errors = 0
+    tasks = [(name, pred_path, json_path, options) for name, pred_path, json_path in pairs]
+    for (name, _, _, _), counts, error in run_batch(_evaluate_task, tasks, workers):
+        if error is not None:
+            errors += 1
+            print(f"Error evaluating {name}: {error}")
+            continue
+        total += counts
+        regions = _region_confusions(counts)
+        report['images'][name] = {region: confusion_metrics(regions[region]) for region in REGIONS}
+        report['images'][name]['confusion'] = regions['all'].tolist()
+        metrics = report['images'][name]['all']
+        print(f"{name}: accuracy={metrics['accuracy']:.4f} mean IoU={_fmt(metrics['mean_iou'])} "
+              f"mean Dice={_fmt(metrics['mean_dice'])}")
+    
+    regions = _region_confusions(total)
+    report['corpus'] = {region: confusion_metrics(regions[region]) for region in REGIONS}
+    report['corpus']['confusion'] = regions['all'].tolist()
+    per_image = [image['all']['mean_iou'] for image in report['images'].values()
+                 if image['all']['mean_iou'] is not None]
+    report['corpus']['mean_image_iou'] = float(np.mean(per_image)) if per_image else None
+    report['errors'] = errors
+    
+    for region in REGIONS:
+        metrics = report['corpus'][region]
+        if metrics['pixels']:
+            print(f"Corpus {region:8s}: accuracy={metrics['accuracy']:.4f} mean IoU={_fmt(metrics['mean_iou'])} "
+                  f"mean Dice={_fmt(metrics['mean_dice'])} ({metrics['pixels']} pixels)")
+    if output_path is not None:
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {output_path}")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    return report
+
+def check_prediction_kinds(strip_rows=64):
+    """
+    Check that perfect predictions of every kind stitch_predictions writes
+    score IoU 1, including a probability map whose first strips are dark
+    
+    Returns:
+        list: Names of the cases that do not
+    """
+    truth = np.zeros((256, 200), dtype=np.uint8)
+    truth[150:220, 30:90] = 1
+    truth[100:240, 120:180] = 2
+    binary = (truth > 0).view(np.uint8)
+    prob = np.where(binary > 0, 0.9, 0.002).astype(np.float32)
+    scores = np.stack([1 - prob, prob], axis=2)
+    cases = [
+        ('label map 0/1', binary, 2),
+        ('mask 0/255', binary * 255, 2),
+        ('8-bit probabilities', np.rint(prob * 255).astype(np.uint8), 2),
+        ('8-bit probabilities with dark strips', np.where(binary > 0, 200, 1).astype(np.uint8), 2),
+        ('float probabilities', prob, 2),
+        ('2-channel scores', scores, 2),
+        ('multi-class label map', truth, 3),
+    ]
+    seam_rows = np.zeros(truth.shape[0], dtype=bool)
+    seam_cols = np.zeros(truth.shape[1], dtype=bool)
+    failures = []
+    for name, pred, num_classes in cases:
+        gt = truth if num_classes > 2 else binary
+        counts = confusion_matrices(pred, gt, num_classes, seam_rows, seam_cols, strip_rows=strip_rows)
+        metrics = confusion_metrics(counts[0] + counts[1])
+        print(f"{name:38s} mean IoU={_fmt(metrics['mean_iou'])}")
+        if metrics['mean_iou'] != 1.0:
+            failures.append(name)
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate stitched predictions against the LabelMe annotations")
+    parser.add_argument('pred_dir', nargs='?', help="Directory of stitched predictions (output of stitch_predictions)")
+    parser.add_argument('annotation_dir', nargs='?', help="Directory of the LabelMe JSON files")
+    parser.add_argument('--output', default=None, help="Save the report as JSON")
+    parser.add_argument('--labels', default=None,
+                        help="Comma-separated class names for multi-class label maps (default: binary masks)")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="Probability threshold of binary predictions (default 0.5, or 128 for 8-bit maps)")
+    parser.add_argument('--prediction-kind', choices=PREDICTION_KINDS, default='auto',
+                        help="How single-channel predictions are read (default: auto, see prediction_kind)")
+    parser.add_argument('--tile-size', type=int, default=512, help="Tile size the predictions were made on")
+    parser.add_argument('--overlap', type=int, default=0, help="Overlap of those tiles")
+    parser.add_argument('--seam-band', type=int, default=16,
+                        help="Half width in pixels of the band along tile seams scored separately")
+    parser.add_argument('--strip-rows', type=int, default=1024, help="Rows per strip of the streaming pass")
+    add_workers_argument(parser, opencv_threads=False)
+    parser.add_argument('--check', action='store_true',
+                        help="Check that perfect predictions of every kind score IoU 1, then exit")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    if args.check:
+        failures = check_prediction_kinds()
+        if failures:
+            print(f"\n{len(failures)} case(s) do not score IoU 1")
+            sys.exit(1)
+        print("\nAll perfect predictions score IoU 1")
+        sys.exit(0)
+    if args.pred_dir is None or args.annotation_dir is None:
+        parser.error("pred_dir and annotation_dir are required")
+    
+    with profiling(args.profile):
+        evaluate_predictions(args.pred_dir, args.annotation_dir, args.output,
+                             args.labels.split(',') if args.labels else None, args.threshold, args.tile_size,
+                             args.overlap, args.seam_band, args.strip_rows, args.workers, args.prediction_kind)
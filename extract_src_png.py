@@ -1,63 +1,270 @@
+import argparse
+import json
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from image_io import EXTRACTED_LISTING
+from manifest import add_manifest_argument, code_version, open_manifest
 
-def extract_src_png(source_dir, output_dir, from_res=True, from_src=True):
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; reflinks are then never attempted
+    fcntl = None
+
+# Version of the extraction code, recorded in incremental-rebuild manifests
+EXTRACT_CODE_VERSION = code_version(__file__)
+
+# Default scan state file in the output directory
+STATE_NAME = ".extract_state.json"
+
+# Linux ioctl cloning a file's extents (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+LINK_METHODS = ('auto', 'hardlink', 'reflink', 'copy')
+
+def _list_dir(path):
+    """List one directory: (mtime_ns, sorted subdirectory names, whether it holds src.png)"""
+    # The mtime is read first, so a change during the listing is seen by the next scan
+    mtime_ns = os.stat(path).st_mtime_ns
+    subdirs = []
+    has_src_png = False
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.name == "src.png" and entry.is_file():
+                has_src_png = True
+    return mtime_ns, sorted(subdirs), has_src_png
+
+def scan_acquisitions(source_dir, from_res=True, from_src=True, state=None, threads=8):
+    """
+    Find the src.png files of 'res' and 'src' directories
+    
+    The tree is scanned breadth-first with os.scandir in a thread pool, so
+    directory listings on a network share overlap. A directory's mtime only
+    changes when entries are added, removed or renamed in it, so directories
+    whose mtime matches the saved state are not listed again: their
+    subdirectories and src.png flag come from the state and only a stat is
+    needed to descend.
+    
+    Args:
+        source_dir (str or Path): Root of the acquisition tree
+        from_res (bool): Include src.png of 'res' directories
+        from_src (bool): Include src.png of 'src' directories
+        state (dict): State returned by an earlier scan of the same tree
+        threads (int): Number of scanning threads
+    
+    Returns:
+        tuple: (sorted list of (src.png path, parent folder relative path,
+            'res' or 'src'), new state, number of directories listed)
+    """
+    source_path = Path(source_dir)
+    old_state = state or {}
+    new_state = {}
+    kinds = {name for name, wanted in (("res", from_res), ("src", from_src)) if wanted}
+    
+    def visit(rel):
+        path = source_path / rel
+        try:
+            cached = old_state.get(rel)
+            if cached is not None and os.stat(path).st_mtime_ns == cached['mtime_ns']:
+                return rel, cached, False
+            mtime_ns, subdirs, has_src_png = _list_dir(path)
+        except FileNotFoundError:
+            # Removed while scanning
+            return rel, None, False
+        return rel, {'mtime_ns': mtime_ns, 'subdirs': subdirs, 'src_png': has_src_png}, True
+    
+    found = []
+    listed = 0
+    level = [""]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        while level:
+            next_level = []
+            for rel, entry, was_listed in pool.map(visit, level):
+                if entry is None:
+                    continue
+                new_state[rel] = entry
+                listed += was_listed
+                name = rel.rsplit("/", 1)[-1]
+                if name in kinds and entry['src_png']:
+                    parent = rel.rsplit("/", 1)[0] if "/" in rel else ""
+                    found.append((source_path / rel / "src.png", parent, name))
+                next_level.extend(f"{rel}/{sub}" if rel else sub for sub in entry['subdirs'])
+            level = next_level
+    return sorted(found), new_state, listed
+
+def _reflink(src, dest):
+    """Clone src to dest sharing its data blocks, or raise OSError"""
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    shutil.copystat(src, dest)
+
+def link_or_copy(src, dest, method='auto'):
+    """
+    Place src at dest without copying its data where possible
+    
+    A destination that is already the same file, or has the same size and
+    mtime (every method keeps the mtime), is left alone. 'auto' tries a
+    hardlink, then a reflink, then a copy. Hardlinked files share their
+    content with the acquisition, so they must not be modified in place;
+    the pipeline only ever writes new files.
+    
+    Args:
+        src (Path): Source file
+        dest (Path): Destination file
+        method (str): 'auto', 'hardlink', 'reflink' or 'copy'
+    
+    Returns:
+        str: 'unchanged', 'hardlink', 'reflink' or 'copy'
+    """
+    src_stat = os.stat(src)
+    try:
+        dest_stat = os.stat(dest)
+        if ((dest_stat.st_dev, dest_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino) or
+                (dest_stat.st_size, dest_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)):
+            return 'unchanged'
+    except FileNotFoundError:
+        pass
+    
+    methods = ('hardlink', 'reflink', 'copy') if method == 'auto' else (method,)
+    tmp = dest.with_name(f".{dest.name}.tmp")
+    for i, current in enumerate(methods):
+        try:
+            if tmp.exists():
+                tmp.unlink()
+            if current == 'hardlink':
+                os.link(src, tmp)
+            elif current == 'reflink':
+                _reflink(src, tmp)
+            else:
+                shutil.copy2(src, tmp)
+            # Replace atomically, so readers never see a partial file
+            os.replace(tmp, dest)
+            return current
+        except OSError:
+            if i == len(methods) - 1:
+                raise
+    return None
+
+def extracted_name(parent, dir_type):
+    """File name of an extracted src.png: its parent folder path plus the directory type ('res' or 'src')"""
+    parent_folder = parent.replace('/', '_') or "root"
+    return f"{parent_folder}_{dir_type}_src.png"
+
+def _write_json(path, data):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def extract_src_png(source_dir, output_dir, from_res=True, from_src=True, manifest=None, threads=8, link='auto',
+                    state_file=None, full_scan=False):
     """
     Recursively extract all src.png files from the source directory
     and save them to the output directory with unique names based on their parent folder.
     
+    The tree is scanned incrementally (see scan_acquisitions) and files are
+    hardlinked or reflinked where possible (see link_or_copy). The output
+    directory gets a listing of the extracted files (image_io.EXTRACTED_LISTING)
+    that the downstream stages read instead of globbing the directory.
+    
     Args:
         source_dir (str): Source directory to search for src.png files
         output_dir (str): Directory to save the extracted src.png files
         from_res (bool): Whether to extract src.png from 'res' directories
         from_src (bool): Whether to extract src.png from 'src' directories
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            files whose copy is up to date are not copied again
+        threads (int): Number of threads scanning and linking
+        link (str): 'auto', 'hardlink', 'reflink' or 'copy'
+        state_file (str or Path): Scan state (default: STATE_NAME in the output directory)
+        full_scan (bool): Ignore the saved state and list every directory
+    
+    Returns:
+        int: Number of src.png files found
     """
     # Convert to Path objects
     source_path = Path(source_dir)
     output_path = Path(output_dir)
+    manifest, own_manifest = open_manifest(manifest)
     
     # Create output directory if it doesn't exist
     output_path.mkdir(parents=True, exist_ok=True)
     
-    # Counter for found files
-    found_count = 0
-    
-    # Walk through all subdirectories
-    for root, dirs, files in os.walk(source_path):
-        root_path = Path(root)
-        
-        # Check if this is a 'res' or 'src' directory
-        if (from_res and root_path.name == "res") or (from_src and root_path.name == "src"):
-            # Check if src.png exists in this directory
-            src_png_path = root_path / "src.png"
-            if src_png_path.exists():
-                # Get parent folder name for unique filename
-                parent_folder = root_path.parent.relative_to(source_path).as_posix().replace('/', '_')
-                if parent_folder == "":
-                    parent_folder = "root"
-                
-                # Create destination filename with directory type indicator
-                dir_type = root_path.name  # 'res' or 'src'
-                dest_filename = f"{parent_folder}_{dir_type}_src.png"
-                dest_path = output_path / dest_filename
-                
-                # Copy the file
-                shutil.copy2(src_png_path, dest_path)
-                found_count += 1
-                print(f"Extracted: {src_png_path} -> {dest_path}")
+    # The state is only valid for the tree it was made of
+    state_path = Path(state_file) if state_file is not None else output_path / STATE_NAME
+    state = None
+    if state_path.exists() and not full_scan:
+        with open(state_path) as f:
+            saved = json.load(f)
+        if saved.get('source') == str(source_path.resolve()):
+            state = saved['dirs']
+    
+    found, new_state, listed = scan_acquisitions(source_path, from_res, from_src, state, threads)
+    print(f"Scanned {len(new_state)} directories ({listed} listed, {len(new_state) - listed} unchanged)")
+    
+    jobs = []
+    for src_png_path, parent, dir_type in found:
+        dest_path = output_path / extracted_name(parent, dir_type)
+        if manifest is not None and manifest.is_up_to_date(dest_path, [src_png_path], None, EXTRACT_CODE_VERSION):
+            jobs.append((src_png_path, dest_path, None))
+            continue
+        jobs.append((src_png_path, dest_path, link))
+    
+    def place(job):
+        src_png_path, dest_path, method = job
+        return 'unchanged' if method is None else link_or_copy(src_png_path, dest_path, method)
     
+    counts = {}
+    files = []
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for (src_png_path, dest_path, method), used in zip(jobs, pool.map(place, jobs)):
+            counts[used] = counts.get(used, 0) + 1
+            files.append({'file': dest_path.name, 'source': str(src_png_path)})
+            if used != 'unchanged':
+                print(f"Extracted ({used}): {src_png_path} -> {dest_path}")
+            if manifest is not None and method is not None:
+                manifest.record(dest_path, 'extract', [src_png_path], [dest_path], None, EXTRACT_CODE_VERSION)
+    
+    if own_manifest:
+        manifest.close()
+    
+    # Save the listing for the downstream stages, then the scan state
+    _write_json(output_path / EXTRACTED_LISTING, {'source': str(source_path.resolve()), 'files': files})
+    _write_json(state_path, {'source': str(source_path.resolve()), 'dirs': new_state})
+    
+    found_count = len(found)
     print(f"\nExtraction complete! Found {found_count} src.png files.")
+    if counts.get('unchanged'):
+        print(f"Skipped {counts['unchanged']} up-to-date files.")
+    placed = ", ".join(f"{n} by {method}" for method, n in counts.items() if method != 'unchanged')
+    if placed:
+        print(f"Placed {placed}.")
     return found_count
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the src.png files of an acquisition tree")
     # Source directory containing the 20250220 folder
-    source_dir = "/Users/xiezhijie/GML/split_512/20250220"
-    
+    parser.add_argument('source_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/20250220")
     # Output directory for extracted src.png files
-    output_dir = "/Users/xiezhijie/GML/split_512/extracted_src_png"
+    parser.add_argument('output_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/extracted_src_png")
+    parser.add_argument('--no-res', action='store_true', help="Skip src.png in 'res' directories")
+    parser.add_argument('--no-src', action='store_true', help="Skip src.png in 'src' directories")
+    parser.add_argument('--threads', type=int, default=8, help="Scanning and linking threads (default 8)")
+    parser.add_argument('--link', choices=LINK_METHODS, default='auto',
+                        help="How to place files: hardlink, then reflink, then copy (auto, the default) "
+                             "or one method only")
+    parser.add_argument('--state', default=None, help=f"Scan state file (default: OUTPUT_DIR/{STATE_NAME})")
+    parser.add_argument('--full-scan', action='store_true', help="Ignore the saved scan state")
+    add_manifest_argument(parser)
+    args = parser.parse_args()
     
     # Extract all src.png files
-    # Set from_res=True to extract from 'res' directories
-    # Set from_src=True to extract from 'src' directories
-    extract_src_png(source_dir, output_dir, from_res=True, from_src=True)
+    extract_src_png(args.source_dir, args.output_dir, from_res=not args.no_res, from_src=not args.no_src,
+                    manifest=args.manifest, threads=args.threads, link=args.link, state_file=args.state,
+                    full_scan=args.full_scan)
@@ -0,0 +1,340 @@
+import json
+import os
+import struct
+import zlib
+from pathlib import Path
+import cv2
+import numpy as np
+from profiling import PROFILER, profile_step
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Last chunk of every PNG file (empty IEND chunk with its CRC)
+_PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+# File listing the images extract_src_png placed in its output directory
+EXTRACTED_LISTING = "extracted.json"
+# Channels read_image returns for each PNG colour type (alpha is dropped)
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 1, 6: 3}
+# Samples per pixel stored for each PNG colour type
+_PNG_SAMPLES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def list_images(input_dir, pattern="*.png"):
+    """
+    List the input images of a directory
+    
+    A directory written by extract_src_png carries a listing of the images
+    it extracted; it is used instead of globbing (which is slow on network
+    shares and also picks up stale files). Other directories are globbed.
+    
+    Args:
+        input_dir (str or Path): Directory of images
+        pattern (str): Glob pattern of the images
+    
+    Returns:
+        list: Sorted image paths
+    """
+    input_dir = Path(input_dir)
+    listing = input_dir / EXTRACTED_LISTING
+    if listing.exists():
+        with open(listing) as f:
+            names = [entry['file'] for entry in json.load(f)['files']]
+        return sorted(input_dir / name for name in names if Path(name).match(pattern))
+    return sorted(input_dir.glob(pattern))
+
+def is_gray_bgr(img):
+    """Return True if a 3-channel image has identical channels"""
+    return (img.ndim == 3 and img.shape[2] == 3
+            and np.array_equal(img[:, :, 0], img[:, :, 1])
+            and np.array_equal(img[:, :, 0], img[:, :, 2]))
+
+def read_image(path, grayscale=False):
+    """
+    Read an 8-bit image, keeping single-channel data single-channel
+    
+    Grayscale files are returned as 2-D arrays. Colour files whose three
+    channels are identical (grey images saved as RGB) are reduced to one
+    channel as well; real colour images stay BGR.
+    
+    Args:
+        path (str or Path): Image file
+        grayscale (bool): Always convert to a single channel
+    
+    Returns:
+        np.ndarray: The image, or None if it could not be read (like cv2.imread)
+    """
+    with profile_step('imread'):
+        if PROFILER.enabled and os.path.exists(path):
+            PROFILER.add_bytes(read=os.path.getsize(path))
+        if grayscale:
+            return cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+        img = cv2.imread(str(path), cv2.IMREAD_ANYCOLOR)
+        if img is not None and is_gray_bgr(img):
+            img = np.ascontiguousarray(img[:, :, 0])
+        return img
+
+def _png_header(path):
+    """(width, height, bit depth, colour type, interlace method) from the IHDR chunk, or None if not a PNG"""
+    with open(path, 'rb') as f:
+        head = f.read(29)
+    if len(head) < 29 or head[:8] != _PNG_SIGNATURE or head[12:16] != b'IHDR':
+        return None
+    width, height, depth, colour = struct.unpack('>IIBB', head[16:26])
+    return width, height, depth, colour, head[28]
+
+def read_png_size(path):
+    """
+    Read the size of a PNG file from its header, without decoding it
+    
+    Returns:
+        tuple: (height, width, channels) as read_image would return them
+            (colour files whose channels turn out identical still come back
+            single-channel), or None if the file is not a PNG
+    """
+    header = _png_header(path)
+    if header is None:
+        return None
+    width, height, _, colour, _ = header
+    return height, width, _PNG_CHANNELS.get(colour, 3)
+
+def png_complete(path):
+    """Return True if a PNG file has been written to the end (signature and IEND chunk present)"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            f.seek(0, os.SEEK_END)
+            if f.tell() < len(_PNG_SIGNATURE) + len(_PNG_END):
+                return False
+            f.seek(-len(_PNG_END), os.SEEK_END)
+            return head == _PNG_SIGNATURE and f.read() == _PNG_END
+    except OSError:
+        return False
+
+def _png_chunks(f, piece=1 << 20):
+    """
+    Yield the (type, data) chunks of a PNG file positioned after its signature, up to IEND
+    
+    IDAT chunks (encoders may write all pixel data as a single one) come in
+    pieces of at most `piece` bytes, as several consecutive IDAT items.
+    """
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            raise ValueError(f"Truncated PNG file {f.name}")
+        length, kind = struct.unpack('>I4s', head)
+        step = piece if kind == b'IDAT' else max(length, 1)
+        for offset in range(0, max(length, 1), step):
+            data = f.read(min(step, length - offset))
+            if len(data) < min(step, length - offset):
+                raise ValueError(f"Truncated PNG file {f.name}")
+            yield kind, data
+        f.read(4)
+        if kind == b'IEND':
+            return
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def _stored_png(head, data):
+    """
+    PNG file made of the chunks `head` and the filtered rows `data` stored
+    without compression, built in a single buffer (no intermediate copies)
+    """
+    blocks = -(-len(data) // 0xFFFF)
+    length = 2 + 5 * blocks + len(data) + 4
+    png = bytearray(len(head) + 8 + length + 4 + 12)
+    png[:len(head)] = head
+    pos = len(head)
+    png[pos:pos + 10] = struct.pack('>I', length) + b'IDAT' + b'\x78\x01'
+    start, pos = pos + 4, pos + 10
+    view = memoryview(data)
+    for offset in range(0, len(data), 0xFFFF):
+        chunk = view[offset:offset + 0xFFFF]
+        # Stored deflate block: final flag, LEN and NLEN, then the bytes
+        png[pos:pos + 5] = struct.pack('<BHH', offset + 0xFFFF >= len(data), len(chunk), len(chunk) ^ 0xFFFF)
+        png[pos + 5:pos + 5 + len(chunk)] = chunk
+        pos += 5 + len(chunk)
+    view.release()
+    png[pos:pos + 4] = struct.pack('>I', zlib.adler32(data))
+    with memoryview(png) as idat:
+        crc = zlib.crc32(idat[start:pos + 4])
+    png[pos + 4:pos + 8] = struct.pack('>I', crc)
+    png[pos + 8:] = _png_chunk(b'IEND', b'')
+    return png
+
+def _decode_png_strips(path, rows):
+    """
+    Decode an 8-bit non-interlaced PNG `rows` rows at a time, as IMREAD_UNCHANGED would
+    
+    The pixel data is inflated chunk by chunk. Each block is decoded by
+    OpenCV as a small PNG of its own, led by the unfiltered last row of the
+    previous block (which the filters of its first row refer to).
+    """
+    with open(path, 'rb') as f:
+        f.read(len(_PNG_SIGNATURE))
+        chunks = _png_chunks(f)
+        _, ihdr = next(chunks)
+        width, height, _, colour = struct.unpack('>IIBB', ihdr[:10])
+        samples = _PNG_SAMPLES[colour]
+        row_bytes = 1 + width * samples
+        # Chunks before the pixel data that OpenCV may need (gAMA, tRNS, ...)
+        header = []
+        inflate = zlib.decompressobj()
+        # Rows of the current block, after the unfiltered last row of the previous one (lead bytes)
+        pending = bytearray()
+        lead = 0
+        top = 0
+        for kind, data in chunks:
+            if kind != b'IDAT':
+                if top == 0 and not pending and kind != b'IEND':
+                    header.append(_png_chunk(kind, data))
+                continue
+            while True:
+                count = min(rows, height - top)
+                needed = lead + count * row_bytes
+                # Bounded output, so a highly compressed chunk never inflates to more than one block
+                pending += inflate.decompress(data, needed - len(pending))
+                data = inflate.unconsumed_tail
+                if len(pending) < needed:
+                    if not data:
+                        break
+                    continue
+                size = struct.pack('>II', width, count + bool(lead))
+                png = _stored_png(_PNG_SIGNATURE + _png_chunk(b'IHDR', size + ihdr[8:]) + b''.join(header), pending)
+                block = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+                del png
+                if block is None:
+                    raise ValueError(f"Could not decode rows {top}-{top + count} of {path}")
+                block = block[1:] if lead else block
+                last = block[-1].reshape(width, -1)
+                # OpenCV returns BGR(A); the filters work on the stored RGB(A) order
+                pending[:] = b'\x00' + (last[:, [2, 1, 0] + [3] * (samples == 4)] if samples > 2 else last).tobytes()
+                lead = row_bytes
+                top += count
+                yield block
+                if top == height:
+                    return
+    raise ValueError(f"Truncated PNG file {path}")
+
+def iter_image_strips(path, rows=1024, grayscale=False):
+    """
+    Read an image as consecutive blocks of rows, as read_image would return them
+    
+    8-bit grey, RGB and RGBA PNG files without interlacing are decoded one
+    block at a time, so only about one block is in memory however large
+    the image; colour files take a first pass to find out whether their
+    channels are identical. Other files (and colour files read as
+    grayscale) are read whole and sliced.
+    
+    Args:
+        path (str or Path): Image file
+        rows (int): Rows per block
+        grayscale (bool): Always convert to a single channel
+    
+    Yields:
+        np.ndarray: Blocks of `rows` rows (the last one may be shorter), top to bottom
+    """
+    header = _png_header(path)
+    if header is None or header[2] != 8 or header[3] not in (0, 2, 6) or header[4] or (grayscale and header[3]):
+        img = read_image(path, grayscale)
+        if img is None:
+            raise ValueError(f"Could not read image {path}")
+        for y in range(0, img.shape[0], rows):
+            yield img[y:y + rows]
+        return
+    
+    colour = header[3]
+    gray = colour == 0
+    if not gray:
+        with profile_step('imread'):
+            gray = all(is_gray_bgr(block[:, :, :3]) for block in _decode_png_strips(path, rows))
+    if PROFILER.enabled:
+        PROFILER.add_bytes(read=os.path.getsize(path))
+    blocks = _decode_png_strips(path, rows)
+    while True:
+        with profile_step('imread'):
+            block = next(blocks, None)
+            if block is not None and colour:
+                block = np.ascontiguousarray(block[:, :, 0] if gray else block[:, :, :3])
+        if block is None:
+            return
+        yield block
+
+class PngWriter:
+    """
+    Write a PNG file block by block, for images too large to hold whole
+    
+    Rows are Sub-filtered and deflated as they arrive, so only the current
+    block is in memory. 2-D blocks make a grey file, BGR blocks a colour one.
+    
+    Args:
+        path (str or Path): PNG file to write
+        height (int): Height of the image
+        width (int): Width of the image
+        channels (int): 1 or 3
+        compress_level (int): zlib level (1 like OpenCV's default)
+    """
+    def __init__(self, path, height, width, channels=1, compress_level=1):
+        self.path = Path(path)
+        self.height = height
+        self.width = width
+        self.channels = channels
+        self.rows = 0
+        self._deflate = zlib.compressobj(compress_level)
+        self._file = open(self.path, 'wb')
+        ihdr = struct.pack('>IIBBBBB', width, height, 8, 0 if channels == 1 else 2, 0, 0, 0)
+        self._file.write(_PNG_SIGNATURE + _png_chunk(b'IHDR', ihdr))
+    
+    def write(self, block):
+        """Append the next rows (a 2-D or BGR array of the image width)"""
+        with profile_step('imwrite'):
+            rows = block.reshape(block.shape[0], self.width, self.channels)
+            if self.channels == 3:
+                rows = rows[:, :, ::-1]
+            rows = rows.reshape(block.shape[0], -1)
+            filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+            filtered[:, 0] = 1
+            filtered[:, 1:self.channels + 1] = rows[:, :self.channels]
+            np.subtract(rows[:, self.channels:], rows[:, :-self.channels], out=filtered[:, self.channels + 1:])
+            data = self._deflate.compress(filtered.data)
+            if data:
+                self._file.write(_png_chunk(b'IDAT', data))
+            self.rows += block.shape[0]
+    
+    def close(self):
+        """Finish the file; raises ValueError if fewer rows than the height were written"""
+        if self._file.closed:
+            return
+        with profile_step('imwrite'):
+            self._file.write(_png_chunk(b'IDAT', self._deflate.flush()) + _png_chunk(b'IEND', b''))
+            self._file.close()
+        if PROFILER.enabled:
+            PROFILER.add_bytes(written=os.path.getsize(self.path))
+        if self.rows != self.height:
+            raise ValueError(f"{self.path}: wrote {self.rows} of {self.height} rows")
+    
+    def abort(self):
+        """Close the file and remove it, after an error"""
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+def write_image(path, img):
+    """Write an image; 2-D arrays are stored as single-channel files"""
+    with profile_step('imwrite'):
+        written = cv2.imwrite(str(path), img)
+        if PROFILER.enabled and written:
+            PROFILER.add_bytes(written=os.path.getsize(path))
+        return written
+
+def to_bgr(img):
+    """Return a 3-channel BGR copy of an image, for colour overlays"""
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img.copy()
@@ -0,0 +1,150 @@
+import queue
+import threading
+from batch_executor import _task_label
+from profiling import PROFILER
+
+# Default thread counts and queue depth of --pipeline
+DEFAULT_PIPELINE = {'readers': 2, 'compute_threads': 2, 'writers': 2, 'depth': 4}
+
+_DONE = object()
+
+def pipeline_options(pipeline=None):
+    """
+    Complete a pipeline option dict with the defaults
+
+    Args:
+        pipeline (dict or bool): Overrides of DEFAULT_PIPELINE, True for the
+            defaults, or None/False for no pipeline
+
+    Returns:
+        dict: The options, or None if no pipeline is wanted
+    """
+    if not pipeline:
+        return None
+    options = dict(DEFAULT_PIPELINE)
+    if isinstance(pipeline, dict):
+        unknown = set(pipeline) - set(DEFAULT_PIPELINE)
+        if unknown:
+            raise ValueError(f"Unknown pipeline options: {', '.join(sorted(unknown))}")
+        options.update(pipeline)
+    return options
+
+def _run_stage(func, inbox, outbox, stage, stop):
+    """Thread body: apply func to the items of inbox until the end marker"""
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            # The last thread of the stage passes the end on to the next stage
+            with stage['lock']:
+                stage['running'] -= 1
+                last = stage['running'] == 0
+            if last:
+                for _ in range(stage['downstream']):
+                    outbox.put(_DONE)
+            return
+        index, task, value, error = item
+        if error is None and not stop.is_set():
+            with PROFILER.image(_task_label(task)):
+                try:
+                    value = func(task, value)
+                except Exception as e:
+                    value, error = None, str(e) or repr(e)
+        outbox.put((index, task, value, error))
+
+def run_pipeline(read, compute, write, tasks, readers=2, compute_threads=2, writers=2, depth=4):
+    """
+    Run tasks through reader, compute and writer threads connected by bounded queues
+
+    OpenCV releases the GIL while decoding, filtering and encoding, so
+    threads let one file be read while another is enhanced and a third is
+    written, keeping the cores busy while I/O waits on (network) storage.
+    Each queue holds at most `depth` items and at most about
+    3 * depth + threads tasks are in flight, so memory stays bounded
+    however many tasks there are. Results are yielded in task order with
+    the same (task, result, error) contract as batch_executor.run_batch,
+    so drivers can use either. An exception in a stage is reported for
+    that task only, and its later stages are skipped.
+
+    Args:
+        read (callable): read(task) -> data, e.g. the decoded image
+        compute (callable): compute(task, data) -> data to write
+        write (callable): write(task, data) -> result of the task
+        tasks (list): Task arguments, one per unit of work
+        readers (int): Reader threads
+        compute_threads (int): Compute threads
+        writers (int): Writer threads
+        depth (int): Capacity of each queue between the stages
+
+    Yields:
+        tuple: (task, result, error) where error is None on success
+    """
+    tasks = list(tasks)
+    readers, compute_threads, writers = max(1, readers), max(1, compute_threads), max(1, writers)
+    depth = max(1, depth)
+    slots = threading.Semaphore(3 * depth + readers + compute_threads + writers)
+    stop = threading.Event()
+    inbox = queue.Queue(depth)
+    decoded = queue.Queue(depth)
+    computed = queue.Queue(depth)
+    done = queue.Queue()
+
+    def feed():
+        for index, task in enumerate(tasks):
+            # Backpressure: wait until an earlier task has been handed to the caller
+            slots.acquire()
+            if stop.is_set():
+                break
+            inbox.put((index, task, None, None))
+        for _ in range(readers):
+            inbox.put(_DONE)
+
+    stages = [
+        (lambda task, _: read(task), inbox, decoded, readers, compute_threads),
+        (compute, decoded, computed, compute_threads, writers),
+        (write, computed, done, writers, 1),
+    ]
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for func, stage_inbox, stage_outbox, count, downstream in stages:
+        stage = {'lock': threading.Lock(), 'running': count, 'downstream': downstream}
+        threads += [threading.Thread(target=_run_stage, args=(func, stage_inbox, stage_outbox, stage, stop),
+                                     daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+
+    # Yield in task order, holding back results that finish early
+    pending = {}
+    try:
+        for index in range(len(tasks)):
+            while index not in pending:
+                item = done.get()
+                if item is not _DONE:
+                    pending[item[0]] = item
+            _, task, result, error = pending.pop(index)
+            slots.release()
+            yield task, result, error
+    finally:
+        # Let the threads run out if the caller stops early
+        stop.set()
+        for _ in range(len(tasks)):
+            slots.release()
+
+def add_pipeline_arguments(parser):
+    """Add the shared --pipeline options to an argparse parser"""
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Overlap reading, processing and writing in threads (instead of --workers processes)")
+    parser.add_argument('--readers', type=int, default=DEFAULT_PIPELINE['readers'],
+                        help=f"Reader threads of --pipeline (default {DEFAULT_PIPELINE['readers']})")
+    parser.add_argument('--compute-threads', type=int, default=DEFAULT_PIPELINE['compute_threads'],
+                        help=f"Compute threads of --pipeline (default {DEFAULT_PIPELINE['compute_threads']})")
+    parser.add_argument('--writers', type=int, default=DEFAULT_PIPELINE['writers'],
+                        help=f"Writer threads of --pipeline (default {DEFAULT_PIPELINE['writers']})")
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_PIPELINE['depth'],
+                        help=f"Items per queue between the --pipeline stages (default {DEFAULT_PIPELINE['depth']})")
+    return parser
+
+def pipeline_from_args(args):
+    """Return the pipeline options selected on the command line, or None"""
+    if not args.pipeline:
+        return None
+    return {'readers': args.readers, 'compute_threads': args.compute_threads, 'writers': args.writers,
+            'depth': args.queue_depth}
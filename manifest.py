@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the SHA-1 hex digest of a file's content"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def code_version(*paths, depends=()):
+    """
+    Return a version string for the code of a stage: a digest of the source
+    files that implement it, so any edit to them invalidates its outputs.
+    
+    Args:
+        *paths (str or Path): Source files, usually module __file__ values
+        depends (tuple): Code versions of other stages this one builds on
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    for version in depends:
+        h.update(version.encode())
+    return h.hexdigest()[:16]
+
+def _canonical(params):
+    """Canonical JSON form of a parameter dict, used for comparisons"""
+    return json.dumps(params or {}, sort_keys=True, default=str)
+
+class Manifest:
+    """
+    Incremental-rebuild manifest stored as JSON lines
+    
+    Each line records one unit of work: its stage, the content hashes of
+    its inputs, its parameters, the code version and the hashes of the
+    files it produced. A later line for the same key replaces an earlier
+    one. A unit is up to date when all of these still match, so reruns can
+    skip it; changing a parameter or an input only invalidates the units
+    that used it.
+    
+    File hashes are cached by (size, mtime), so unchanged files are not
+    re-read on every run.
+    
+    Args:
+        path (str or Path): Manifest file, created if missing
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self._stat_cache = {}
+        self._lines = 0
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by an interrupted run
+                        continue
+                    self._lines += 1
+                    self.entries[entry['key']] = entry
+                    for files in (entry['inputs'], entry['outputs']):
+                        for file_path, (size, mtime_ns, digest) in files.items():
+                            self._stat_cache[file_path] = (size, mtime_ns, digest)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = None
+    
+    def _describe(self, path):
+        """Return (size, mtime_ns, hash) of a file, hashing only if it changed"""
+        path = str(path)
+        st = os.stat(path)
+        cached = self._stat_cache.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached
+        described = (st.st_size, st.st_mtime_ns, file_hash(path))
+        self._stat_cache[path] = described
+        return described
+    
+    def _describe_files(self, paths):
+        return {str(p): list(self._describe(p)) for p in paths}
+    
+    def is_up_to_date(self, key, inputs, params=None, version=None):
+        """
+        Check whether a unit of work can be skipped
+        
+        Args:
+            key (str): Unique name of the unit (usually its main output path)
+            inputs (list): Input file paths
+            params (dict): Parameters that affect the outputs
+            version (str): Code version of the stage
+        
+        Returns:
+            bool: True if inputs, parameters, code and outputs are unchanged
+        """
+        entry = self.entries.get(str(key))
+        if entry is None:
+            return False
+        if entry['params'] != _canonical(params) or entry['version'] != version:
+            return False
+        if sorted(entry['inputs']) != sorted(str(p) for p in inputs):
+            return False
+        try:
+            for file_path, (_, _, digest) in entry['inputs'].items():
+                if self._describe(file_path)[2] != digest:
+                    return False
+            for file_path, (_, _, digest) in entry['outputs'].items():
+                if self._describe(file_path)[2] != digest:
+                    return False
+        except OSError:
+            # An input or output is missing
+            return False
+        return True
+    
+    def record(self, key, stage, inputs, outputs, params=None, version=None):
+        """
+        Record a finished unit of work
+        
+        Args:
+            key (str): Unique name of the unit
+            stage (str): Pipeline stage ('extract', 'enhance', 'split', ...)
+            inputs (list): Input file paths
+            outputs (list): Output file paths produced by the unit
+            params (dict): Parameters that affect the outputs
+            version (str): Code version of the stage
+        """
+        entry = {
+            'key': str(key),
+            'stage': stage,
+            'inputs': self._describe_files(inputs),
+            'outputs': self._describe_files(outputs),
+            'params': _canonical(params),
+            'version': version,
+        }
+        self.entries[entry['key']] = entry
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        self._lines += 1
+    
+    def close(self):
+        """Close the manifest, compacting it if most lines are superseded"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lines > 2 * len(self.entries):
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
+            self._lines = len(self.entries)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def open_manifest(manifest):
+    """
+    Accept a Manifest, a manifest path or None
+    
+    Returns:
+        tuple: (Manifest or None, whether the caller owns it and must close it)
+    """
+    if manifest is None or isinstance(manifest, Manifest):
+        return manifest, False
+    return Manifest(manifest), True
+
+def add_manifest_argument(parser):
+    """Add the shared --manifest option to an argparse parser"""
+    parser.add_argument('--manifest', default=None,
+                        help="JSON-lines manifest for incremental rebuilds; up-to-date outputs are skipped")
+    return parser
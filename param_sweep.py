@@ -0,0 +1,241 @@
+import argparse
+import collections
+import itertools
+import json
+from pathlib import Path
+import cv2
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from enhance_image import DEFAULT_PARAMS, ENHANCE_STAGES, enhancement_params
+from image_io import list_images, read_image, write_image
+from profiling import add_profile_argument, profile_step, profiling
+
+# Intermediate images kept per image while sweeping
+DEFAULT_CACHE_BYTES = 1 << 30
+
+def _first_stage(name):
+    """Index of the first enhancement stage reading parameter `name`"""
+    for index, (_, _, names) in enumerate(ENHANCE_STAGES):
+        if name in names:
+            return index
+    raise ValueError(f"Unknown enhancement parameter: {name}")
+
+def parse_grid(specs):
+    """
+    Parse NAME=V1,V2,... strings into a parameter grid, converting each value
+    to the type of its default
+    """
+    grid = {}
+    for spec in specs or []:
+        name, sep, values = spec.partition('=')
+        if not sep or name not in DEFAULT_PARAMS:
+            raise ValueError(f"Invalid sweep parameter: {spec}")
+        grid[name] = [type(DEFAULT_PARAMS[name])(value) for value in values.split(',')]
+    return grid
+
+def sweep_variants(grid):
+    """
+    Expand a parameter grid into the list of parameter overrides to try
+    
+    The parameters of early stages vary slowest, so consecutive variants
+    share the longest possible stage prefix and the prefix cache only needs
+    about one image per stage.
+    
+    Args:
+        grid (dict): Parameter name -> list of values
+    
+    Returns:
+        list: One dict of overrides per variant
+    """
+    names = sorted(grid, key=lambda name: (_first_stage(name), name))
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+class StageCache:
+    """
+    LRU cache of intermediate images keyed by the stage prefix that made them
+    
+    A key lists every stage run so far with the values of its parameters,
+    so two variants that only differ in later stages share their entries.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.computed = 0
+    
+    def get(self, key):
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+    
+    def put(self, key, image):
+        if key in self._entries or image.nbytes > self.max_bytes:
+            return
+        self._entries[key] = image
+        self._bytes += image.nbytes
+        while self._bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old.nbytes
+
+def _prefix_keys(params):
+    """Cache key of the output of every stage for a complete parameter set"""
+    keys = []
+    key = ()
+    for name, _, names in ENHANCE_STAGES:
+        key += ((name,) + tuple(params[p] for p in names),)
+        keys.append(key)
+    return keys
+
+def enhance_cached(img, params, cache):
+    """
+    Enhance an image like enhance_array, reusing the longest stage prefix
+    already in the cache and caching the intermediate images it computes
+    
+    Args:
+        img (np.ndarray): 2-D uint8 image
+        params (dict): Overrides for DEFAULT_PARAMS
+        cache (StageCache): Cache of intermediates of this image
+    
+    Returns:
+        np.ndarray: The enhanced image
+    """
+    params = enhancement_params(params)
+    keys = _prefix_keys(params)
+    start = 0
+    for index in range(len(keys) - 1, -1, -1):
+        cached = cache.get(keys[index])
+        if cached is not None:
+            img, start = cached, index + 1
+            cache.hits += index + 1
+            break
+    with profile_step('enhance'):
+        for index in range(start, len(ENHANCE_STAGES)):
+            name, stage, _ = ENHANCE_STAGES[index]
+            with profile_step(f"enhance.{name}"):
+                img = stage(img, params)
+            cache.computed += 1
+            # The final image is only cached for a repeated variant's sake, which the grid never has
+            if index < len(ENHANCE_STAGES) - 1:
+                cache.put(keys[index], img)
+    return img
+
+def image_metrics(img):
+    """
+    Summary metrics of an enhanced image
+    
+    Returns:
+        dict: mean brightness, fraction of pixels clipped to 0 or 255, and
+            RMS contrast (standard deviation of the grey levels)
+    """
+    mean, std = cv2.meanStdDev(img)
+    hist = cv2.calcHist([img], [0], None, [256], [0, 256]).ravel()
+    return {
+        'mean': float(mean[0, 0]),
+        'clipped': float((hist[0] + hist[255]) / img.size),
+        'contrast': float(std[0, 0]),
+    }
+
+def _sweep_task(task):
+    """Worker task: run every variant on one image"""
+    image_path, variants, cache_bytes, save_dir = task
+    img = read_image(image_path, grayscale=True)
+    if img is None:
+        raise ValueError(f"Could not read image {image_path}")
+    cache = StageCache(cache_bytes)
+    metrics = []
+    for index, variant in enumerate(variants):
+        output = enhance_cached(img, variant, cache)
+        metrics.append(image_metrics(output))
+        if save_dir is not None:
+            variant_dir = Path(save_dir) / f"variant_{index:03d}"
+            variant_dir.mkdir(parents=True, exist_ok=True)
+            write_image(variant_dir / f"{Path(image_path).stem}.png", output)
+    return metrics, cache.computed, cache.hits
+
+def run_sweep(inputs, grid, output_dir=None, save_images=False, cache_bytes=DEFAULT_CACHE_BYTES, workers=1,
+              opencv_threads=None):
+    """
+    Run the enhancement with every combination of a parameter grid
+    
+    Each image is read once and its variants run in stage-prefix order;
+    stages whose input and parameters were already seen (for example
+    normalize + CLAHE(8) across all gamma values) come from a per-image
+    LRU cache of intermediates instead of being computed again.
+    
+    Args:
+        inputs (list): Image files and/or directories of images
+        grid (dict): Parameter name -> list of values, see parse_grid
+        output_dir (str or Path): Where sweep.json (and the images) are written
+        save_images (bool): Also write every variant as
+            output_dir/variant_NNN/<image>.png
+        cache_bytes (int): Largest total size of cached intermediates per image
+        workers (int): Number of worker processes (0 = all cores)
+        opencv_threads (int): Threads OpenCV may use inside each worker
+    
+    Returns:
+        list: One dict per variant with its parameters, the metrics of each
+            image and their means
+    """
+    variants = sweep_variants(grid)
+    image_paths = []
+    for item in map(Path, inputs):
+        image_paths += list_images(item) if item.is_dir() else [item]
+    save_dir = output_dir if save_images else None
+    if save_images and output_dir is None:
+        raise ValueError("save_images needs an output directory")
+    
+    results = [{'variant': index, 'params': variant, 'images': {}} for index, variant in enumerate(variants)]
+    computed = hits = errors = 0
+    tasks = [(path, variants, cache_bytes, save_dir) for path in image_paths]
+    for task, result, error in run_batch(_sweep_task, tasks, workers, opencv_threads=opencv_threads):
+        if error is not None:
+            errors += 1
+            print(f"Error sweeping {task[0]}: {error}")
+            continue
+        metrics, image_computed, image_hits = result
+        computed += image_computed
+        hits += image_hits
+        for entry, image_metric in zip(results, metrics):
+            entry['images'][Path(task[0]).name] = image_metric
+    
+    for entry in results:
+        values = list(entry['images'].values())
+        entry['mean'] = {name: float(np.mean([v[name] for v in values])) if values else None
+                         for name in ('mean', 'clipped', 'contrast')}
+    
+    full_runs = computed + hits
+    if full_runs:
+        print(f"{len(variants)} variants x {len(image_paths) - errors} images: computed {computed} of "
+              f"{full_runs} stages ({computed / full_runs:.0%} of the full runs)")
+    if output_dir is not None:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with open(output_dir / 'sweep.json', 'w') as f:
+            json.dump({'grid': grid, 'variants': results}, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep enhancement parameters, sharing stage prefixes "
+                                                 "between variants")
+    parser.add_argument('inputs', nargs='+', help="Image files or directories of images")
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=V1,V2,...',
+                        help=f"Values to try for one parameter (repeatable), one of: {', '.join(DEFAULT_PARAMS)}")
+    parser.add_argument('--output-dir', default="sweep", help="Directory for sweep.json (default 'sweep')")
+    parser.add_argument('--save-images', action='store_true', help="Also save every variant of every image")
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES,
+                        help="Largest total size of cached intermediate images per image")
+    add_workers_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    with profiling(args.profile):
+        results = run_sweep(args.inputs, parse_grid(args.grid), args.output_dir, args.save_images,
+                            args.cache_bytes, args.workers, args.opencv_threads)
+    for entry in results:
+        params = ", ".join(f"{name}={value}" for name, value in entry['params'].items()) or "defaults"
+        mean = entry['mean']
+        if mean['mean'] is not None:
+            print(f"{entry['variant']:3d}  mean={mean['mean']:6.1f}  clipped={mean['clipped']:6.2%}  "
+                  f"contrast={mean['contrast']:5.1f}  {params}")
@@ -1,9 +1,18 @@
+import argparse
 import json
 import numpy as np
-from PIL import Image, ImageDraw
 import os
 from pathlib import Path
 import cv2
+from batch_executor import add_workers_argument, run_batch
+from manifest import add_manifest_argument, code_version, open_manifest
+from image_io import PngWriter, iter_image_strips, read_image, read_png_size, write_image, to_bgr
+from tile_store import TileStore, TILE_STORE_SUFFIX
+from profiling import add_profile_argument, profile_step, profiling
+from pyramid import PyramidWriter, write_pyramid
+
+# 代码版本, 记录在增量构建清单中
+LABELME_CODE_VERSION = code_version(__file__)
 
 def load_labelme_json(json_path):
     """加载LabelMe的JSON文件"""
@@ -11,24 +20,109 @@ def load_labelme_json(json_path):
         data = json.load(f)
     return data
 
-def create_mask(shapes, img_size):
-    """根据标注创建mask"""
-    mask = Image.new('L', img_size, 0)
-    draw = ImageDraw.Draw(mask)
+# 亚像素精度: 坐标乘以2**_SHIFT取整后交给cv2的shift参数
+_SHIFT = 4
+# 线段标注的cv2线宽: 2画出约3像素宽的线, 与原PIL width=3的效果一致
+LINE_WIDTH = 2
+
+def _shape_value(shape, label_ids):
+    """形状在mask中的取值: 二值mask为255, 多类别时为label_ids中的类别ID (未列出的类别返回None)"""
+    if label_ids is None:
+        return 255
+    return label_ids.get(shape.get('label'))
+
+def _drawable(shape):
+    return shape['shape_type'] in ('polygon', 'linestrip') and len(shape['points']) > 0
+
+# mask按图像坐标中固定的_MASK_ROWS行一块栅格化. cv2会把超出画布的边裁剪后再画(fillPoly的填充边界也按
+# 裁剪后的端点计算), 画布不同结果就不同; 固定分块后整张mask与任意条带的结果完全相同
+_MASK_ROWS = 512
+
+def _draw_shapes(mask, shapes, label_ids, line_width, top):
+    """把形状画到mask上, mask为整张mask从第top行开始的一块. 后面的形状覆盖前面的形状"""
+    strips = []
+    strip_value = None
+    
+    def draw_strips():
+        if strips:
+            cv2.polylines(mask, strips, False, strip_value, thickness=line_width, lineType=cv2.LINE_8,
+                          shift=_SHIFT)
+            strips.clear()
     
     for shape in shapes:
-        points = shape['points']
+        value = _shape_value(shape, label_ids)
+        points = np.rint(np.asarray(shape['points'], dtype=np.float64) * (1 << _SHIFT)).astype(np.int32)
+        # 在定点坐标上整数平移, 不引入舍入误差
+        points[:, 1] -= top << _SHIFT
+        points = points.reshape(-1, 1, 2)
         if shape['shape_type'] == 'polygon':
             # 处理多边形标注
-            draw.polygon([tuple(map(int, p)) for p in points], fill=255)
-        elif shape['shape_type'] == 'linestrip':
+            draw_strips()
+            cv2.fillPoly(mask, [points], value, lineType=cv2.LINE_8, shift=_SHIFT)
+        else:
             # 处理线段标注
-            for i in range(len(points)-1):
-                p1 = tuple(map(int, points[i]))
-                p2 = tuple(map(int, points[i+1]))
-                draw.line([p1, p2], fill=255, width=3)
-    
-    return np.array(mask)
+            if value != strip_value:
+                draw_strips()
+                strip_value = value
+            strips.append(points)
+    draw_strips()
+
+def rasterize_shapes(shapes, height, width, label_ids=None, line_width=LINE_WIDTH, rows=None):
+    """
+    用cv2批量栅格化标注, 坐标保留亚像素精度
+    多边形逐个用fillPoly填充(同一次调用中重叠的多边形会被当作孔洞);
+    连续的同类别线段标注合并为一次polylines调用. 后面的形状覆盖前面的形状
+    每_MASK_ROWS行一块, 只画与该块相交的形状. rows=(y0, y1)时只返回第y0到y1行(条带),
+    结果与整张mask的对应行相同, 临时内存不超过一块, 与标注形状无关
+    """
+    y0, y1 = rows or (0, height)
+    mask = np.zeros((y1 - y0, width), dtype=np.uint8)
+    drawn = [shape for shape in shapes if _drawable(shape) and _shape_value(shape, label_ids) is not None]
+    bounds = shape_bounds(drawn, label_ids, line_width)
+    for top in range(y0 - y0 % _MASK_ROWS, y1, _MASK_ROWS):
+        bottom = min(top + _MASK_ROWS, height)
+        hits = [shape for shape, (_, low, _, high) in zip(drawn, bounds) if low < bottom and high >= top]
+        if not hits:
+            continue
+        if y0 <= top and bottom <= y1:
+            # 整块都在结果中, 直接画在结果上
+            _draw_shapes(mask[top - y0:bottom - y0], hits, label_ids, line_width, top)
+        else:
+            block = np.zeros((bottom - top, width), dtype=np.uint8)
+            _draw_shapes(block, hits, label_ids, line_width, top)
+            start, end = max(top, y0), min(bottom, y1)
+            mask[start - y0:end - y0] = block[start - top:end - top]
+    return mask
+
+def create_mask(shapes, img_size, label_ids=None):
+    """根据标注创建mask, img_size为(宽, 高); 给出label_ids(类别名->ID)时生成多类别mask"""
+    return rasterize_shapes(shapes, img_size[1], img_size[0], label_ids)
+
+def shape_bounds(shapes, label_ids=None, line_width=LINE_WIDTH):
+    """返回会画进mask的形状的包围盒数组 (x0, y0, x1, y1), 含线宽余量"""
+    margin = line_width / 2 + 1
+    bounds = [np.concatenate([np.min(shape['points'], axis=0) - margin, np.max(shape['points'], axis=0) + margin])
+              for shape in shapes if _drawable(shape) and _shape_value(shape, label_ids) is not None]
+    return np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+def tiles_touching(bounds, positions, tile_size):
+    """空间索引: 返回每个图像块是否与某个形状包围盒相交, 不相交的块一定没有标注"""
+    if len(positions) == 0 or len(bounds) == 0:
+        return np.zeros(len(positions), dtype=bool)
+    tiles = np.asarray(positions, dtype=np.float64)
+    x0, y0 = tiles[:, 0:1], tiles[:, 1:2]
+    hits = ((bounds[None, :, 0] < x0 + tile_size) & (bounds[None, :, 2] >= x0) &
+            (bounds[None, :, 1] < y0 + tile_size) & (bounds[None, :, 3] >= y0))
+    return hits.any(axis=1)
+
+def annotation_overlay(image, mask):
+    """在原图上叠加红色标注, 返回(叠加图, 黑底标注图); 逐像素计算, 也可以对条带调用"""
+    # 只有可视化使用彩色
+    overlay = to_bgr(image)
+    mask_rgb = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+    mask_rgb[mask > 0] = [0, 0, 255]  # 红色标注
+    cv2.addWeighted(mask_rgb, 0.5, overlay, 0.5, 0, overlay)
+    return overlay, mask_rgb
 
 def visualize_annotation(image, mask, output_dir):
     """可视化标注效果"""
@@ -37,64 +131,203 @@ def visualize_annotation(image, mask, output_dir):
     output_dir.mkdir(parents=True, exist_ok=True)
     
     # 在原图上显示标注
-    overlay = image.copy()
-    mask_rgb = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
-    mask_rgb[mask > 0] = [0, 0, 255]  # 红色标注
-    cv2.addWeighted(mask_rgb, 0.5, overlay, 0.5, 0, overlay)
+    overlay, mask_rgb = annotation_overlay(image, mask)
     
     # 保存结果
     image_name = Path(output_dir) / "annotation_on_image.png"
     blank_name = Path(output_dir) / "annotation_on_blank.png"
     
-    cv2.imwrite(str(image_name), overlay)
-    cv2.imwrite(str(blank_name), mask_rgb)
+    write_image(image_name, overlay)
+    write_image(blank_name, mask_rgb)
     
     return overlay, mask_rgb
 
-def split_image_and_mask(image, mask, tile_size=512, overlap=0):
-    """将图像和mask切分成小块"""
+def visualize_annotation_pyramid(image, mask, output_dir, strip_rows=1024):
+    """
+    可视化标注效果, 写成Deep Zoom金字塔(annotation_on_image.dzi, annotation_on_blank.dzi)
+    叠加图按条带生成并直接写入金字塔, 不生成全分辨率的彩色图像; 返回两个.dzi文件
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
     h, w = image.shape[:2]
-    tiles_img = []
-    tiles_mask = []
+    paths = []
+    for index, name in enumerate(("annotation_on_image.dzi", "annotation_on_blank.dzi")):
+        strips = (annotation_overlay(image[y:y + strip_rows], mask[y:y + strip_rows])[index]
+                  for y in range(0, h, strip_rows))
+        paths.append(write_pyramid(strips, h, w, output_dir / name))
+    return paths
+
+def tile_positions(height, width, tile_size=512, overlap=0):
+    """
+    切块的左上角坐标(x, y), 与split_image_and_mask一致:
+    边缘的块向内平移以保持大小一致, 小于tile_size的图像没有块
+    """
     positions = []
-    
-    for y in range(0, h-overlap, tile_size-overlap):
-        for x in range(0, w-overlap, tile_size-overlap):
-            x1 = x
-            y1 = y
-            x2 = min(x + tile_size, w)
-            y2 = min(y + tile_size, h)
+    for y in range(0, height-overlap, tile_size-overlap):
+        for x in range(0, width-overlap, tile_size-overlap):
+            x2 = min(x + tile_size, width)
+            y2 = min(y + tile_size, height)
             
             # 如果是图像边缘的小块，调整起始位置确保大小一致
-            if x2 - x1 < tile_size:
-                x1 = max(0, x2 - tile_size)
-            if y2 - y1 < tile_size:
-                y1 = max(0, y2 - tile_size)
-            
-            tile_img = image[y1:y2, x1:x2]
-            tile_mask = mask[y1:y2, x1:x2]
+            x1 = max(0, x2 - tile_size) if x2 - x < tile_size else x
+            y1 = max(0, y2 - tile_size) if y2 - y < tile_size else y
             
             # 确保所有切片大小一致
-            if tile_img.shape[:2] == (tile_size, tile_size):
-                tiles_img.append(tile_img)
-                tiles_mask.append(tile_mask)
+            if (y2 - y1, x2 - x1) == (tile_size, tile_size):
                 positions.append((x1, y1))
-    
+    return positions
+
+def split_image_and_mask(image, mask, tile_size=512, overlap=0):
+    """将图像和mask切分成小块"""
+    positions = tile_positions(image.shape[0], image.shape[1], tile_size, overlap)
+    tiles_img = [image[y:y+tile_size, x:x+tile_size] for x, y in positions]
+    tiles_mask = [mask[y:y+tile_size, x:x+tile_size] for x, y in positions]
     return tiles_img, tiles_mask, positions
 
-def process_labelme_annotation(image_path, json_path, output_dir, tile_size=512):
-    """处理单个LabelMe标注文件"""
+def annotated_tiles(image, mask, shapes, tile_size=512, label_ids=None):
+    """
+    切分图像和mask, 返回[(图像块, mask块, (x, y), 是否含标注)]
+    空间索引: 与所有形状包围盒都不相交的块直接判为无标注, 不再扫描其mask
+    """
+    with profile_step('split'):
+        tiles_img, tiles_mask, positions = split_image_and_mask(image, mask, tile_size)
+    candidates = tiles_touching(shape_bounds(shapes, label_ids), positions, tile_size)
+    return [(tile_img, tile_mask, pos, bool(candidate and tile_mask.any()))
+            for tile_img, tile_mask, pos, candidate in zip(tiles_img, tiles_mask, positions, candidates)]
+
+def annotation_strips(image_path, shapes, height, rows=512, label_ids=None, line_width=LINE_WIDTH):
+    """
+    按条带生成(起始行y, 图像条带, mask条带), 每个条带rows行(最后一个可能更少)
+    图像按条带解码, mask条带由rasterize_shapes按固定分块画出, 与整张mask的对应行相同
+    """
+    y = 0
+    for band in iter_image_strips(image_path, rows):
+        end = y + len(band)
+        with profile_step('labelme.mask'):
+            mask = rasterize_shapes(shapes, height, band.shape[1], label_ids, line_width, (y, end))
+        yield y, band, mask
+        y = end
+
+# 条带模式下每次生成的叠加图行数
+_OVERLAY_ROWS = 64
+
+def process_annotation_strips(image_path, json_path, output_dir, tile_size=512, tile_format='png', label_ids=None,
+                              visualization='full'):
+    """
+    process_labelme_annotation的条带模式, 写出相同的文件, 返回写出的文件列表
+    每次只处理tile_size行的一个条带: 图像按条带解码, mask只画条带所在的块(annotation_strips),
+    图像块和可视化结果(PNG或金字塔)随条带写出. 同时只保留当前和上一个条带,
+    峰值内存约为 宽 x tile_size 的若干倍, 与图像高度无关
+    """
+    size = read_png_size(image_path)
+    if size is None:
+        raise ValueError(f"条带模式只支持PNG图像: {image_path}")
+    height, width = size[:2]
+    data = load_labelme_json(json_path)
+    base_name = Path(image_path).stem
+    output_dir = Path(output_dir)
+    vis_dir = output_dir / 'visualization' / base_name
+    vis_dir.mkdir(parents=True, exist_ok=True)
+    
+    # 每个块行的起始y -> 该行的块, 顺序与整图模式相同
+    positions = tile_positions(height, width, tile_size)
+    bounds = shape_bounds(data['shapes'], label_ids)
+    tile_rows = {}
+    for pos in positions:
+        tile_rows.setdefault(pos[1], []).append(pos)
+    
+    # 可视化结果(PNG或金字塔)逐条带追加写出
+    pyramid = visualization == 'pyramid'
+    suffix = ".dzi" if pyramid else ".png"
+    outputs = [vis_dir / f"annotation_on_image{suffix}", vis_dir / f"annotation_on_blank{suffix}"]
+    store_paths = []
+    if tile_format == 'store':
+        store_paths = [output_dir / 'images' / f"{base_name}{TILE_STORE_SUFFIX}",
+                       output_dir / 'masks' / f"{base_name}{TILE_STORE_SUFFIX}"]
+    writers, stores = [], []
+    failed = True
     try:
-        # 加载图像和标注
-        image = cv2.imread(str(image_path))
+        for path in outputs:
+            writers.append(PyramidWriter(height, width, path) if pyramid else PngWriter(path, height, width, 3))
+        appends = [writer.push if pyramid else writer.write for writer in writers]
+        for path in store_paths:
+            stores.append(TileStore(path, 'w'))
+            stores[-1].set_image_size(base_name, height, width)
+        
+        previous = None
+        for y, band, mask in annotation_strips(image_path, data['shapes'], height, tile_size, label_ids):
+            # 彩色叠加图分小块生成和写出, 临时内存只有几十行
+            for start in range(0, len(band), _OVERLAY_ROWS):
+                overlays = annotation_overlay(band[start:start + _OVERLAY_ROWS], mask[start:start + _OVERLAY_ROWS])
+                for append, rows in zip(appends, overlays):
+                    append(rows)
+            
+            # 条带内的块行; 最后一行块向上平移时跨越上一个条带
+            for row_y in sorted(row_y for row_y in tile_rows if y - tile_size < row_y <= y + len(band) - tile_size):
+                if row_y < y:
+                    skip = row_y - previous[0]
+                    image_rows = np.concatenate([previous[1][skip:], band])
+                    mask_rows = np.concatenate([previous[2][skip:], mask])
+                else:
+                    image_rows, mask_rows = band[row_y - y:], mask[row_y - y:]
+                row = tile_rows[row_y]
+                for (x, _), candidate in zip(row, tiles_touching(bounds, row, tile_size)):
+                    tile_mask = mask_rows[:tile_size, x:x + tile_size]
+                    # 只保存包含标注的图像块
+                    if not (candidate and tile_mask.any()):
+                        continue
+                    tile_img = image_rows[:tile_size, x:x + tile_size]
+                    if stores:
+                        stores[0].write_tile(base_name, x, row_y, tile_img)
+                        stores[1].write_tile(base_name, x, row_y, tile_mask)
+                        continue
+                    img_name = f"{base_name}_tile_{x}_{row_y}.png"
+                    write_image(output_dir / 'images' / img_name, tile_img)
+                    write_image(output_dir / 'masks' / img_name, tile_mask)
+                    outputs += [output_dir / 'images' / img_name, output_dir / 'masks' / img_name]
+            previous = (y, band, mask)
+        failed = False
+    finally:
+        for store in stores:
+            store.close()
+        # 出错时删除写了一半的输出, 不留下截断的文件
+        for writer in writers:
+            if failed:
+                writer.abort()
+            else:
+                writer.close()
+        if failed:
+            for path in outputs[2:] + store_paths:
+                path.unlink(missing_ok=True)
+    return outputs + store_paths
+
+def process_labelme_annotation(image_path, json_path, output_dir, tile_size=512, tile_format='png',
+                               label_ids=None, visualization='full', strips=False):
+    """
+    处理单个LabelMe标注文件, 成功时返回写出的文件列表, 失败时返回None
+    tile_format为'store'时图像块和mask块分别写入images/和masks/下每张图一个的tile store文件
+    label_ids(类别名->ID)给出时mask保存类别ID, 否则为0/255二值mask
+    visualization为'pyramid'时可视化结果写成Deep Zoom金字塔而不是全分辨率PNG
+    strips为True时按条带处理(process_annotation_strips), 内存与图像高度无关, 输出相同
+    """
+    try:
+        if strips:
+            outputs = process_annotation_strips(image_path, json_path, output_dir, tile_size, tile_format, label_ids,
+                                                visualization)
+            print(f"成功处理: {image_path}")
+            return outputs
+        
+        # 加载图像和标注 (灰度图保持单通道)
+        image = read_image(image_path)
         if image is None:
             print(f"无法读取图像: {image_path}")
-            return
+            return None
         
         data = load_labelme_json(json_path)
         
         # 创建mask
-        mask = create_mask(data['shapes'], (image.shape[1], image.shape[0]))
+        with profile_step('labelme.mask'):
+            mask = create_mask(data['shapes'], (image.shape[1], image.shape[0]), label_ids)
         
         # 创建输出目录
         base_name = Path(image_path).stem
@@ -102,49 +335,146 @@ def process_labelme_annotation(image_path, json_path, output_dir, tile_size=512)
         vis_dir.mkdir(parents=True, exist_ok=True)
         
         # 可视化标注效果
-        visualize_annotation(image, mask, vis_dir)
+        if visualization == 'pyramid':
+            outputs = visualize_annotation_pyramid(image, mask, vis_dir)
+        else:
+            visualize_annotation(image, mask, vis_dir)
+            outputs = [vis_dir / "annotation_on_image.png", vis_dir / "annotation_on_blank.png"]
         
-        # 切分图像和mask
-        tiles_img, tiles_mask, positions = split_image_and_mask(image, mask, tile_size)
+        # 切分图像和mask, 只保留包含标注的图像块
+        annotated = [(tile_img, tile_mask, pos)
+                     for tile_img, tile_mask, pos, positive in annotated_tiles(image, mask, data['shapes'], tile_size,
+                                                                               label_ids)
+                     if positive]
+        
+        # 保存切分后的图像和mask (tile store格式)
+        if tile_format == 'store':
+            image_store_path = Path(output_dir) / 'images' / f"{base_name}{TILE_STORE_SUFFIX}"
+            mask_store_path = Path(output_dir) / 'masks' / f"{base_name}{TILE_STORE_SUFFIX}"
+            with TileStore(image_store_path, 'w') as image_store, TileStore(mask_store_path, 'w') as mask_store:
+                image_store.set_image_size(base_name, *image.shape[:2])
+                mask_store.set_image_size(base_name, *mask.shape[:2])
+                # 只保存包含标注的图像块
+                for tile_img, tile_mask, pos in annotated:
+                    image_store.write_tile(base_name, pos[0], pos[1], tile_img)
+                    mask_store.write_tile(base_name, pos[0], pos[1], tile_mask)
+            print(f"成功处理: {image_path}")
+            return outputs + [image_store_path, mask_store_path]
         
         # 保存切分后的图像和mask
-        for idx, (tile_img, tile_mask, pos) in enumerate(zip(tiles_img, tiles_mask, positions)):
-            # 只保存包含标注的图像块
-            if np.max(tile_mask) > 0:
-                img_name = f"{base_name}_tile_{pos[0]}_{pos[1]}.png"
-                cv2.imwrite(str(Path(output_dir) / 'images' / img_name), tile_img)
-                cv2.imwrite(str(Path(output_dir) / 'masks' / img_name), tile_mask)
+        # 只保存包含标注的图像块
+        for tile_img, tile_mask, pos in annotated:
+            img_name = f"{base_name}_tile_{pos[0]}_{pos[1]}.png"
+            write_image(Path(output_dir) / 'images' / img_name, tile_img)
+            write_image(Path(output_dir) / 'masks' / img_name, tile_mask)
+            outputs += [Path(output_dir) / 'images' / img_name, Path(output_dir) / 'masks' / img_name]
         
         print(f"成功处理: {image_path}")
+        return outputs
     except Exception as e:
         print(f"处理文件时出错 {image_path}: {str(e)}")
+        return None
+
+def _process_annotation_task(task):
+    """工作进程任务: 处理一个(图像, JSON, 输出目录, 切片大小, 切片格式, 类别ID, 可视化方式, 条带模式)"""
+    return process_labelme_annotation(*task)
 
-def process_directory(input_dir, output_dir, tile_size=512):
-    """处理整个目录下的所有图片和对应的JSON文件"""
+def process_directory(input_dir, output_dir, tile_size=512, workers=1, opencv_threads=None, manifest=None,
+                      tile_format='png', labels=None, visualization='full', strips=False):
+    """
+    处理整个目录下的所有图片和对应的JSON文件
+    workers为并行进程数(0表示全部核心); 给出manifest时跳过图像和标注都未变化的文件
+    tile_format为'png'(每块一个PNG文件)或'store'(每张图一个tile store文件)
+    labels为类别名列表时生成多类别mask(第i个类别的ID为i+1, 未列出的类别忽略), 并写出labels.json
+    visualization为'full'(全分辨率PNG)或'pyramid'(Deep Zoom金字塔, 适合很大的拼接图)
+    strips为True时每张图按tile_size行的条带处理, 峰值内存与图像高度无关, 可以并行处理更多的大图;
+    输出与整图模式相同, 所以不记入清单参数
+    """
     input_dir = Path(input_dir)
     output_dir = Path(output_dir)
+    manifest, own_manifest = open_manifest(manifest)
+    label_ids = {label: i for i, label in enumerate(labels, 1)} if labels else None
+    stage_params = {'tile_size': tile_size, 'tile_format': tile_format, 'labels': label_ids,
+                    'visualization': visualization}
     
     # 创建输出目录结构
     (output_dir / 'images').mkdir(parents=True, exist_ok=True)
     (output_dir / 'masks').mkdir(parents=True, exist_ok=True)
     (output_dir / 'visualization').mkdir(parents=True, exist_ok=True)
+    if label_ids is not None:
+        with open(output_dir / 'labels.json', 'w') as f:
+            json.dump(label_ids, f, ensure_ascii=False, indent=2)
     
     # 获取所有PNG文件
-    png_files = list(input_dir.glob('*.png'))
-    processed_count = 0
-    
+    png_files = sorted(input_dir.glob('*.png'))
+    tasks = []
+    skipped_count = 0
     for png_file in png_files:
         json_file = png_file.with_suffix('.json')
-        if json_file.exists():
-            process_labelme_annotation(png_file, json_file, output_dir, tile_size)
-            processed_count += 1
+        if not json_file.exists():
+            continue
+        key = output_dir / 'visualization' / png_file.stem
+        if manifest is not None and manifest.is_up_to_date(key, [png_file, json_file], stage_params,
+                                                           LABELME_CODE_VERSION):
+            skipped_count += 1
+            continue
+        tasks.append((png_file, json_file, output_dir, tile_size, tile_format, label_ids, visualization, strips))
+    processed_count = 0
+    error_count = 0
+    
+    for task, outputs, error in run_batch(_process_annotation_task, tasks, workers, opencv_threads=opencv_threads):
+        processed_count += 1
+        if outputs is None:
+            error_count += 1
+            if error is not None:
+                print(f"处理文件时出错 {task[0]}: {error}")
+        elif manifest is not None:
+            png_file, json_file = task[0], task[1]
+            manifest.record(output_dir / 'visualization' / png_file.stem, 'labelme', [png_file, json_file],
+                            outputs, stage_params, LABELME_CODE_VERSION)
+    
+    if own_manifest:
+        manifest.close()
     
     print(f"\n处理完成! 共处理了 {processed_count} 个文件")
+    if skipped_count > 0:
+        print(f"跳过未变化的文件数: {skipped_count}")
+    if error_count > 0:
+        print(f"出错文件数: {error_count}")
     print(f"输出目录: {output_dir}")
+    
+    return processed_count, error_count
 
 if __name__ == "__main__":
     # 使用示例
-    input_dir = "/Users/xiezhijie/GML/split_512/concatenated_enhanced"
-    output_dir = "dataset"
+    parser = argparse.ArgumentParser(description="将LabelMe标注的大图切分成训练数据")
+    parser.add_argument('input_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/concatenated_enhanced")
+    parser.add_argument('output_dir', nargs='?', default="dataset")
+    parser.add_argument('--tile-size', type=int, default=512)
+    add_workers_argument(parser)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    parser.add_argument('--tile-format', choices=('png', 'store', 'shards'), default='png',
+                        help="切片保存为PNG文件, 每张图一个tile store文件, 或打包成训练用的tar分片")
+    parser.add_argument('--labels', default=None,
+                        help="逗号分隔的类别名, 给出时mask保存类别ID(1, 2, ...)而不是0/255")
+    parser.add_argument('--visualization', choices=('full', 'pyramid'), default='full',
+                        help="可视化结果保存为全分辨率PNG, 或Deep Zoom金字塔(.dzi)")
+    parser.add_argument('--strips', action='store_true',
+                        help="每张图按tile_size行的条带处理, 峰值内存约为 宽 x tile_size, 适合很大的拼接图")
+    # 分片输出的选项 (dataset_shards依赖本模块, 所以在这里导入)
+    from dataset_shards import add_shard_arguments, write_dataset_shards
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    labels = args.labels.split(',') if args.labels else None
     
-    process_directory(input_dir, output_dir, tile_size=512)
\ No newline at end of file
+    with profiling(args.profile):
+        if args.tile_format == 'shards':
+            write_dataset_shards(args.input_dir, args.output_dir, args.tile_size, args.shard_size,
+                                 args.shuffle_buffer, args.val_fraction, args.negative_ratio, args.seed, labels,
+                                 args.workers, args.opencv_threads, args.manifest)
+        else:
+            process_directory(args.input_dir, args.output_dir, tile_size=args.tile_size,
+                              workers=args.workers, opencv_threads=args.opencv_threads, manifest=args.manifest,
+                              tile_format=args.tile_format, labels=labels, visualization=args.visualization,
+                              strips=args.strips)
@@ -0,0 +1,200 @@
+import contextlib
+import csv
+import json
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+class Profiler:
+    """
+    Opt-in per-step timing, allocation and I/O instrumentation
+    
+    Code marks its steps with step(name) and reports the file I/O of the
+    innermost open step with add_bytes(); while the profiler is disabled
+    both do nothing. Every record is tagged with the image being processed
+    (see image()), so the report can give percentiles over images as well
+    as totals. Worker processes started by batch_executor.run_batch profile
+    too and send their records back with each result.
+    
+    Peak allocation is the highest tracemalloc level above the level at the
+    start of the step (NumPy and OpenCV arrays returned to Python are
+    traced), so it is only measured when memory tracing is enabled.
+    
+    Open steps and the image tag are kept per thread, so the threads of an
+    io_pipeline can profile concurrently; their peaks then include what the
+    other threads allocated at the same time.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.records = []
+        self._local = threading.local()
+        self._start = None
+    
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+    
+    @property
+    def _image(self):
+        return getattr(self._local, 'image', None)
+    
+    @_image.setter
+    def _image(self, name):
+        self._local.image = name
+    
+    def enable(self, memory=True):
+        """Start recording; memory=True also traces peak allocations"""
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._start is None:
+            self._start = time.perf_counter()
+    
+    def disable(self):
+        """Stop recording (the records are kept)"""
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    
+    def take_records(self):
+        """Return the records and clear them"""
+        records, self.records = self.records, []
+        return records
+    
+    @contextlib.contextmanager
+    def image(self, name):
+        """Tag the records made inside the block with an image name"""
+        previous, self._image = self._image, str(name)
+        try:
+            yield
+        finally:
+            self._image = previous
+    
+    def step(self, name):
+        """Context manager timing one step (a no-op while disabled)"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._step(name)
+    
+    @contextlib.contextmanager
+    def _step(self, name):
+        frame = {'child_peak': 0, 'start_memory': 0, 'bytes_read': 0, 'bytes_written': 0}
+        if self.memory:
+            frame['start_memory'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            peak = 0
+            if self.memory:
+                # Nested steps reset the peak, so keep the highest level they saw
+                level = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+                peak = max(level - frame['start_memory'], 0)
+                if self._stack:
+                    self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], level)
+            self.records.append({'image': self._image, 'step': name, 'seconds': seconds, 'peak_bytes': peak,
+                                 'bytes_read': frame['bytes_read'], 'bytes_written': frame['bytes_written']})
+    
+    def add_bytes(self, read=0, written=0):
+        """Add bytes read or written to the innermost open step"""
+        if self.enabled and self._stack:
+            self._stack[-1]['bytes_read'] += read
+            self._stack[-1]['bytes_written'] += written
+    
+    def report(self):
+        """
+        Summarise the records
+        
+        Returns:
+            dict: Wall time of the run, and for every step its call count,
+                total time, percentiles of the per-image time (p50/p90/p99,
+                max), largest peak allocation and bytes read and written;
+                plus the per-image totals
+        """
+        steps = {}
+        images = {}
+        for record in self.records:
+            step = steps.setdefault(record['step'], {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0,
+                                                     'bytes_read': 0, 'bytes_written': 0, 'per_image': {}})
+            step['calls'] += 1
+            step['seconds'] += record['seconds']
+            step['peak_bytes'] = max(step['peak_bytes'], record['peak_bytes'])
+            step['bytes_read'] += record['bytes_read']
+            step['bytes_written'] += record['bytes_written']
+            image = record['image']
+            step['per_image'][image] = step['per_image'].get(image, 0.0) + record['seconds']
+            images.setdefault(image, {}).setdefault(record['step'], 0.0)
+            images[image][record['step']] += record['seconds']
+        
+        summary = {}
+        for name, step in steps.items():
+            per_image = np.array(list(step.pop('per_image').values()))
+            p50, p90, p99 = np.percentile(per_image, [50, 90, 99])
+            summary[name] = dict(step, images=len(per_image), p50_seconds=p50, p90_seconds=p90,
+                                 p99_seconds=p99, max_seconds=per_image.max())
+        wall = time.perf_counter() - self._start if self._start is not None else 0.0
+        return {'wall_seconds': wall, 'images': len(images), 'steps': summary,
+                'per_image': {str(image): image_steps for image, image_steps in images.items()}}
+    
+    def write_report(self, path):
+        """
+        Write the report as JSON, or as CSV (one row per step) if the path
+        ends in .csv
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report = self.report()
+        if path.suffix == '.csv':
+            columns = ['step', 'calls', 'images', 'seconds', 'p50_seconds', 'p90_seconds', 'p99_seconds',
+                       'max_seconds', 'peak_bytes', 'bytes_read', 'bytes_written']
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                for name, step in report['steps'].items():
+                    writer.writerow(dict(step, step=name))
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+# Process-wide profiler used by the pipeline modules
+PROFILER = Profiler()
+
+def profile_step(name):
+    """Time a step with the process-wide profiler (a no-op unless profiling)"""
+    return PROFILER.step(name)
+
+@contextlib.contextmanager
+def profiling(report_path=None, memory=True):
+    """
+    Profile the block and write the report to report_path
+    
+    Does nothing if report_path is None, so drivers can always wrap their
+    work in it.
+    """
+    if report_path is None:
+        yield None
+        return
+    PROFILER.enable(memory)
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.disable()
+        report = PROFILER.write_report(report_path)
+        print(f"Profile of {report['images']} images written to {report_path}")
+
+def add_profile_argument(parser):
+    """Add the shared --profile option to an argparse parser"""
+    parser.add_argument('--profile', default=None, metavar='REPORT',
+                        help="Write a per-step timing/memory/I-O report (.json or .csv)")
+    return parser
@@ -0,0 +1,337 @@
+import argparse
+import math
+import shutil
+from pathlib import Path
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from image_io import iter_image_strips, list_images, read_image, read_png_size, write_image
+from manifest import add_manifest_argument, code_version, open_manifest
+from profiling import add_profile_argument, profile_step, profiling
+from tile_store import TileStore, TILE_STORE_SUFFIX
+
+# Version of the pyramid code, recorded in incremental-rebuild manifests
+PYRAMID_CODE_VERSION = code_version(__file__)
+
+# Deep Zoom defaults (OpenSeadragon and most viewers expect these)
+DZI_TILE_SIZE = 254
+DZI_OVERLAP = 1
+
+_DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+def pyramid_levels(height, width):
+    """Number of Deep Zoom levels: level 0 is 1x1, the last level is full size"""
+    return int(math.ceil(math.log2(max(height, width, 1)))) + 1
+
+def _halve_rows(rows):
+    """Halve an even number of rows by 2x2 averaging (rounding half up); an odd last column is repeated"""
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+    r = rows.astype(np.uint16)
+    total = r[0::2, 0::2] + r[1::2, 0::2] + r[0::2, 1::2] + r[1::2, 1::2]
+    return ((total + 2) >> 2).astype(np.uint8)
+
+class _Level:
+    """
+    One pyramid level fed with rows from the top down
+    
+    Rows are buffered only until the tile row they belong to is complete;
+    then its tiles go to the sink, and every pair of rows is averaged
+    into one row of the next smaller level.
+    """
+    def __init__(self, level, height, width, tile_size, overlap, sink, parent):
+        self.level = level
+        self.height = height
+        self.width = width
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.sink = sink
+        self.parent = parent
+        self.buffer = None
+        self.top = 0
+        self.tile_row = 0
+        self.pending = None
+    
+    def push(self, rows):
+        self.buffer = rows if self.buffer is None else np.concatenate([self.buffer, rows])
+        self._emit(final=False)
+        if self.parent is not None:
+            if self.pending is not None:
+                rows = np.concatenate([self.pending, rows])
+                self.pending = None
+            if len(rows) % 2:
+                self.pending = rows[-1:].copy()
+                rows = rows[:-1]
+            if len(rows):
+                self.parent.push(_halve_rows(rows))
+    
+    def _emit(self, final):
+        t, overlap = self.tile_size, self.overlap
+        while self.tile_row * t < self.height:
+            y0 = max(0, self.tile_row * t - overlap)
+            y1 = min(self.height, (self.tile_row + 1) * t + overlap)
+            if self.top + len(self.buffer) < y1 and not final:
+                return
+            strip = self.buffer[y0 - self.top:y1 - self.top]
+            for col in range((self.width + t - 1) // t):
+                x0 = max(0, col * t - overlap)
+                x1 = min(self.width, (col + 1) * t + overlap)
+                self.sink(self.level, col, self.tile_row, x0, y0, strip[:, x0:x1])
+            self.tile_row += 1
+            # Keep only the rows the next tile row still needs
+            drop = max(0, self.tile_row * t - overlap) - self.top
+            if drop > 0:
+                self.buffer = self.buffer[drop:]
+                self.top += drop
+    
+    def finish(self):
+        if self.parent is not None and self.pending is not None:
+            # An odd last row is averaged with itself
+            self.parent.push(_halve_rows(np.concatenate([self.pending, self.pending])))
+        if self.buffer is not None:
+            self._emit(final=True)
+        if self.parent is not None:
+            self.parent.finish()
+
+def _build_levels(height, width, tile_size, overlap, sink):
+    """Chain of pyramid levels, returning the full-size level that rows are pushed into"""
+    levels = pyramid_levels(height, width)
+    level = None
+    for n in range(levels):
+        scale = 2 ** (levels - 1 - n)
+        level = _Level(n, -(-height // scale), -(-width // scale), tile_size, overlap, sink, level)
+    return level
+
+def build_pyramid_from_strips(strips, height, width, sink, tile_size=DZI_TILE_SIZE, overlap=DZI_OVERLAP):
+    """
+    Build all pyramid levels from the rows of the full-size image
+    
+    Only the current strip and about one tile row per level are held in
+    memory; the pyramid is never built as a whole.
+    
+    Args:
+        strips (iterable): Consecutive row blocks of the full-size image, top to bottom
+        height (int): Height of the image
+        width (int): Width of the image
+        sink (callable): sink(level, col, row, x, y, tile) called for every tile
+        tile_size (int): Tile size without the overlap
+        overlap (int): Pixels each tile extends into its neighbours
+    
+    Returns:
+        int: Number of levels
+    """
+    level = _build_levels(height, width, tile_size, overlap, sink)
+    with profile_step('pyramid'):
+        for strip in strips:
+            level.push(strip)
+        level.finish()
+    return level.level + 1
+
+def image_strips(image, rows=1024):
+    """Yield consecutive row blocks of an image (views, no copies)"""
+    for y in range(0, image.shape[0], rows):
+        yield image[y:y + rows]
+
+class DziWriter:
+    """
+    Sink writing a Deep Zoom image: "<name>.dzi" plus "<name>_files/<level>/<col>_<row>.<format>"
+    """
+    def __init__(self, dzi_path, tile_format='png'):
+        self.dzi_path = Path(dzi_path)
+        self.tiles_dir = self.dzi_path.with_name(f"{self.dzi_path.stem}_files")
+        self.tile_format = tile_format
+        self._dirs = set()
+    
+    def __call__(self, level, col, row, x, y, tile):
+        level_dir = self.tiles_dir / str(level)
+        if level not in self._dirs:
+            level_dir.mkdir(parents=True, exist_ok=True)
+            self._dirs.add(level)
+        write_image(level_dir / f"{col}_{row}.{self.tile_format}", tile)
+    
+    def finish(self, height, width, tile_size, overlap):
+        self.dzi_path.write_text(_DZI_TEMPLATE.format(format=self.tile_format, overlap=overlap, tile_size=tile_size,
+                                                      width=width, height=height))
+        return self.dzi_path
+    
+    def abort(self):
+        shutil.rmtree(self.tiles_dir, ignore_errors=True)
+        self.dzi_path.unlink(missing_ok=True)
+
+class StoreWriter:
+    """
+    Sink writing all levels into one tile store: image "<level>" holds the
+    tiles of that level at their pixel positions, so reassemble_image can
+    rebuild any level
+    """
+    def __init__(self, store_path):
+        self.store = TileStore(store_path, 'w')
+        self.sizes = {}
+    
+    def __call__(self, level, col, row, x, y, tile):
+        self.store.write_tile(str(level), x, y, tile)
+        size = self.sizes.get(level, (0, 0))
+        self.sizes[level] = (max(size[0], y + tile.shape[0]), max(size[1], x + tile.shape[1]))
+    
+    def finish(self, height, width, tile_size, overlap):
+        for level, size in self.sizes.items():
+            self.store.set_image_size(str(level), *size)
+        self.store.close()
+        return self.store.path
+    
+    def abort(self):
+        self.store.close()
+        self.store.path.unlink(missing_ok=True)
+
+def write_pyramid(strips, height, width, output_path, tile_size=DZI_TILE_SIZE, overlap=DZI_OVERLAP,
+                  tile_format='png'):
+    """
+    Write the pyramid of an image given as row strips
+    
+    Args:
+        strips (iterable): Row blocks of the full-size image, see build_pyramid_from_strips
+        height (int): Height of the image
+        width (int): Width of the image
+        output_path (str or Path): "<name>.dzi" for a Deep Zoom directory
+            layout, or "<name>.tiles" for a single tile store file
+        tile_size (int): Tile size without the overlap
+        overlap (int): Pixels each tile extends into its neighbours
+        tile_format (str): 'png' or 'jpg' tiles of the Deep Zoom layout
+    
+    Returns:
+        Path: The .dzi or tile store file
+    """
+    writer = PyramidWriter(height, width, output_path, tile_size, overlap, tile_format)
+    for strip in strips:
+        writer.push(strip)
+    return writer.close()
+
+class PyramidWriter:
+    """
+    write_pyramid fed from the caller's loop: push() the rows of the
+    full-size image top to bottom, then close() returns the .dzi or tile
+    store file. Several pyramids can be built from the same pass this way.
+    """
+    def __init__(self, height, width, output_path, tile_size=DZI_TILE_SIZE, overlap=DZI_OVERLAP,
+                 tile_format='png'):
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if output_path.suffix == TILE_STORE_SUFFIX:
+            self.sink = StoreWriter(output_path)
+        else:
+            self.sink = DziWriter(output_path, tile_format)
+        self.size = (height, width, tile_size, overlap)
+        self._level = _build_levels(height, width, tile_size, overlap, self.sink)
+    
+    def push(self, rows):
+        with profile_step('pyramid'):
+            self._level.push(rows)
+    
+    def close(self):
+        with profile_step('pyramid'):
+            self._level.finish()
+        return self.sink.finish(*self.size)
+    
+    def abort(self):
+        """Remove the tiles written so far, after an error"""
+        self.sink.abort()
+
+def build_pyramid(image_path, output_path, tile_size=DZI_TILE_SIZE, overlap=DZI_OVERLAP, tile_format='png'):
+    """
+    Write the pyramid of an image file (see write_pyramid)
+    
+    PNG files are decoded in row strips (image_io.iter_image_strips), so the
+    full-resolution image is never held in memory; other files are read whole.
+    """
+    size = read_png_size(image_path)
+    if size is None:
+        image = read_image(image_path)
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        strips, size = image_strips(image, 4 * tile_size), image.shape
+    else:
+        strips = iter_image_strips(image_path, tile_size)
+    return write_pyramid(strips, size[0], size[1], output_path, tile_size, overlap, tile_format)
+
+def _pyramid_task(task):
+    """Worker task: build the pyramid of one image"""
+    return build_pyramid(*task)
+
+def build_pyramids(inputs, output_dir, layout='dzi', tile_size=DZI_TILE_SIZE, overlap=DZI_OVERLAP,
+                   tile_format='png', workers=1, manifest=None):
+    """
+    Build pyramids of the outputs of concat_images or reassemble_tiles
+    
+    Args:
+        inputs (list): Image files and/or directories of images
+        output_dir (str or Path): Directory for the pyramids
+        layout (str): 'dzi' for Deep Zoom directories, 'store' for one tile
+            store file per image
+        tile_size (int): Tile size without the overlap
+        overlap (int): Pixels each tile extends into its neighbours
+        tile_format (str): 'png' or 'jpg' tiles of the Deep Zoom layout
+        workers (int): Number of worker processes (0 = all cores)
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            pyramids of unchanged images are not built again
+    
+    Returns:
+        tuple: (processed, errors) counts
+    """
+    output_dir = Path(output_dir)
+    manifest, own_manifest = open_manifest(manifest)
+    stage_params = {'layout': layout, 'tile_size': tile_size, 'overlap': overlap, 'tile_format': tile_format}
+    suffix = TILE_STORE_SUFFIX if layout == 'store' else '.dzi'
+    
+    image_paths = []
+    for item in map(Path, inputs):
+        image_paths += list_images(item) if item.is_dir() else [item]
+    
+    tasks = []
+    for image_path in image_paths:
+        output_path = output_dir / f"{image_path.stem}{suffix}"
+        if manifest is not None and manifest.is_up_to_date(output_path, [image_path], stage_params,
+                                                           PYRAMID_CODE_VERSION):
+            print(f"Up to date: {output_path}")
+            continue
+        tasks.append((image_path, output_path, tile_size, overlap, tile_format))
+    
+    processed = 0
+    errors = 0
+    for task, output_path, error in run_batch(_pyramid_task, tasks, workers):
+        if error is None:
+            processed += 1
+            print(f"Built pyramid: {output_path}")
+            if manifest is not None:
+                # Only the .dzi descriptor is hashed, not the thousands of tiles
+                manifest.record(output_path, 'pyramid', [task[0]], [output_path], stage_params, PYRAMID_CODE_VERSION)
+        else:
+            errors += 1
+            print(f"Error building the pyramid of {task[0]}: {error}")
+    
+    if own_manifest:
+        manifest.close()
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    return processed, errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build Deep Zoom pyramids of large images")
+    parser.add_argument('inputs', nargs='*', default=["/Users/xiezhijie/GML/split_512/concatenated_enhanced"],
+                        help="Image files or directories of images")
+    parser.add_argument('--output-dir', default="pyramids")
+    parser.add_argument('--layout', choices=('dzi', 'store'), default='dzi',
+                        help="Deep Zoom directories (.dzi) or one tile store file per image")
+    parser.add_argument('--tile-size', type=int, default=DZI_TILE_SIZE)
+    parser.add_argument('--overlap', type=int, default=DZI_OVERLAP)
+    parser.add_argument('--tile-format', choices=('png', 'jpg'), default='png')
+    add_workers_argument(parser, opencv_threads=False)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    with profiling(args.profile):
+        build_pyramids(args.inputs, args.output_dir, args.layout, args.tile_size, args.overlap, args.tile_format,
+                       args.workers, args.manifest)
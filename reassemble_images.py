@@ -1,21 +1,201 @@
+import argparse
 import os
-import cv2
+import tempfile
 import numpy as np
 from pathlib import Path
 import re
+from batch_executor import add_workers_argument, run_batch
+from manifest import add_manifest_argument, code_version, open_manifest
+from image_io import PngWriter, read_image, read_png_size, write_image, to_bgr
+from profiling import add_profile_argument, profile_step, profiling
+from tile_store import TileStore, TILE_STORE_SUFFIX
 
-def reassemble_tiles(tiles_dir, output_dir, tile_size=1024):
+# Version of the reassembly code, recorded in incremental-rebuild manifests
+REASSEMBLE_CODE_VERSION = code_version(__file__)
+
+# Canvases larger than this many bytes are kept in a disk-backed memmap
+DEFAULT_MEMORY_LIMIT = 1 << 30
+
+def paste_tiles(tiles, height, width, out=None):
+    """
+    Paste tiles into a new image
+    
+    Args:
+        tiles (iterable): (x, y, tile) triples; the first tile decides the
+            number of channels (grey tiles are kept single-channel)
+        height (int): Height of the image
+        width (int): Width of the image
+        out (np.ndarray): Optional zero-filled canvas of shape (height, width)
+            or (height, width, 3), e.g. a np.memmap, used instead of a new one
+    
+    Returns:
+        np.ndarray: The image, or None if there are no tiles and no out. A
+            colour out that only received grey tiles comes back as a
+            single-channel view of it (not a copy, see _write_canvas)
+    """
+    reassembled = out
+    colour = False
+    for x, y, tile in tiles:
+        if reassembled is None:
+            reassembled = np.zeros((height, width) + tile.shape[2:], dtype=np.uint8)
+        colour = colour or tile.ndim == 3
+        
+        # A grey-looking tile of a colour image comes back single-channel
+        if tile.ndim != reassembled.ndim:
+            if tile.ndim == 2:
+                tile = tile[:, :, None]
+            else:
+                reassembled = to_bgr(reassembled)
+        
+        # Ensure the tile fits within the reassembled image
+        h = min(tile.shape[0], height - y)
+        w = min(tile.shape[1], width - x)
+        reassembled[y:y+h, x:x+w] = tile[:h, :w]
+    
+    # A colour canvas that only received grey tiles stays grey
+    if out is not None and reassembled is out and reassembled.ndim == 3 and not colour:
+        reassembled = reassembled[:, :, 0]
+    return reassembled
+
+def _write_canvas(output_path, img, rows=1024):
+    """Save a canvas; a single-channel view of a colour canvas is written in strips rather than copied whole"""
+    if img.flags.c_contiguous:
+        write_image(output_path, img)
+    elif Path(output_path).suffix.lower() == '.png':
+        with PngWriter(output_path, img.shape[0], img.shape[1]) as writer:
+            for y in range(0, img.shape[0], rows):
+                writer.write(img[y:y + rows])
+    else:
+        write_image(output_path, np.ascontiguousarray(img))
+
+def find_tiles(img_dir, suffixes=(".png",)):
+    """
+    List the tiles of one image directory
+    
+    Args:
+        img_dir (Path): Directory of tiles
+        suffixes (tuple): File suffixes of the tiles
+    
+    Returns:
+        list: (x, y, path) for every "*tile_x{x}_y{y}*" file with one of the suffixes,
+            in the row-major order split_image writes them
+    """
+    tile_info = []
+    for suffix in suffixes:
+        for tile_path in img_dir.glob(f"*{suffix}"):
+            # Extract x and y coordinates from filename
+            match = re.search(r'tile_x(\d+)_y(\d+)', tile_path.name)
+            if match:
+                tile_info.append((int(match.group(1)), int(match.group(2)), tile_path))
+    # Shifted edge tiles overlap their neighbours and the later one wins, so the
+    # paste order must not depend on the order the file system lists them in
+    return sorted(tile_info, key=lambda t: (t[1], t[0]))
+
+def _tile_geometry(tile_path):
+    """Return (height, width, channels) of a tile, from the header if it is a PNG"""
+    size = read_png_size(tile_path)
+    if size is None:
+        # Other formats have to be decoded
+        tile = read_image(tile_path)
+        size = tile.shape[:2] + (tile.shape[2] if tile.ndim == 3 else 1,)
+    return size
+
+def reassemble_image(source, output_path, image=None, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None):
+    """
+    Reassemble one image, streaming its tiles into the canvas
+    
+    The image size and number of channels are worked out from the PNG
+    headers or the tile store index before any tile is decoded, and every
+    tile is decoded exactly once. The image gets the exact extent of its
+    tiles (the recorded original size for tile stores), so the shifted last
+    tiles do not enlarge it. Canvases above memory_limit bytes live in a
+    memmap in scratch_dir, so images larger than RAM can be reassembled.
+    
+    Args:
+        source (str, Path or list): Directory of PNG tiles, a tile store
+            file, or a list of (x, y, path) from find_tiles
+        output_path (str or Path): Path of the reassembled image
+        image (str): Name of the image in a tile store (default: the
+            store's only or first image)
+        memory_limit (int): Largest canvas in bytes kept in memory
+        scratch_dir (str or Path): Directory for the canvas memmap
+    
+    Returns:
+        int: Number of tiles pasted
+    """
+    if isinstance(source, list) or Path(source).is_dir():
+        tile_info = source if isinstance(source, list) else find_tiles(Path(source))
+        geometry = [_tile_geometry(tile_path) for _, _, tile_path in tile_info]
+        height = max(y + size[0] for (_, y, _), size in zip(tile_info, geometry))
+        width = max(x + size[1] for (x, _, _), size in zip(tile_info, geometry))
+        channels = max(size[2] for size in geometry)
+        return _stream_tiles(((x, y, lambda p=tile_path: read_image(p)) for x, y, tile_path in tile_info),
+                             len(tile_info), height, width, channels, output_path, memory_limit, scratch_dir)
+    
+    with TileStore(source) as store:
+        if image is None:
+            image = store.images()[0]
+        entries = sorted(store.tiles(image), key=lambda e: (e.y, e.x))
+        size = store.image_size(image)
+        if size is None:
+            size = (max(e.y + e.height for e in entries), max(e.x + e.width for e in entries))
+        channels = max(e.channels for e in entries)
+        return _stream_tiles(((e.x, e.y, lambda e=e: store.read_tile(e)) for e in entries),
+                             len(entries), size[0], size[1], channels, output_path, memory_limit, scratch_dir)
+
+def _stream_tiles(tiles, count, height, width, channels, output_path, memory_limit, scratch_dir):
+    """Paste lazily-read tiles into an in-memory or memmap canvas and save it"""
+    shape = (height, width) + ((3,) if channels > 1 else ())
+    decoded = ((x, y, load()) for x, y, load in tiles)
+    if np.prod(shape) <= memory_limit:
+        # Tiles are decoded while pasting, so 'reassemble' includes their reads
+        with profile_step('reassemble'):
+            reassembled = paste_tiles(decoded, height, width, np.zeros(shape, dtype=np.uint8))
+        _write_canvas(output_path, reassembled)
+        return count
+    
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        canvas = np.memmap(Path(tmp) / 'canvas.u8', dtype=np.uint8, mode='w+', shape=shape)
+        with profile_step('reassemble'):
+            reassembled = paste_tiles(decoded, height, width, canvas)
+        _write_canvas(output_path, reassembled)
+        del canvas, reassembled
+    return count
+
+def _reassemble_task(task):
+    """Worker task: reassemble one image"""
+    return reassemble_image(*task)
+
+def reassemble_tiles(tiles_dir, output_dir, tile_size=1024, manifest=None, workers=1,
+                     memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None):
     """
     Reassemble tiles back into complete images
     
+    Tiles are read from one subdirectory of PNG tiles per image and from
+    tile store files ("*.tiles") directly in tiles_dir. Tile positions and
+    sizes come from the file names and headers (or the store index), and
+    each image is streamed into its canvas by reassemble_image.
+    
     Args:
         tiles_dir (str or Path): Directory containing the tile images
         output_dir (str or Path): Directory to save the reassembled images
-        tile_size (int): Size of the square tiles (width and height)
+        tile_size (int): Nominal tile size; the actual tile sizes are read
+            from the tiles
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            images whose tiles have not changed are not reassembled again
+        workers (int): Number of worker processes (0 = all cores)
+        memory_limit (int): Largest canvas in bytes kept in memory; larger
+            ones are kept in a memmap in scratch_dir
+        scratch_dir (str or Path): Directory for canvas memmaps
+    
+    Returns:
+        tuple: (processed, errors) counts
     """
     # Convert to Path objects
     tiles_dir = Path(tiles_dir)
     output_dir = Path(output_dir)
+    manifest, own_manifest = open_manifest(manifest)
+    stage_params = {'tile_size': tile_size}
     
     # Create output directory
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -25,70 +205,82 @@ def reassemble_tiles(tiles_dir, output_dir, tile_size=1024):
     
     print(f"Found {len(image_dirs)} image directories to reassemble")
     
-    # Process each image directory
-    for i, img_dir in enumerate(image_dirs, 1):
-        print(f"Reassembling image {i}/{len(image_dirs)}: {img_dir.name}")
-        
-        # Get all tile images in this directory
-        tile_paths = list(img_dir.glob("*.png"))
-        
-        if not tile_paths:
+    # Tile store files, each holding the tiles of one or more images
+    store_paths = sorted(tiles_dir.glob(f"*{TILE_STORE_SUFFIX}"))
+    if store_paths:
+        print(f"Found {len(store_paths)} tile stores to reassemble")
+    
+    # Collect the images to reassemble: (name, inputs, task)
+    jobs = []
+    for img_dir in image_dirs:
+        tile_info = find_tiles(img_dir)
+        if not tile_info:
             print(f"  No tiles found in {img_dir}")
             continue
-        
-        # Extract coordinates from filenames
-        tile_info = []
-        for tile_path in tile_paths:
-            # Extract x and y coordinates from filename
-            match = re.search(r'tile_x(\d+)_y(\d+)', tile_path.name)
-            if match:
-                x = int(match.group(1))
-                y = int(match.group(2))
-                tile_info.append((x, y, tile_path))
-        
-        if not tile_info:
-            print(f"  Could not parse tile coordinates in {img_dir}")
+        output_path = output_dir / f"{img_dir.name}_reassembled.png"
+        jobs.append((img_dir.name, [tile_path for _, _, tile_path in tile_info],
+                     (tile_info, output_path, None, memory_limit, scratch_dir)))
+    for store_path in store_paths:
+        with TileStore(store_path) as store:
+            images = [image for image in store.images() if store.tiles(image)]
+        for image in images:
+            output_path = output_dir / f"{image}_reassembled.png"
+            jobs.append((image, [store_path], (store_path, output_path, image, memory_limit, scratch_dir)))
+    
+    # Skip images whose tiles have not changed
+    tasks = []
+    inputs = {}
+    for name, tile_inputs, task in jobs:
+        output_path = task[1]
+        if manifest is not None and manifest.is_up_to_date(output_path, tile_inputs, stage_params,
+                                                           REASSEMBLE_CODE_VERSION):
+            print(f"  Up to date: {output_path}")
             continue
-        
-        # Determine the dimensions of the reassembled image
-        max_x = max(x for x, _, _ in tile_info) + tile_size
-        max_y = max(y for _, y, _ in tile_info) + tile_size
-        
-        # Create an empty image to hold the reassembled result
-        # Read one tile to determine the number of channels
-        sample_tile = cv2.imread(str(tile_info[0][2]))
-        channels = sample_tile.shape[2] if len(sample_tile.shape) > 2 else 1
-        
-        if channels == 1:
-            reassembled = np.zeros((max_y, max_x), dtype=np.uint8)
+        inputs[output_path] = tile_inputs
+        tasks.append(task)
+    
+    processed = 0
+    errors = 0
+    for i, (task, count, error) in enumerate(run_batch(_reassemble_task, tasks, workers), 1):
+        output_path = task[1]
+        print(f"Reassembling image {i}/{len(tasks)}: {output_path.name}")
+        if error is None:
+            processed += 1
+            print(f"  Saved reassembled image from {count} tiles: {output_path}")
+            if manifest is not None:
+                manifest.record(output_path, 'reassemble', inputs[output_path], [output_path], stage_params,
+                                REASSEMBLE_CODE_VERSION)
         else:
-            reassembled = np.zeros((max_y, max_x, channels), dtype=np.uint8)
-        
-        # Place each tile in the correct position
-        for x, y, tile_path in tile_info:
-            tile = cv2.imread(str(tile_path))
-            
-            # Ensure the tile fits within the reassembled image
-            h, w = tile.shape[:2]
-            reassembled[y:y+h, x:x+w] = tile
-        
-        # Save the reassembled image
-        output_path = output_dir / f"{img_dir.name}_reassembled.png"
-        cv2.imwrite(str(output_path), reassembled)
-        print(f"  Saved reassembled image: {output_path}")
+            errors += 1
+            print(f"  Error: {error}")
+    
+    if own_manifest:
+        manifest.close()
     
     print("\nReassembly complete!")
     print(f"Reassembled images saved to: {output_dir}")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    
+    return processed, errors
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reassemble tiles back into complete images")
     # Input directory containing the enhanced tiles
-    tiles_dir = "/Users/xiezhijie/GML/split_512/enhanced_tiles"
-    
+    parser.add_argument('tiles_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/enhanced_tiles")
     # Output directory for reassembled images
-    output_dir = "/Users/xiezhijie/GML/split_512/reassembled_images"
-    
+    parser.add_argument('output_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/reassembled_images")
     # Tile size
-    tile_size = 1024
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--memory-limit', type=int, default=DEFAULT_MEMORY_LIMIT,
+                        help="Largest canvas in bytes kept in memory; larger ones use a disk-backed memmap")
+    parser.add_argument('--scratch-dir', default=None, help="Directory for canvas memmaps")
+    add_workers_argument(parser, opencv_threads=False)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
     
     # Reassemble the tiles
-    reassemble_tiles(tiles_dir, output_dir, tile_size)
+    with profiling(args.profile):
+        reassemble_tiles(args.tiles_dir, args.output_dir, args.tile_size, args.manifest, args.workers,
+                         args.memory_limit, args.scratch_dir)
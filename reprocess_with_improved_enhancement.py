@@ -1,51 +1,107 @@
+import argparse
 import os
 import cv2
 import numpy as np
 from pathlib import Path
-from enhance_image import enhance_image
+from enhance_image import (_enhance_file, enhancement_params, add_params_argument, parse_params,
+                           ENHANCE_CODE_VERSION, ENHANCE_FILE_STAGES)
+from batch_executor import add_workers_argument, run_batch
+from image_io import list_images
+from io_pipeline import add_pipeline_arguments, pipeline_from_args, pipeline_options, run_pipeline
+from manifest import add_manifest_argument, open_manifest
+from profiling import add_profile_argument, profiling
 
-def reprocess_images(input_dir, output_dir):
+def reprocess_images(input_dir, output_dir, workers=1, opencv_threads=None, params=None, manifest=None,
+                     pipeline=None):
     """
     Reprocess all images in the input directory using the improved enhancement algorithm
     
     Args:
         input_dir (str or Path): Directory containing the original extracted images
         output_dir (str or Path): Directory to save the reprocessed images
+        workers (int): Number of worker processes (0 = all cores)
+        opencv_threads (int): OpenCV threads per worker process
+        params (dict): Overrides for the enhancement parameters
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            images whose enhanced output is up to date are skipped
+        pipeline (dict or bool): Options of io_pipeline.run_pipeline (True
+            for the defaults); reads, enhances and writes in threads of this
+            process instead of using worker processes
+    
+    Returns:
+        tuple: (processed, errors) counts
     """
     # Convert to Path objects
     input_dir = Path(input_dir)
     output_dir = Path(output_dir)
+    params = enhancement_params(params)
+    manifest, own_manifest = open_manifest(manifest)
     
     # Create output directory
     output_dir.mkdir(parents=True, exist_ok=True)
     
     # Get all PNG files in the input directory
-    png_files = list(input_dir.glob("*.png"))
+    png_files = list_images(input_dir)
     total_files = len(png_files)
     
     print(f"Found {total_files} PNG files to reprocess")
     
-    # Process each image
-    for i, img_path in enumerate(png_files, 1):
-        print(f"Processing image {i}/{total_files}: {img_path.name}")
-        
-        # Create output path
+    # Create output paths, skipping images that are up to date
+    tasks = []
+    for img_path in png_files:
         output_path = output_dir / img_path.name.replace('.png', '_enhanced.png')
-        
-        # Enhance the image with the improved algorithm
-        enhance_image(img_path, output_path)
-        
-        print(f"  Enhanced: {output_path}")
+        if manifest is not None and manifest.is_up_to_date(output_path, [img_path], params, ENHANCE_CODE_VERSION):
+            continue
+        tasks.append((img_path, output_path, params))
+    
+    if len(tasks) < total_files:
+        print(f"Skipping {total_files - len(tasks)} up-to-date images")
+        total_files = len(tasks)
+    
+    processed = 0
+    errors = 0
+    
+    # Enhance each image with the improved algorithm
+    pipeline = pipeline_options(pipeline)
+    if pipeline is not None:
+        results = run_pipeline(*ENHANCE_FILE_STAGES, tasks, **pipeline)
+    else:
+        results = run_batch(_enhance_file, tasks, workers, opencv_threads=opencv_threads)
+    for i, ((img_path, output_path, _), _, error) in enumerate(results, 1):
+        print(f"Processing image {i}/{total_files}: {img_path.name}")
+        if error is None:
+            processed += 1
+            print(f"  Enhanced: {output_path}")
+            if manifest is not None:
+                manifest.record(output_path, 'enhance', [img_path], [output_path], params, ENHANCE_CODE_VERSION)
+        else:
+            errors += 1
+            print(f"  Error: {error}")
+    
+    if own_manifest:
+        manifest.close()
     
     print("\nReprocessing complete!")
     print(f"Enhanced images saved to: {output_dir}")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    
+    return processed, errors
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocess extracted images with the improved enhancement")
     # Input directory containing the extracted src.png files
-    input_dir = "/Users/xiezhijie/GML/split_512/extracted_src_png"
-    
+    parser.add_argument('input_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/extracted_src_png")
     # Output directory for enhanced images
-    output_dir = "/Users/xiezhijie/GML/split_512/improved_enhanced_images"
+    parser.add_argument('output_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/improved_enhanced_images")
+    add_workers_argument(parser)
+    add_pipeline_arguments(parser)
+    add_params_argument(parser)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
     
     # Reprocess all images with the improved enhancement
-    reprocess_images(input_dir, output_dir)
+    with profiling(args.profile):
+        reprocess_images(args.input_dir, args.output_dir, args.workers, args.opencv_threads,
+                         parse_params(args.param), args.manifest, pipeline_from_args(args))
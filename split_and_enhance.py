@@ -1,10 +1,68 @@
+import argparse
 import os
 import cv2
 import numpy as np
 from pathlib import Path
-from enhance_image import enhance_image
+from enhance_image import (enhance_array, enhancement_params, add_params_argument, parse_params,
+                           ENHANCE_CODE_VERSION)
+from batch_executor import add_workers_argument, run_batch
+from io_pipeline import add_pipeline_arguments, pipeline_from_args, pipeline_options, run_pipeline
+from manifest import add_manifest_argument, code_version, open_manifest
+from tiled_enhance import enhance_tiled, TILED_CODE_VERSION
+from image_io import list_images, read_image, write_image
+from profiling import add_profile_argument, profile_step, profiling
+from tile_store import TileStore, TILE_STORE_SUFFIX
 
-def split_image(image_path, output_dir, tile_size=1024, overlap=0):
+def tile_positions(h, w, tile_size=1024, overlap=0):
+    """
+    Compute the tile layout used by split_image
+    
+    Tiles are laid out on a grid with step tile_size - overlap. A tile that
+    would run past the right or bottom edge is shifted back so that it ends
+    on the edge (or starts at 0 if the image is smaller than a tile).
+    
+    Args:
+        h (int): Image height
+        w (int): Image width
+        tile_size (int): Size of the square tiles (width and height)
+        overlap (int): Overlap between adjacent tiles in pixels
+    
+    Returns:
+        list: List of (x1, y1, x2, y2) tile boxes in row-major order
+    """
+    positions = []
+    for y in range(0, h-overlap, tile_size-overlap):
+        for x in range(0, w-overlap, tile_size-overlap):
+            # Calculate tile coordinates
+            x1 = x
+            y1 = y
+            x2 = min(x + tile_size, w)
+            y2 = min(y + tile_size, h)
+            
+            # If the tile is smaller than the specified size, adjust starting position
+            if x2 - x1 < tile_size:
+                x1 = max(0, x2 - tile_size)
+            if y2 - y1 < tile_size:
+                y1 = max(0, y2 - tile_size)
+            
+            positions.append((x1, y1, x2, y2))
+    return positions
+
+def _cut_tiles(img, tile_size=1024, overlap=0):
+    """Yield (x, y, tile) in the split_image layout; tiles of images smaller than a tile are zero-padded"""
+    for x1, y1, x2, y2 in tile_positions(img.shape[0], img.shape[1], tile_size, overlap):
+        # Extract the tile
+        tile = img[y1:y2, x1:x2]
+        
+        # Skip if tile is not the expected size
+        if tile.shape[0] != tile_size or tile.shape[1] != tile_size:
+            # Pad the tile to make it the right size
+            padded_tile = np.zeros((tile_size, tile_size) + tile.shape[2:], dtype=np.uint8)
+            padded_tile[0:tile.shape[0], 0:tile.shape[1]] = tile
+            tile = padded_tile
+        yield x1, y1, tile
+
+def split_image(image_path, output_dir, tile_size=1024, overlap=0, store=None):
     """
     Split an image into tiles of specified size
     
@@ -13,66 +71,134 @@ def split_image(image_path, output_dir, tile_size=1024, overlap=0):
         output_dir (str or Path): Directory to save the split tiles
         tile_size (int): Size of the square tiles (width and height)
         overlap (int): Overlap between adjacent tiles in pixels
+        store (TileStore): If given, the tiles are added to this tile store
+            (named after the image) instead of written as PNG files, and
+            output_dir is not used
     
     Returns:
-        list: List of paths to the generated tile images
+        list: List of paths to the generated tile images, or of the
+            (x, y) positions of the tiles added to store
     """
     # Convert to Path objects
     image_path = Path(image_path)
-    output_dir = Path(output_dir)
     
     # Create output directory
-    output_dir.mkdir(parents=True, exist_ok=True)
+    if store is None:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Read the image
-    img = cv2.imread(str(image_path))
+    # Read the image (grey images stay single-channel)
+    img = read_image(image_path)
     if img is None:
         print(f"Error: Could not read image {image_path}")
         return []
     
     # Get image dimensions
     h, w = img.shape[:2]
+    base_name = image_path.stem
+    if store is not None:
+        store.set_image_size(base_name, h, w)
     
     # List to store paths of generated tiles
     tile_paths = []
     
     # Split the image into tiles
-    for y in range(0, h-overlap, tile_size-overlap):
-        for x in range(0, w-overlap, tile_size-overlap):
-            # Calculate tile coordinates
-            x1 = x
-            y1 = y
-            x2 = min(x + tile_size, w)
-            y2 = min(y + tile_size, h)
-            
-            # If the tile is smaller than the specified size, adjust starting position
-            if x2 - x1 < tile_size:
-                x1 = max(0, x2 - tile_size)
-            if y2 - y1 < tile_size:
-                y1 = max(0, y2 - tile_size)
-            
-            # Extract the tile
-            tile = img[y1:y2, x1:x2]
-            
-            # Skip if tile is not the expected size
-            if tile.shape[0] != tile_size or tile.shape[1] != tile_size:
-                # Pad the tile to make it the right size
-                padded_tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
-                padded_tile[0:tile.shape[0], 0:tile.shape[1]] = tile
-                tile = padded_tile
+    with profile_step('split'):
+        for x1, y1, tile in _cut_tiles(img, tile_size, overlap):
+            if store is not None:
+                store.write_tile(base_name, x1, y1, tile)
+                tile_paths.append((x1, y1))
+                continue
             
             # Generate output filename
-            base_name = image_path.stem
             tile_name = f"{base_name}_tile_x{x1}_y{y1}.png"
             tile_path = output_dir / tile_name
             
             # Save the tile
-            cv2.imwrite(str(tile_path), tile)
+            write_image(tile_path, tile)
             tile_paths.append(tile_path)
-            
+    
     return tile_paths
 
-def process_all_images(input_dir, output_split_dir, output_enhanced_dir, tile_size=1024):
+# Version of the split/enhance code, recorded in incremental-rebuild manifests
+SPLIT_CODE_VERSION = code_version(__file__, depends=(ENHANCE_CODE_VERSION, TILED_CODE_VERSION))
+
+def _read_source(task):
+    """Pipeline reader: decode the source image of a split task (grey images stay single-channel)"""
+    img = read_image(task[0])
+    if img is None:
+        raise ValueError(f"Could not read image {task[0]}")
+    return img
+
+def _enhance_source_tiles(task, img):
+    """
+    Pipeline compute stage: cut an image into tiles and enhance them
+    
+    Returns:
+        tuple: ((height, width), [(x, y, tile)], [enhanced tile])
+    """
+    tile_size, params = task[3], task[4]
+    with profile_step('split'):
+        tiles = list(_cut_tiles(img, tile_size))
+    # Tiles are enhanced as grayscale, like enhance_image reads them
+    enhanced = [enhance_array(cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if tile.ndim == 3 else tile, params)
+                for _, _, tile in tiles]
+    return img.shape[:2], tiles, enhanced
+
+def _write_tiles(task, data):
+    """
+    Pipeline writer: save the split and enhanced tiles of an image
+    
+    Returns:
+        tuple: (number of tiles, paths of the output files)
+    """
+    img_path, output_split_dir, output_enhanced_dir, _, _, tile_format = task
+    (height, width), tiles, enhanced = data
+    base_name = img_path.stem
+    
+    if tile_format == 'store':
+        # One tile store per image in each output directory
+        split_path = output_split_dir / f"{base_name}{TILE_STORE_SUFFIX}"
+        enhanced_path = output_enhanced_dir / f"{base_name}{TILE_STORE_SUFFIX}"
+        with TileStore(split_path, 'w') as split_store, TileStore(enhanced_path, 'w') as enhanced_store:
+            for store in (split_store, enhanced_store):
+                store.set_image_size(base_name, height, width)
+            for (x, y, tile), enhanced_tile in zip(tiles, enhanced):
+                split_store.write_tile(base_name, x, y, tile)
+                enhanced_store.write_tile(base_name, x, y, enhanced_tile)
+        return len(tiles), [split_path, enhanced_path]
+    
+    # One subdirectory per image in each output directory
+    img_split_dir = output_split_dir / base_name
+    img_enhanced_dir = output_enhanced_dir / base_name
+    img_split_dir.mkdir(parents=True, exist_ok=True)
+    img_enhanced_dir.mkdir(parents=True, exist_ok=True)
+    
+    tile_paths = []
+    enhanced_paths = []
+    for (x, y, tile), enhanced_tile in zip(tiles, enhanced):
+        tile_name = f"{base_name}_tile_x{x}_y{y}.png"
+        write_image(img_split_dir / tile_name, tile)
+        write_image(img_enhanced_dir / tile_name, enhanced_tile)
+        tile_paths.append(img_split_dir / tile_name)
+        enhanced_paths.append(img_enhanced_dir / tile_name)
+    return len(tiles), tile_paths + enhanced_paths
+
+# Reader, compute and writer of split tasks, for io_pipeline.run_pipeline
+SPLIT_FILE_STAGES = (_read_source, _enhance_source_tiles, _write_tiles)
+
+def _split_and_enhance_file(task):
+    """
+    Worker task: split one image and enhance its tiles
+    
+    Returns:
+        tuple: (number of tiles, paths of the output files)
+    """
+    return _write_tiles(task, _enhance_source_tiles(task, _read_source(task)))
+
+def process_all_images(input_dir, output_split_dir, output_enhanced_dir, tile_size=1024,
+                       workers=1, opencv_threads=None, params=None, manifest=None, tile_format='png',
+                       pipeline=None):
     """
     Process all images in the input directory:
     1. Split them into tiles
@@ -83,62 +209,294 @@ def process_all_images(input_dir, output_split_dir, output_enhanced_dir, tile_si
         output_split_dir (str or Path): Directory to save the split tiles
         output_enhanced_dir (str or Path): Directory to save the enhanced tiles
         tile_size (int): Size of the square tiles (width and height)
+        workers (int): Number of worker processes (0 = all cores)
+        opencv_threads (int): OpenCV threads per worker process
+        params (dict): Overrides for the enhancement parameters
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            images whose tiles are up to date are skipped
+        tile_format (str): 'png' writes one PNG file per tile in a directory
+            per image; 'store' writes one tile store file per image
+        pipeline (dict or bool): Options of io_pipeline.run_pipeline (True
+            for the defaults); reads, enhances and writes in threads of this
+            process instead of using worker processes
+    
+    Returns:
+        tuple: (processed, errors) counts
     """
     # Convert to Path objects
     input_dir = Path(input_dir)
     output_split_dir = Path(output_split_dir)
     output_enhanced_dir = Path(output_enhanced_dir)
+    params = enhancement_params(params)
+    stage_params = {'tile_size': tile_size, 'enhance': params, 'tile_format': tile_format}
+    manifest, own_manifest = open_manifest(manifest)
     
     # Create output directories
     output_split_dir.mkdir(parents=True, exist_ok=True)
     output_enhanced_dir.mkdir(parents=True, exist_ok=True)
     
     # Get all PNG files in the input directory
-    png_files = list(input_dir.glob("*.png"))
+    png_files = list_images(input_dir)
     total_files = len(png_files)
     
     print(f"Found {total_files} PNG files to process")
     
+    # Skip images whose tiles are up to date
+    tasks = []
+    for img_path in png_files:
+        key = output_enhanced_dir / img_path.stem
+        if manifest is not None and manifest.is_up_to_date(key, [img_path], stage_params, SPLIT_CODE_VERSION):
+            continue
+        tasks.append((img_path, output_split_dir, output_enhanced_dir, tile_size, params, tile_format))
+    
+    if len(tasks) < total_files:
+        print(f"Skipping {total_files - len(tasks)} up-to-date images")
+        total_files = len(tasks)
+    
+    processed = 0
+    errors = 0
+    
     # Process each image
-    for i, img_path in enumerate(png_files, 1):
+    pipeline = pipeline_options(pipeline)
+    if pipeline is not None:
+        results = run_pipeline(*SPLIT_FILE_STAGES, tasks, **pipeline)
+    else:
+        results = run_batch(_split_and_enhance_file, tasks, workers, opencv_threads=opencv_threads)
+    for i, (task, result, error) in enumerate(results, 1):
+        img_path = task[0]
         print(f"Processing image {i}/{total_files}: {img_path.name}")
+        if error is None:
+            processed += 1
+            tile_count, outputs = result
+            print(f"  Split and enhanced {tile_count} tiles")
+            if manifest is not None:
+                manifest.record(output_enhanced_dir / img_path.stem, 'split', [img_path], outputs,
+                                stage_params, SPLIT_CODE_VERSION)
+        else:
+            errors += 1
+            print(f"  Error: {error}")
+    
+    if own_manifest:
+        manifest.close()
+    
+    print("\nProcessing complete!")
+    print(f"Split tiles saved to: {output_split_dir}")
+    print(f"Enhanced tiles saved to: {output_enhanced_dir}")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    
+    return processed, errors
+
+def enhance_tiles(img, tile_size=1024, out=None, base_name="image", split_dir=None, enhanced_dir=None,
+                  params=None, seamless=False):
+    """
+    Split, enhance and reassemble an image entirely in memory
+    
+    Tiles are NumPy views of the decoded image and use the same layout as
+    split_image. Each enhanced tile is written straight into the output
+    canvas; where the shifted last tiles overlap their neighbours, the later
+    tile in row-major order wins, as in reassemble_tiles.
+    
+    With seamless=True the image is instead enhanced by the halo-tiled
+    engine (tiled_enhance.enhance_tiled), which equals enhancing the whole
+    image at once, and the debug tiles are cut from that result.
+    
+    Args:
+        img (np.ndarray): 2-D uint8 image
+        tile_size (int): Size of the square tiles (width and height)
+        out (np.ndarray): Optional preallocated output canvas with the shape of img
+        base_name (str): Base name used for the optional debug tile files
+        split_dir (str or Path): If given, also save the split tiles here
+        enhanced_dir (str or Path): If given, also save the enhanced tiles here
+        params (dict): Overrides for the enhancement parameters
+        seamless (bool): Use the seam-free halo-tiled engine
+    
+    Returns:
+        np.ndarray: The reassembled enhanced image
+    """
+    h, w = img.shape[:2]
+    if out is None:
+        out = np.empty((h, w), dtype=np.uint8)
+    
+    if seamless:
+        with profile_step('enhance_tiled'):
+            enhance_tiled(img, tile_size, params, out)
+        if split_dir is None and enhanced_dir is None:
+            return out
+    
+    if split_dir is not None:
+        Path(split_dir).mkdir(parents=True, exist_ok=True)
+    if enhanced_dir is not None:
+        Path(enhanced_dir).mkdir(parents=True, exist_ok=True)
+    
+    for x1, y1, x2, y2 in tile_positions(h, w, tile_size):
+        tile = img[y1:y2, x1:x2]
+        th, tw = tile.shape[:2]
         
-        # Create subdirectory for this image's tiles
-        img_split_dir = output_split_dir / img_path.stem
-        img_enhanced_dir = output_enhanced_dir / img_path.stem
-        
-        # Split the image
-        tile_paths = split_image(img_path, img_split_dir, tile_size)
-        print(f"  Split into {len(tile_paths)} tiles")
+        # Pad tiles of images smaller than a tile, as split_image does
+        if th != tile_size or tw != tile_size:
+            padded_tile = np.zeros((tile_size, tile_size), dtype=np.uint8)
+            padded_tile[0:th, 0:tw] = tile
+            tile = padded_tile
         
-        # Enhance each tile
-        for tile_path in tile_paths:
-            # Create output path for enhanced tile
-            rel_path = tile_path.relative_to(output_split_dir)
-            enhanced_path = output_enhanced_dir / rel_path
-            
-            # Create parent directory if it doesn't exist
-            enhanced_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            # Enhance the tile
-            enhance_image(tile_path, enhanced_path)
+        if seamless:
+            enhanced = out[y1:y2, x1:x2]
+        else:
+            enhanced = enhance_array(tile, params)
+            out[y1:y2, x1:x2] = enhanced[0:th, 0:tw]
         
-        print(f"  Enhanced {len(tile_paths)} tiles")
+        # Optional debug output
+        tile_name = f"{base_name}_tile_x{x1}_y{y1}.png"
+        if split_dir is not None:
+            write_image(Path(split_dir) / tile_name, tile)
+        if enhanced_dir is not None:
+            write_image(Path(enhanced_dir) / tile_name, enhanced)
+    
+    return out
+
+def _enhance_tiles_file(task):
+    """
+    Worker task: split, enhance and reassemble one image in memory
+    
+    Returns:
+        Path: Path of the reassembled image
+    """
+    img_path, output_reassembled_dir, tile_size, output_split_dir, output_enhanced_dir, params, seamless = task
+    
+    img = read_image(img_path, grayscale=True)
+    if img is None:
+        raise ValueError(f"Could not read image {img_path}")
+    
+    split_dir = Path(output_split_dir) / img_path.stem if output_split_dir else None
+    enhanced_dir = Path(output_enhanced_dir) / img_path.stem if output_enhanced_dir else None
+    
+    reassembled = enhance_tiles(img, tile_size, base_name=img_path.stem,
+                                split_dir=split_dir, enhanced_dir=enhanced_dir, params=params, seamless=seamless)
+    
+    output_path = output_reassembled_dir / f"{img_path.stem}_reassembled.png"
+    write_image(output_path, reassembled)
+    return output_path
+
+def process_all_images_in_memory(input_dir, output_reassembled_dir, tile_size=1024,
+                                 output_split_dir=None, output_enhanced_dir=None,
+                                 workers=1, opencv_threads=None, params=None, manifest=None, seamless=False):
+    """
+    Split, enhance and reassemble all images without intermediate PNG files
+    
+    Produces the same "<name>_reassembled.png" images as running
+    process_all_images followed by reassemble_tiles, but each source image is
+    decoded once and encoded once.
+    
+    Args:
+        input_dir (str or Path): Directory containing the input images
+        output_reassembled_dir (str or Path): Directory to save the reassembled images
+        tile_size (int): Size of the square tiles (width and height)
+        output_split_dir (str or Path): Optional directory for debug copies of the split tiles
+        output_enhanced_dir (str or Path): Optional directory for debug copies of the enhanced tiles
+        workers (int): Number of worker processes (0 = all cores)
+        opencv_threads (int): OpenCV threads per worker process
+        params (dict): Overrides for the enhancement parameters
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest;
+            images whose reassembled output is up to date are skipped
+        seamless (bool): Enhance with the seam-free halo-tiled engine instead
+            of enhancing each tile on its own
+    
+    Returns:
+        tuple: (processed, errors) counts
+    """
+    # Convert to Path objects
+    input_dir = Path(input_dir)
+    output_reassembled_dir = Path(output_reassembled_dir)
+    params = enhancement_params(params)
+    stage_params = {'tile_size': tile_size, 'enhance': params, 'seamless': seamless}
+    manifest, own_manifest = open_manifest(manifest)
+    
+    # Create output directory
+    output_reassembled_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Get all PNG files in the input directory
+    png_files = list_images(input_dir)
+    total_files = len(png_files)
+    
+    print(f"Found {total_files} PNG files to process")
+    
+    # Skip images whose reassembled output is up to date
+    tasks = []
+    for img_path in png_files:
+        output_path = output_reassembled_dir / f"{img_path.stem}_reassembled.png"
+        if manifest is not None and manifest.is_up_to_date(output_path, [img_path], stage_params,
+                                                           SPLIT_CODE_VERSION):
+            continue
+        tasks.append((img_path, output_reassembled_dir, tile_size, output_split_dir, output_enhanced_dir, params,
+                      seamless))
+    
+    if len(tasks) < total_files:
+        print(f"Skipping {total_files - len(tasks)} up-to-date images")
+        total_files = len(tasks)
+    
+    processed = 0
+    errors = 0
+    
+    for i, (task, output_path, error) in enumerate(
+            run_batch(_enhance_tiles_file, tasks, workers, opencv_threads=opencv_threads), 1):
+        img_path = task[0]
+        print(f"Processing image {i}/{total_files}: {img_path.name}")
+        if error is None:
+            processed += 1
+            print(f"  Saved reassembled image: {output_path}")
+            if manifest is not None:
+                manifest.record(output_path, 'split', [img_path], [output_path], stage_params, SPLIT_CODE_VERSION)
+        else:
+            errors += 1
+            print(f"  Error: {error}")
+    
+    if own_manifest:
+        manifest.close()
     
     print("\nProcessing complete!")
-    print(f"Split tiles saved to: {output_split_dir}")
-    print(f"Enhanced tiles saved to: {output_enhanced_dir}")
+    print(f"Reassembled images saved to: {output_reassembled_dir}")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    
+    return processed, errors
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split images into tiles and enhance each tile")
     # Input directory containing the extracted src.png files
-    input_dir = "/Users/xiezhijie/GML/split_512/extracted_src_png"
-    
-    # Output directories
-    output_split_dir = "/Users/xiezhijie/GML/split_512/split_tiles"
-    output_enhanced_dir = "/Users/xiezhijie/GML/split_512/enhanced_tiles"
-    
+    parser.add_argument('input_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/extracted_src_png")
+    # Output directories of the tiles; with --in-memory they are optional debug outputs
+    parser.add_argument('output_split_dir', nargs='?', default=None)
+    parser.add_argument('output_enhanced_dir', nargs='?', default=None)
     # Tile size
-    tile_size = 1024
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--in-memory', metavar='OUTPUT_DIR', default=None,
+                        help="Split, enhance and reassemble each image in memory and save only the reassembled "
+                             "image in OUTPUT_DIR; the tile directories are then written only if given")
+    parser.add_argument('--seamless', action='store_true',
+                        help="With --in-memory, enhance with the seam-free halo-tiled engine (tiled_enhance), "
+                             "which equals enhancing each whole image, instead of each tile on its own")
+    add_workers_argument(parser)
+    add_pipeline_arguments(parser)
+    add_params_argument(parser)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    parser.add_argument('--tile-format', choices=('png', 'store'), default='png',
+                        help="Write tiles as PNG files or as one tile store file per image")
+    args = parser.parse_args()
     
     # Process all images
-    process_all_images(input_dir, output_split_dir, output_enhanced_dir, tile_size)
+    if args.seamless and not args.in_memory:
+        parser.error("--seamless needs --in-memory: the tiles written to disk are enhanced one by one")
+    with profiling(args.profile):
+        if args.in_memory:
+            if args.tile_format != 'png' or args.pipeline:
+                parser.error("--in-memory writes no tile stores and runs in worker processes only")
+            process_all_images_in_memory(args.input_dir, args.in_memory, args.tile_size, args.output_split_dir,
+                                         args.output_enhanced_dir, args.workers, args.opencv_threads,
+                                         parse_params(args.param), args.manifest, args.seamless)
+        else:
+            process_all_images(args.input_dir,
+                               args.output_split_dir or "/Users/xiezhijie/GML/split_512/split_tiles",
+                               args.output_enhanced_dir or "/Users/xiezhijie/GML/split_512/enhanced_tiles",
+                               args.tile_size, args.workers, args.opencv_threads, parse_params(args.param),
+                               args.manifest, args.tile_format, pipeline_from_args(args))
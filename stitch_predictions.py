@@ -0,0 +1,393 @@
+import argparse
+import functools
+import tempfile
+from pathlib import Path
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from manifest import add_manifest_argument, code_version, open_manifest
+from image_io import read_image, read_png_size, write_image
+from reassemble_images import find_tiles, DEFAULT_MEMORY_LIMIT
+from tile_store import TileStore, TILE_STORE_SUFFIX
+from profiling import add_profile_argument, profile_step, profiling
+
+# Version of the stitching code, recorded in incremental-rebuild manifests
+STITCH_CODE_VERSION = code_version(__file__)
+
+WINDOWS = ('hann', 'gaussian', 'linear', 'uniform')
+
+# Prediction tile files: float arrays or 8-bit probability images
+PREDICTION_SUFFIXES = (".npy", ".png")
+
+@functools.lru_cache(maxsize=32)
+def _window_1d(n, window):
+    """1-D blending weights of length n, strictly positive"""
+    if window == 'hann':
+        # Drop the zero end points so border pixels keep some weight
+        w = np.hanning(n + 2)[1:-1]
+    elif window == 'gaussian':
+        i = np.arange(n) - (n - 1) / 2
+        w = np.exp(-0.5 * (i / (n / 8)) ** 2)
+    elif window == 'linear':
+        # Linear feathering over the outer quarter of the tile
+        ramp = max(n // 4, 1)
+        w = np.minimum(np.minimum(np.arange(n), np.arange(n)[::-1]) + 1, ramp) / ramp
+    elif window == 'uniform':
+        w = np.ones(n)
+    else:
+        raise ValueError(f"Unknown window {window!r}, expected one of {', '.join(WINDOWS)}")
+    return np.maximum(w, 1e-6).astype(np.float32)
+
+@functools.lru_cache(maxsize=32)
+def blend_window(height, width, window='hann'):
+    """
+    Return the 2-D blending weights for a tile of the given size
+    
+    Args:
+        height (int): Tile height
+        width (int): Tile width
+        window (str): 'hann', 'gaussian' (sigma = size / 8), 'linear'
+            (feathering over the outer quarter) or 'uniform' (plain average)
+    
+    Returns:
+        np.ndarray: Read-only float32 array of shape (height, width)
+    """
+    w = np.outer(_window_1d(height, window), _window_1d(width, window))
+    w.flags.writeable = False
+    return w
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+class PredictionStitcher:
+    """
+    Stitch overlapping prediction tiles into one probability map
+    
+    Each tile is multiplied by a blending window and added to a float32
+    canvas, and the window is added to a weight canvas; the result is the
+    weighted average of all tiles covering a pixel. Tiles may overlap by
+    any amount and may stick out of the image. Both canvases live in a
+    disk-backed memmap when they would exceed memory_limit bytes, and the
+    result is normalised in row strips, so memory use stays bounded.
+    
+    Args:
+        height (int): Image height
+        width (int): Image width
+        channels (int): Number of classes (1 for a binary foreground map)
+        window (str): Blending window, see blend_window
+        activation (str): None if the tiles are probabilities, 'sigmoid' or
+            'softmax' (over the last axis) if they are logits
+        memory_limit (int): Largest canvases in bytes kept in memory
+        scratch_dir (str or Path): Directory for the canvas memmaps
+    """
+    def __init__(self, height, width, channels=1, window='hann', activation=None,
+                 memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None):
+        if activation not in (None, 'sigmoid', 'softmax'):
+            raise ValueError(f"Unknown activation {activation!r}, expected None, 'sigmoid' or 'softmax'")
+        self.height = height
+        self.width = width
+        self.channels = channels
+        self.window = window
+        self.activation = activation
+        self._tmp = None
+        
+        shape = (height, width) + ((channels,) if channels > 1 else ())
+        if 4 * height * width * (channels + 1) <= memory_limit:
+            self.acc = np.zeros(shape, dtype=np.float32)
+            self.weight = np.zeros((height, width), dtype=np.float32)
+        else:
+            self._tmp = tempfile.TemporaryDirectory(dir=scratch_dir)
+            self.acc = np.memmap(Path(self._tmp.name) / 'acc.f32', dtype=np.float32, mode='w+', shape=shape)
+            self.weight = np.memmap(Path(self._tmp.name) / 'weight.f32', dtype=np.float32, mode='w+',
+                                    shape=(height, width))
+    
+    def add(self, x, y, pred):
+        """
+        Add one prediction tile
+        
+        Args:
+            x (int): Left edge of the tile in the image
+            y (int): Top edge of the tile in the image
+            pred (np.ndarray): (h, w) or (h, w, channels) probabilities or
+                logits; uint8 tiles are read as probabilities scaled to 0-255
+        """
+        if pred.dtype == np.uint8:
+            pred = pred.astype(np.float32) / 255
+        else:
+            pred = pred.astype(np.float32, copy=False)
+        if self.activation == 'sigmoid':
+            pred = _sigmoid(pred)
+        elif self.activation == 'softmax':
+            pred = _softmax(pred)
+        
+        th, tw = pred.shape[:2]
+        win = blend_window(th, tw, self.window)
+        
+        # Clip the tile to the image
+        h = min(th, self.height - y)
+        w = min(tw, self.width - x)
+        if h <= 0 or w <= 0:
+            return
+        win = win[:h, :w]
+        pred = pred[:h, :w]
+        if self.channels > 1:
+            self.acc[y:y+h, x:x+w] += pred * win[:, :, None]
+        else:
+            self.acc[y:y+h, x:x+w] += pred * win
+        self.weight[y:y+h, x:x+w] += win
+    
+    def strips(self, strip_rows=512):
+        """
+        Yield the normalised probabilities in row strips
+        
+        Yields:
+            tuple: (y0, y1, probabilities of rows y0:y1); pixels no tile
+                covered are 0
+        """
+        for y0 in range(0, self.height, strip_rows):
+            y1 = min(y0 + strip_rows, self.height)
+            weight = np.asarray(self.weight[y0:y1])
+            if self.channels > 1:
+                weight = weight[:, :, None]
+            prob = np.divide(self.acc[y0:y1], weight, out=np.zeros(self.acc[y0:y1].shape, np.float32),
+                             where=weight > 0)
+            yield y0, y1, prob
+    
+    def result(self, threshold=None, out=None, strip_rows=512):
+        """
+        Return the stitched map
+        
+        Args:
+            threshold (float): If given, return a uint8 mask (255 where the
+                probability is at least threshold) instead of probabilities;
+                multi-class maps are always reduced to uint8 argmax labels
+            out (np.ndarray): Optional output array, e.g. a np.memmap
+            strip_rows (int): Rows normalised at a time
+        
+        Returns:
+            np.ndarray: float32 probabilities, or the uint8 mask or label map
+        """
+        if out is None:
+            dtype = np.float32 if self.channels == 1 and threshold is None else np.uint8
+            out = np.empty((self.height, self.width), dtype=dtype)
+        
+        for y0, y1, prob in self.strips(strip_rows):
+            if self.channels > 1:
+                out[y0:y1] = prob.argmax(axis=-1)
+            elif threshold is not None:
+                out[y0:y1] = np.where(prob >= threshold, 255, 0)
+            else:
+                out[y0:y1] = prob
+        return out
+    
+    def close(self):
+        """Release the canvases and their scratch files"""
+        self.acc = self.weight = None
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def load_prediction(path):
+    """Read a prediction tile: a .npy array, or an 8-bit probability image"""
+    path = Path(path)
+    if path.suffix == '.npy':
+        return np.load(path)
+    return read_image(path)
+
+def _prediction_geometry(path):
+    """Return (height, width, channels) of a prediction tile without reading its data"""
+    path = Path(path)
+    if path.suffix == '.npy':
+        shape = np.load(path, mmap_mode='r').shape
+    else:
+        shape = read_png_size(path)
+        if shape is not None:
+            return shape
+        shape = read_image(path).shape
+    return shape[:2] + (shape[2] if len(shape) == 3 else 1,)
+
+def stitch_image(source, output_path, image=None, window='hann', threshold=None, activation=None,
+                 probability_path=None, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None):
+    """
+    Stitch the prediction tiles of one image
+    
+    Args:
+        source (str, Path or list): Directory of prediction tiles
+            ("*tile_x{x}_y{y}*.npy" or ".png"), a tile store file, or a list
+            of (x, y, path) from find_tiles
+        output_path (str or Path): Output PNG: the probability map scaled to
+            0-255, the thresholded mask, or the argmax label map
+        image (str): Name of the image in a tile store (default: its first image)
+        window (str): Blending window, see blend_window
+        threshold (float): Optional probability threshold for a binary mask
+        activation (str): None, 'sigmoid' or 'softmax' for logit tiles
+        probability_path (str or Path): If given, also save the float32
+            probabilities here as a .npy file
+        memory_limit (int): Largest canvases in bytes kept in memory
+        scratch_dir (str or Path): Directory for canvas memmaps
+    
+    Returns:
+        int: Number of tiles stitched
+    """
+    store = None
+    if isinstance(source, list) or Path(source).is_dir():
+        tile_info = source if isinstance(source, list) else find_tiles(Path(source), PREDICTION_SUFFIXES)
+        geometry = [_prediction_geometry(tile_path) for _, _, tile_path in tile_info]
+        height = max(y + size[0] for (_, y, _), size in zip(tile_info, geometry))
+        width = max(x + size[1] for (x, _, _), size in zip(tile_info, geometry))
+        channels = geometry[0][2]
+        tiles = ((x, y, lambda p=tile_path: load_prediction(p)) for x, y, tile_path in tile_info)
+        count = len(tile_info)
+    else:
+        store = TileStore(source)
+        if image is None:
+            image = store.images()[0]
+        entries = store.tiles(image)
+        height, width = store.image_size(image) or (max(e.y + e.height for e in entries),
+                                                    max(e.x + e.width for e in entries))
+        channels = entries[0].channels
+        tiles = ((e.x, e.y, lambda e=e: store.read_tile(e)) for e in entries)
+        count = len(entries)
+    
+    try:
+        with PredictionStitcher(height, width, channels, window, activation, memory_limit,
+                                scratch_dir) as stitcher:
+            for x, y, load in tiles:
+                pred = load()
+                with profile_step('stitch.add'):
+                    stitcher.add(x, y, pred)
+            
+            if probability_path is not None and channels == 1:
+                stitcher.result(out=np.lib.format.open_memmap(probability_path, mode='w+', dtype=np.float32,
+                                                              shape=(height, width)))
+            if channels > 1 or threshold is not None:
+                write_image(output_path, stitcher.result(threshold))
+            else:
+                # 8-bit probability map, computed strip by strip
+                out = np.empty((height, width), dtype=np.uint8)
+                for y0, y1, prob in stitcher.strips():
+                    out[y0:y1] = np.rint(prob * 255)
+                write_image(output_path, out)
+    finally:
+        if store is not None:
+            store.close()
+    return count
+
+def _stitch_task(task):
+    """Worker task: stitch one image"""
+    source, output_path, image, options = task
+    return stitch_image(source, output_path, image, **options)
+
+def stitch_predictions(pred_dir, output_dir, window='hann', threshold=None, activation=None, save_npy=False,
+                       workers=1, manifest=None, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None):
+    """
+    Stitch the prediction tiles of all images (step 4.3 of Plan.md)
+    
+    Prediction tiles are read from one subdirectory per image, named like
+    the split tiles ("<name>_tile_x{x}_y{y}.npy" or ".png"), and from tile
+    store files directly in pred_dir.
+    
+    Args:
+        pred_dir (str or Path): Directory containing the prediction tiles
+        output_dir (str or Path): Directory to save "<name>_stitched.png" to
+        window (str): Blending window, see blend_window
+        threshold (float): Optional probability threshold for binary masks
+        activation (str): None, 'sigmoid' or 'softmax' for logit tiles
+        save_npy (bool): Also save the float32 probabilities as "<name>_prob.npy"
+        workers (int): Number of worker processes (0 = all cores)
+        manifest (str, Path or Manifest): Optional incremental-rebuild manifest
+        memory_limit (int): Largest canvases in bytes kept in memory
+        scratch_dir (str or Path): Directory for canvas memmaps
+    
+    Returns:
+        tuple: (processed, errors) counts
+    """
+    pred_dir = Path(pred_dir)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest, own_manifest = open_manifest(manifest)
+    stage_params = {'window': window, 'threshold': threshold, 'activation': activation, 'save_npy': save_npy}
+    
+    # Collect the images to stitch: (inputs, outputs, task)
+    jobs = []
+    for img_dir in sorted(d for d in pred_dir.iterdir() if d.is_dir()):
+        tile_info = find_tiles(img_dir, PREDICTION_SUFFIXES)
+        if tile_info:
+            jobs.append((img_dir.name, [tile_path for _, _, tile_path in tile_info], tile_info, None))
+    for store_path in sorted(pred_dir.glob(f"*{TILE_STORE_SUFFIX}")):
+        with TileStore(store_path) as store:
+            images = [image for image in store.images() if store.tiles(image)]
+        jobs += [(image, [store_path], store_path, image) for image in images]
+    
+    print(f"Found {len(jobs)} images to stitch")
+    
+    tasks = []
+    records = {}
+    for name, inputs, source, image in jobs:
+        output_path = output_dir / f"{name}_stitched.png"
+        probability_path = output_dir / f"{name}_prob.npy" if save_npy else None
+        if manifest is not None and manifest.is_up_to_date(output_path, inputs, stage_params, STITCH_CODE_VERSION):
+            continue
+        options = {'window': window, 'threshold': threshold, 'activation': activation,
+                   'probability_path': probability_path, 'memory_limit': memory_limit, 'scratch_dir': scratch_dir}
+        records[output_path] = (inputs, [output_path] + ([probability_path] if save_npy else []))
+        tasks.append((source, output_path, image, options))
+    
+    if len(tasks) < len(jobs):
+        print(f"Skipping {len(jobs) - len(tasks)} up-to-date images")
+    
+    processed = 0
+    errors = 0
+    for i, (task, count, error) in enumerate(run_batch(_stitch_task, tasks, workers), 1):
+        output_path = task[1]
+        print(f"Stitching image {i}/{len(tasks)}: {output_path.name}")
+        if error is None:
+            processed += 1
+            print(f"  Stitched {count} tiles")
+            if manifest is not None:
+                inputs, outputs = records[output_path]
+                manifest.record(output_path, 'stitch', inputs, outputs, stage_params, STITCH_CODE_VERSION)
+        else:
+            errors += 1
+            print(f"  Error: {error}")
+    
+    if own_manifest:
+        manifest.close()
+    
+    print("\nStitching complete!")
+    print(f"Stitched images saved to: {output_dir}")
+    if errors > 0:
+        print(f"Errors encountered: {errors} images")
+    
+    return processed, errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stitch overlapping prediction tiles into full-size maps")
+    parser.add_argument('pred_dir', help="Directory of per-image prediction tile directories or tile stores")
+    parser.add_argument('output_dir')
+    parser.add_argument('--window', choices=WINDOWS, default='hann', help="Blending window (default hann)")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="Save a binary mask thresholded at this probability")
+    parser.add_argument('--activation', choices=('sigmoid', 'softmax'), default=None,
+                        help="Apply to logit tiles before blending")
+    parser.add_argument('--save-npy', action='store_true', help="Also save float32 probabilities as .npy")
+    parser.add_argument('--memory-limit', type=int, default=DEFAULT_MEMORY_LIMIT,
+                        help="Largest canvases in bytes kept in memory; larger ones use disk-backed memmaps")
+    parser.add_argument('--scratch-dir', default=None, help="Directory for canvas memmaps")
+    add_workers_argument(parser, opencv_threads=False)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    with profiling(args.profile):
+        stitch_predictions(args.pred_dir, args.output_dir, args.window, args.threshold, args.activation,
+                           args.save_npy, args.workers, args.manifest, args.memory_limit, args.scratch_dir)
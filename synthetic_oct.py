@@ -0,0 +1,115 @@
+import numpy as np
+from pathlib import Path
+import cv2
+
+def make_bscan(height=1024, width=1024, seed=0):
+    """
+    Generate a reproducible synthetic OCT-like B-scan.
+    
+    The image has a dark background, a handful of curved bright layers of
+    varying thickness and brightness, a few dark shadow columns and
+    multiplicative speckle noise.
+    
+    Args:
+        height (int): Image height in pixels
+        width (int): Image width in pixels
+        seed (int): Seed for the random generator
+    
+    Returns:
+        np.ndarray: 2-D uint8 image
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(width, dtype=np.float32)
+    y = np.arange(height, dtype=np.float32)[:, None]
+    
+    # Dark background with a slow vertical falloff
+    img = np.full((height, width), 20.0, dtype=np.float32)
+    img += 15.0 * (1.0 - y / max(height, 1))
+    
+    # Curved bright layers
+    n_layers = int(rng.integers(4, 8))
+    top = height * rng.uniform(0.15, 0.3)
+    for i in range(n_layers):
+        center = top + i * height * rng.uniform(0.05, 0.1)
+        amplitude = height * rng.uniform(0.01, 0.05)
+        period = width * rng.uniform(0.5, 2.0)
+        phase = rng.uniform(0, 2 * np.pi)
+        thickness = height * rng.uniform(0.005, 0.03)
+        brightness = rng.uniform(60, 200)
+        layer_y = center + amplitude * np.sin(2 * np.pi * x / period + phase)
+        img += brightness * np.exp(-0.5 * ((y - layer_y) / thickness) ** 2)
+    
+    # Dark shadow columns (e.g. behind vessels)
+    for _ in range(int(rng.integers(1, 4))):
+        cx = rng.uniform(0, width)
+        half_width = width * rng.uniform(0.005, 0.02)
+        depth = rng.uniform(0.3, 0.7)
+        img *= 1.0 - depth * np.exp(-0.5 * ((x - cx) / half_width) ** 2)
+    
+    # Multiplicative speckle noise
+    speckle = rng.gamma(shape=4.0, scale=0.25, size=(height, width)).astype(np.float32)
+    img *= speckle
+    
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+def make_annotation(height=1024, width=1024, seed=0, count=4):
+    """
+    Generate reproducible LabelMe-style shapes for a synthetic B-scan.
+    
+    Half of the shapes are polygons (blobs with a wavy outline), the others
+    linestrips running across the image like layer boundaries.
+    
+    Args:
+        height (int): Image height in pixels
+        width (int): Image width in pixels
+        seed (int): Seed for the random generator
+        count (int): Number of shapes
+    
+    Returns:
+        list: LabelMe shape dicts with 'label', 'points' and 'shape_type'
+    """
+    rng = np.random.default_rng(seed)
+    shapes = []
+    for i in range(count):
+        if i % 2 == 0:
+            cx, cy = rng.uniform(0.2, 0.8) * width, rng.uniform(0.2, 0.8) * height
+            radius = rng.uniform(0.05, 0.2) * min(height, width)
+            angles = np.linspace(0, 2 * np.pi, 24, endpoint=False)
+            r = radius * (1 + 0.2 * np.sin(3 * angles + rng.uniform(0, 2 * np.pi)))
+            points = np.stack([cx + r * np.cos(angles), cy + r * np.sin(angles)], axis=1)
+            shapes.append({'label': 'lesion', 'points': points.tolist(), 'shape_type': 'polygon'})
+        else:
+            xs = np.linspace(0, width - 1, 32)
+            ys = height * rng.uniform(0.2, 0.8) + height * 0.03 * np.sin(xs / width * 2 * np.pi * rng.uniform(0.5, 2))
+            points = np.stack([xs, ys], axis=1)
+            shapes.append({'label': 'layer', 'points': points.tolist(), 'shape_type': 'linestrip'})
+    return shapes
+
+def write_bscans(output_dir, count=4, height=1024, width=1024, seed=0):
+    """
+    Write a reproducible set of synthetic B-scans as PNG files.
+    
+    Args:
+        output_dir (str or Path): Directory to save the images
+        count (int): Number of images to generate
+        height (int): Image height in pixels
+        width (int): Image width in pixels
+        seed (int): Seed of the first image, the others use seed + i
+    
+    Returns:
+        list: List of paths to the generated images
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    paths = []
+    for i in range(count):
+        path = output_dir / f"synthetic_{height}x{width}_{seed + i}.png"
+        cv2.imwrite(str(path), make_bscan(height, width, seed + i))
+        paths.append(path)
+    
+    return paths
+
+if __name__ == "__main__":
+    paths = write_bscans("synthetic_bscans")
+    print(f"Generated {len(paths)} synthetic B-scans")
@@ -0,0 +1,273 @@
+import argparse
+import collections
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from batch_executor import add_workers_argument, run_batch
+from image_io import read_image, read_png_size, write_image
+from process_labelme import (load_labelme_json, create_mask, shape_bounds, tile_positions,
+                             LABELME_CODE_VERSION)
+
+# Decoded images and masks kept open per process
+DEFAULT_CACHE_BYTES = 2 << 30
+
+class _Source:
+    """Geometry and annotation bounding boxes of one annotated image, known without decoding it"""
+    def __init__(self, image_path, json_path, label_ids):
+        self.image_path = Path(image_path)
+        self.json_path = Path(json_path)
+        self.name = self.image_path.stem
+        data = load_labelme_json(json_path)
+        size = read_png_size(image_path)
+        if size is None:
+            size = (data['imageHeight'], data['imageWidth'])
+        self.height, self.width = size[:2]
+        self.bounds = shape_bounds(data['shapes'], label_ids)
+    
+    def cache_key(self, label_ids):
+        """Digest of everything the decoded arrays depend on"""
+        h = hashlib.sha1(LABELME_CODE_VERSION.encode())
+        for path in (self.image_path, self.json_path):
+            stat = path.stat()
+            h.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        h.update(repr(sorted(label_ids.items()) if label_ids else None).encode())
+        return h.hexdigest()[:12]
+
+def _decode(source, label_ids):
+    """Decode the image and rasterise its mask"""
+    image = read_image(source.image_path)
+    if image is None:
+        raise ValueError(f"Could not read image {source.image_path}")
+    shapes = load_labelme_json(source.json_path)['shapes']
+    return image, create_mask(shapes, (image.shape[1], image.shape[0]), label_ids)
+
+def _save_npy(path, array):
+    """Save atomically, so processes decoding the same image concurrently never see a partial file"""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+class TileSampler:
+    """
+    Lazy crop sampler over full annotated images
+    
+    Crops are cut on demand from the decoded images and their create_mask
+    masks, so the tile size, stride and sampling can change without
+    regenerating a dataset on disk. Decoded arrays are held in an LRU cache
+    capped at cache_bytes per process. With a cache_dir they are decoded
+    once into .npy files and memory-mapped: worker processes (e.g. those of
+    a training dataloader) then share the arrays through the page cache
+    instead of each holding a copy, and a pickled sampler carries no arrays.
+    
+    Two modes:
+      - 'grid': every position of the tile_positions grid with the given
+        stride, image by image
+      - 'random': uniformly placed crops, where a positive_fraction of them
+        is centred near a random annotation (annotation-weighted sampling)
+    
+    Args:
+        input_dir (str or Path): Directory of images with LabelMe JSON files
+        tile_size (int): Size of the square crops
+        stride (int): Grid stride (default tile_size, i.e. no overlap)
+        mode (str): 'random' or 'grid'
+        positive_fraction (float): Share of random crops placed on an annotation
+        seed (int): Seed of the random crops
+        cache_dir (str or Path): Directory for memory-mapped decoded arrays
+            (default: decode into process memory)
+        cache_bytes (int): Largest total size of cached arrays per process
+        labels (list): Class names for multi-class masks (IDs 1..N); None
+            for binary 0/255 masks
+    """
+    def __init__(self, input_dir, tile_size=512, stride=None, mode='random', positive_fraction=0.5, seed=0,
+                 cache_dir=None, cache_bytes=DEFAULT_CACHE_BYTES, labels=None):
+        if mode not in ('random', 'grid'):
+            raise ValueError(f"Unknown sampling mode: {mode}")
+        self.tile_size = tile_size
+        self.stride = stride or tile_size
+        self.mode = mode
+        self.positive_fraction = positive_fraction
+        self.seed = seed
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.cache_bytes = cache_bytes
+        self.label_ids = {label: i for i, label in enumerate(labels, 1)} if labels else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Images smaller than a crop cannot be sampled
+        pairs = [(png, png.with_suffix('.json')) for png in sorted(Path(input_dir).glob('*.png'))
+                 if png.with_suffix('.json').exists()]
+        sources = [_Source(png, json_file, self.label_ids) for png, json_file in pairs]
+        self.sources = [s for s in sources if s.height >= tile_size and s.width >= tile_size]
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+    
+    def __getstate__(self):
+        # Workers reopen (or map) the arrays themselves
+        return dict(self.__dict__, _cache=collections.OrderedDict(), _cached_bytes=0)
+    
+    def _cache_paths(self, source):
+        key = source.cache_key(self.label_ids)
+        return (self.cache_dir / f"{source.name}-{key}.image.npy",
+                self.cache_dir / f"{source.name}-{key}.mask.npy")
+    
+    def prepare(self, index):
+        """Decode source `index` into cache_dir unless it is there already"""
+        image_path, mask_path = self._cache_paths(self.sources[index])
+        if not (image_path.exists() and mask_path.exists()):
+            image, mask = _decode(self.sources[index], self.label_ids)
+            _save_npy(image_path, image)
+            _save_npy(mask_path, mask)
+    
+    def arrays(self, index):
+        """Return the (image, mask) of source `index`, through the LRU cache"""
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        
+        if self.cache_dir is None:
+            image, mask = _decode(self.sources[index], self.label_ids)
+        else:
+            self.prepare(index)
+            image_path, mask_path = self._cache_paths(self.sources[index])
+            image = np.load(image_path, mmap_mode='r')
+            mask = np.load(mask_path, mmap_mode='r')
+        
+        self._cache[index] = (image, mask)
+        self._cached_bytes += image.nbytes + mask.nbytes
+        # Evict the least recently used arrays, but always keep the current ones
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, (old_image, old_mask) = self._cache.popitem(last=False)
+            self._cached_bytes -= old_image.nbytes + old_mask.nbytes
+        return image, mask
+    
+    def crop(self, index, x, y):
+        """
+        Cut one crop
+        
+        Returns:
+            tuple: (image crop, mask crop, metadata dict with source, x, y);
+                the crops are views of the cached (possibly memory-mapped) arrays
+        """
+        image, mask = self.arrays(index)
+        t = self.tile_size
+        return image[y:y+t, x:x+t], mask[y:y+t, x:x+t], {'source': self.sources[index].name, 'x': x, 'y': y}
+    
+    def grid(self):
+        """List (source index, x, y) of every grid crop"""
+        return [(i, x, y) for i, source in enumerate(self.sources)
+                for x, y in tile_positions(source.height, source.width, self.tile_size,
+                                           self.tile_size - self.stride)]
+    
+    def _random_position(self, rng, weights, shape_sources):
+        t = self.tile_size
+        if len(shape_sources) and rng.random() < self.positive_fraction:
+            # Centre on a random point of a random annotation's bounding box
+            j = int(rng.integers(len(shape_sources)))
+            index, box = shape_sources[j]
+            source = self.sources[index]
+            px = rng.uniform(box[0], box[2])
+            py = rng.uniform(box[1], box[3])
+            x = int(np.clip(px - t / 2 + rng.uniform(-t / 4, t / 4), 0, source.width - t))
+            y = int(np.clip(py - t / 2 + rng.uniform(-t / 4, t / 4), 0, source.height - t))
+            return index, x, y
+        
+        # Uniform over the image area
+        index = int(rng.choice(len(self.sources), p=weights))
+        source = self.sources[index]
+        return index, int(rng.integers(source.width - t + 1)), int(rng.integers(source.height - t + 1))
+    
+    def crops(self, count=None, worker=0, num_workers=1):
+        """
+        Iterate over crops
+        
+        For use from several processes, give each its worker index and the
+        number of workers: grid crops are divided between them and random
+        crops get an independent seed per worker.
+        
+        Args:
+            count (int): Number of random crops (default: endless); grid
+                mode always yields each grid crop once
+            worker (int): Index of this worker
+            num_workers (int): Number of workers
+        
+        Yields:
+            tuple: (image crop, mask crop, metadata dict)
+        """
+        if not self.sources:
+            return
+        if self.mode == 'grid':
+            for index, x, y in self.grid()[worker::num_workers]:
+                yield self.crop(index, x, y)
+            return
+        
+        rng = np.random.default_rng([self.seed, worker])
+        areas = np.array([(s.height - self.tile_size + 1) * (s.width - self.tile_size + 1) for s in self.sources],
+                         dtype=np.float64)
+        weights = areas / areas.sum()
+        shape_sources = [(i, box) for i, source in enumerate(self.sources) for box in source.bounds]
+        n = 0
+        while count is None or n < count:
+            yield self.crop(*self._random_position(rng, weights, shape_sources))
+            n += 1
+    
+    def __iter__(self):
+        return self.crops()
+
+def _prepare_task(task):
+    """Worker task: decode one source into the sampler's cache directory"""
+    sampler, index = task
+    sampler.prepare(index)
+    return sampler.sources[index].name
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sample crops on the fly from LabelMe-annotated images")
+    parser.add_argument('input_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/concatenated_enhanced")
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--stride', type=int, default=None, help="Grid stride (default: the tile size)")
+    parser.add_argument('--mode', choices=('random', 'grid'), default='random')
+    parser.add_argument('--count', type=int, default=100, help="Number of random crops (default 100)")
+    parser.add_argument('--positive-fraction', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default=None, help="Directory for memory-mapped decoded arrays")
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES)
+    parser.add_argument('--labels', default=None,
+                        help="Comma-separated class names for multi-class masks (IDs 1, 2, ...)")
+    parser.add_argument('--output', default=None, help="Save the crops to images/ and masks/ in this directory")
+    add_workers_argument(parser, opencv_threads=False)
+    args = parser.parse_args()
+    
+    sampler = TileSampler(args.input_dir, args.tile_size, args.stride, args.mode, args.positive_fraction,
+                          args.seed, args.cache_dir, args.cache_bytes,
+                          args.labels.split(',') if args.labels else None)
+    print(f"Sampling from {len(sampler.sources)} images")
+    if sampler.cache_dir is not None:
+        # Fill the cache in parallel up front
+        tasks = [(sampler, i) for i in range(len(sampler.sources))]
+        for task, name, error in run_batch(_prepare_task, tasks, args.workers):
+            if error is not None:
+                print(f"Error decoding {sampler.sources[task[1]].name}: {error}")
+    
+    if args.output:
+        for sub in ('images', 'masks'):
+            (Path(args.output) / sub).mkdir(parents=True, exist_ok=True)
+    
+    start = time.perf_counter()
+    n = 0
+    positive = 0
+    for image, mask, meta in sampler.crops(args.count):
+        n += 1
+        positive += bool(mask.any())
+        if args.output:
+            name = f"{meta['source']}_x{meta['x']}_y{meta['y']}.png"
+            write_image(Path(args.output) / 'images' / name, image)
+            write_image(Path(args.output) / 'masks' / name, mask)
+    seconds = time.perf_counter() - start
+    print(f"{n} crops ({positive} with annotations) in {seconds:.2f} s ({n / max(seconds, 1e-9):.0f} crops/s)")
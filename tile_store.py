@@ -0,0 +1,289 @@
+import argparse
+import json
+import struct
+import zlib
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+from image_io import write_image
+from profiling import PROFILER, profile_step
+
+# File suffix of tile containers
+TILE_STORE_SUFFIX = ".tiles"
+
+# Fixed-size header: magic, format version, index offset, index length
+_MAGIC = b"OCTTILES"
+_VERSION = 1
+_HEADER = struct.Struct('<8sIQQ')
+_HEADER_SIZE = 32
+
+# One tile in the index; offset and size locate its chunk in the file
+TileEntry = namedtuple('TileEntry', 'image x y width height channels offset size codec')
+
+class TileStore:
+    """
+    Single-file container for the tiles of one or more images
+    
+    Replaces a directory of "<name>_tile_x{x}_y{y}.png" files. The file
+    starts with a 32-byte header (magic, format version, offset and length
+    of the index), followed by one chunk per tile and a JSON index that
+    lists every tile as (image, x, y, width, height, channels, offset,
+    size, codec) together with the full size of each image. Chunks hold the
+    tile pixels, zlib-compressed unless compress_level is 0.
+    
+    Reads go through a read-only memory map, so fetching a tile touches
+    only its own chunk; uncompressed tiles are returned as zero-copy views
+    of the map. Appending writes new chunks and a new index after the
+    existing data and rewrites the header last, so an interrupted append
+    leaves the previous contents readable. Writing a tile again at the same
+    position replaces it in the index.
+    
+    Args:
+        path (str or Path): Container file
+        mode (str): 'r' to read, 'w' to create (truncating) or 'a' to append
+            (creating the file if it does not exist)
+        compress_level (int): zlib level for new tiles (0 = uncompressed)
+    """
+    def __init__(self, path, mode='r', compress_level=1):
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError(f"Invalid mode {mode!r}, expected 'r', 'w' or 'a'")
+        self.path = Path(path)
+        self.mode = mode
+        self.compress_level = compress_level
+        self._sizes = {}
+        self._entries = {}
+        self._map = None
+        self._file = None
+        self._dirty = False
+        
+        if mode == 'a' and not self.path.exists():
+            mode = 'w'
+        if mode == 'w':
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'w+b')
+            self._file.write(b'\0' * _HEADER_SIZE)
+            self._end = _HEADER_SIZE
+            self._dirty = True
+        else:
+            self._load()
+            if mode == 'a':
+                self._file = open(self.path, 'r+b')
+                self._end = self._file.seek(0, 2)
+    
+    def _load(self):
+        """Read the header and the index"""
+        with open(self.path, 'rb') as f:
+            magic, version, index_offset, index_size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"Not a tile store: {self.path}")
+            if version != _VERSION:
+                raise ValueError(f"Unsupported tile store version {version}: {self.path}")
+            f.seek(index_offset)
+            index = json.loads(f.read(index_size).decode('utf-8'))
+        self._sizes = {name: tuple(size) for name, size in index['images'].items()}
+        for record in index['tiles']:
+            entry = TileEntry(*record)
+            self._entries[(entry.image, entry.x, entry.y)] = entry
+    
+    def _buffer(self):
+        """Return the memory map of the file, remapping it after writes"""
+        if self._map is None:
+            if self._file is not None:
+                self._file.flush()
+            self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+        return self._map
+    
+    def _write_chunk(self, image, x, y, height, width, channels, data, codec):
+        """Append one chunk and add it to the index"""
+        if self._file is None:
+            raise ValueError(f"Tile store opened read-only: {self.path}")
+        self._file.seek(self._end)
+        self._file.write(data)
+        entry = TileEntry(image, int(x), int(y), int(width), int(height), int(channels),
+                          self._end, len(data), codec)
+        self._end += len(data)
+        self._entries[(image, entry.x, entry.y)] = entry
+        self._map = None
+        self._dirty = True
+        return entry
+    
+    def write_tile(self, image, x, y, tile):
+        """
+        Add a tile
+        
+        Args:
+            image (str): Name of the image the tile belongs to
+            x (int): Left edge of the tile in the image
+            y (int): Top edge of the tile in the image
+            tile (np.ndarray): 2-D or 3-D uint8 tile
+        
+        Returns:
+            TileEntry: Index entry of the tile
+        """
+        tile = np.ascontiguousarray(tile, dtype=np.uint8)
+        if tile.ndim not in (2, 3):
+            raise ValueError(f"Expected a 2-D or 3-D tile, got shape {tile.shape}")
+        channels = tile.shape[2] if tile.ndim == 3 else 1
+        with profile_step('tile_store.write'):
+            if self.compress_level:
+                data, codec = zlib.compress(tile.data, self.compress_level), 'zlib'
+            else:
+                data, codec = tile.tobytes(), 'raw'
+            PROFILER.add_bytes(written=len(data))
+            return self._write_chunk(image, x, y, tile.shape[0], tile.shape[1], channels, data, codec)
+    
+    def set_image_size(self, image, height, width):
+        """Record the full size of an image, used when reassembling it"""
+        if self._file is None:
+            raise ValueError(f"Tile store opened read-only: {self.path}")
+        self._sizes[image] = (int(height), int(width))
+        self._dirty = True
+    
+    def image_size(self, image):
+        """Return the recorded (height, width) of an image, or None"""
+        return self._sizes.get(image)
+    
+    def images(self):
+        """Return the names of the images in the store"""
+        names = dict.fromkeys(self._sizes)
+        names.update(dict.fromkeys(entry.image for entry in self._entries.values()))
+        return list(names)
+    
+    def tiles(self, image=None):
+        """Return the index entries of all tiles, or of the tiles of one image"""
+        return [entry for entry in self._entries.values() if image is None or entry.image == image]
+    
+    def find(self, image, x, y):
+        """Return the entry of the tile at (x, y) of an image, or None"""
+        return self._entries.get((image, x, y))
+    
+    def read_tile(self, entry):
+        """
+        Read a tile
+        
+        Args:
+            entry (TileEntry): Index entry from tiles() or find()
+        
+        Returns:
+            np.ndarray: The tile; uncompressed tiles are read-only views of
+                the memory-mapped file
+        """
+        with profile_step('tile_store.read'):
+            data = self._buffer()[entry.offset:entry.offset + entry.size]
+            PROFILER.add_bytes(read=entry.size)
+            if entry.codec == 'zlib':
+                data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+            elif entry.codec != 'raw':
+                raise ValueError(f"Unknown tile codec {entry.codec!r} in {self.path}")
+        shape = (entry.height, entry.width) + ((entry.channels,) if entry.channels > 1 else ())
+        return np.asarray(data).reshape(shape)
+    
+    def copy_from(self, other, image=None):
+        """
+        Append the tiles of another store without recompressing them
+        
+        Args:
+            other (TileStore): Store to copy from
+            image (str): Only copy this image (default: all images)
+        """
+        buffer = other._buffer()
+        for entry in other.tiles(image):
+            self._write_chunk(entry.image, entry.x, entry.y, entry.height, entry.width, entry.channels,
+                              buffer[entry.offset:entry.offset + entry.size].tobytes(), entry.codec)
+        for name in ([image] if image is not None else other.images()):
+            size = other.image_size(name)
+            if size is not None:
+                self.set_image_size(name, *size)
+    
+    def flush(self):
+        """Write the index and header, making everything written so far readable"""
+        if self._file is None or not self._dirty:
+            return
+        index = {
+            'images': {name: list(size) for name, size in self._sizes.items()},
+            'tiles': [list(entry) for entry in self._entries.values()],
+        }
+        data = json.dumps(index, separators=(',', ':')).encode('utf-8')
+        index_offset = self._end
+        self._file.seek(index_offset)
+        self._file.write(data)
+        self._file.flush()
+        # The new index is complete before the header points to it
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, index_offset, len(data)))
+        self._file.flush()
+        # Later chunks go after the index, which stays valid until the next flush
+        self._end = index_offset + len(data)
+        self._map = None
+        self._dirty = False
+    
+    def close(self):
+        """Flush pending writes and close the file"""
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+        self._map = None
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def export_tiles(store_path, output_dir):
+    """
+    Write the tiles of a store as PNG files in the split_image layout
+    ("<output_dir>/<image>/<image>_tile_x{x}_y{y}.png")
+    
+    Returns:
+        int: Number of tiles written
+    """
+    output_dir = Path(output_dir)
+    count = 0
+    with TileStore(store_path) as store:
+        for entry in store.tiles():
+            image_dir = output_dir / entry.image
+            image_dir.mkdir(parents=True, exist_ok=True)
+            write_image(image_dir / f"{entry.image}_tile_x{entry.x}_y{entry.y}.png", store.read_tile(entry))
+            count += 1
+    return count
+
+def merge_stores(output_path, store_paths):
+    """Append the tiles of several stores to one (e.g. a per-dataset store)"""
+    with TileStore(output_path, 'a') as output:
+        for store_path in store_paths:
+            with TileStore(store_path) as store:
+                output.copy_from(store)
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, export and merge tile stores")
+    commands = parser.add_subparsers(dest='command', required=True)
+    info_parser = commands.add_parser('info', help="List the images and tiles in stores")
+    info_parser.add_argument('stores', nargs='+')
+    export_parser = commands.add_parser('export', help="Write the tiles of a store as PNG files")
+    export_parser.add_argument('store')
+    export_parser.add_argument('output_dir')
+    merge_parser = commands.add_parser('merge', help="Append stores to one store")
+    merge_parser.add_argument('output')
+    merge_parser.add_argument('stores', nargs='+')
+    args = parser.parse_args()
+    
+    if args.command == 'info':
+        for store_path in args.stores:
+            with TileStore(store_path) as store:
+                print(f"{store_path}: {len(store.images())} images, {len(store)} tiles")
+                for image in store.images():
+                    size = store.image_size(image)
+                    size_text = f"{size[1]}x{size[0]}" if size else "unknown size"
+                    print(f"  {image}: {len(store.tiles(image))} tiles, {size_text}")
+    elif args.command == 'export':
+        count = export_tiles(args.store, args.output_dir)
+        print(f"Exported {count} tiles to {args.output_dir}")
+    else:
+        merge_stores(args.output, args.stores)
+        print(f"Merged {len(args.stores)} stores into {args.output}")
@@ -0,0 +1,286 @@
+import argparse
+import tempfile
+import cv2
+import numpy as np
+from pathlib import Path
+from enhance_image import (enhancement_params, add_params_argument, parse_params, _normalize_lut,
+                           _stretch_lut, _gamma_lut, _stage_bilateral, _stage_region_boost,
+                           _stage_sharpen, _stage_final_bilateral, ENHANCE_CODE_VERSION)
+from manifest import code_version
+from image_io import read_image, write_image
+
+# Version of the tiled engine, recorded in incremental-rebuild manifests
+TILED_CODE_VERSION = code_version(__file__, depends=(ENHANCE_CODE_VERSION,))
+
+# The tiled engine reproduces enhance_array exactly while only holding a few
+# tile-sized buffers:
+#   pass 1  global min/max of the source and the CLAHE histograms of the
+#           normalised image
+#   pass 2  steps 2-6 per tile (with a halo for the bilateral filter and the
+#           mask dilation), accumulating the second-CLAHE histograms
+#   pass 3  second CLAHE per tile, accumulating the global histogram that
+#           gives the stretch percentiles
+#   pass 4  steps 7-10 per tile with a halo for the unsharp mask and the
+#           final bilateral filter, written into the output
+# CLAHE is computed globally by re-implementing OpenCV's per-grid-cell
+# lookup tables and bilinear interpolation, which makes it a point-wise
+# operation once the tables are known.
+
+def _bilateral_radius(d, sigma_space):
+    """Neighbourhood radius used by cv2.bilateralFilter"""
+    if d <= 0:
+        return int(round(sigma_space * 1.5))
+    return d // 2
+
+def _gaussian_radius(sigma):
+    """Kernel radius cv2.GaussianBlur derives from sigma for uint8 images"""
+    ksize = int(round(sigma * 3 * 2 + 1)) | 1
+    return ksize // 2
+
+def halo_sizes(params=None):
+    """
+    Halo widths the tiled engine needs
+    
+    Returns:
+        tuple: (halo for steps 2-6, halo for steps 7-10)
+    """
+    params = enhancement_params(params)
+    boost_halo = _bilateral_radius(params['bilateral_d'], params['bilateral_sigma']) + params['dilate_size'] // 2
+    output_halo = _gaussian_radius(params['blur_sigma']) + _bilateral_radius(params['final_d'], params['final_sigma'])
+    return boost_halo, output_halo
+
+class _ClaheGrid:
+    """
+    Global CLAHE for an h x w image, built from streamed blocks
+    
+    Mirrors cv2.CLAHE: when the image size is not a multiple of the grid,
+    the histogram image is padded at the bottom and right with
+    BORDER_REFLECT_101 (by a whole grid step in a dimension that already
+    divides, as OpenCV does), each grid cell histogram is clipped and
+    redistributed, and pixels are mapped by bilinear interpolation between
+    the lookup tables of the four nearest cells, in float32 arithmetic.
+    """
+    def __init__(self, h, w, clip_limit, grid):
+        self.h, self.w, self.grid = h, w, grid
+        self.clip_limit = clip_limit
+        if w % grid == 0 and h % grid == 0:
+            self.ext_h, self.ext_w = h, w
+        else:
+            self.ext_h = h + grid - h % grid
+            self.ext_w = w + grid - w % grid
+        self.cell_h = self.ext_h // grid
+        self.cell_w = self.ext_w // grid
+        self.hist = np.zeros(grid * grid * 256, dtype=np.int64)
+        self.luts = None
+    
+    def _variants(self, start, stop, n, ext_n, cell):
+        """
+        (selection, cell index) pairs for the source indices start..stop-1:
+        the direct position and, for indices reflected into the padding,
+        the mirrored one
+        """
+        idx = np.arange(start, stop)
+        variants = [(slice(None), idx // cell)]
+        mirrored = 2 * (n - 1) - idx
+        sel = (mirrored >= n) & (mirrored < ext_n)
+        if sel.any():
+            variants.append((sel, mirrored[sel] // cell))
+        return variants
+    
+    def accumulate(self, block, y0, x0):
+        """Add a block of the source image with top-left corner (x0, y0)"""
+        bh, bw = block.shape
+        for rsel, rcell in self._variants(y0, y0 + bh, self.h, self.ext_h, self.cell_h):
+            for csel, ccell in self._variants(x0, x0 + bw, self.w, self.ext_w, self.cell_w):
+                sub = block[rsel][:, csel]
+                cells = rcell[:, None] * self.grid + ccell[None, :]
+                self.hist += np.bincount((cells * 256 + sub).ravel(), minlength=self.hist.size)
+    
+    def finish(self):
+        """Turn the accumulated histograms into per-cell lookup tables"""
+        hist = self.hist.reshape(self.grid * self.grid, 256).copy()
+        area = self.cell_h * self.cell_w
+        if self.clip_limit > 0:
+            limit = max(int(self.clip_limit * area / 256), 1)
+            clipped = np.maximum(hist - limit, 0).sum(axis=1)
+            np.minimum(hist, limit, out=hist)
+            batch = clipped // 256
+            hist += batch[:, None]
+            for cell, residual in enumerate(clipped - batch * 256):
+                if residual:
+                    step = max(256 // int(residual), 1)
+                    hist[cell, np.arange(0, 256, step)[:residual]] += 1
+        scale = np.float32(255) / np.float32(area)
+        cdf = np.cumsum(hist, axis=1).astype(np.float32) * scale
+        self.luts = np.clip(np.rint(cdf), 0, 255).astype(np.uint8).ravel()
+        self.hist = None
+    
+    def _axis(self, start, stop, cell, n_cells):
+        pos = np.arange(start, stop, dtype=np.float32) * (np.float32(1) / np.float32(cell)) - np.float32(0.5)
+        i1 = np.floor(pos)
+        frac = (pos - i1).astype(np.float32)
+        i1 = i1.astype(np.intp)
+        return np.maximum(i1, 0), np.minimum(i1 + 1, n_cells - 1), frac, np.float32(1) - frac
+    
+    def apply(self, block, y0, x0):
+        """Apply the global CLAHE to a block with top-left corner (x0, y0)"""
+        bh, bw = block.shape
+        tx1, tx2, xa, xa1 = self._axis(x0, x0 + bw, self.cell_w, self.grid)
+        ty1, ty2, ya, ya1 = self._axis(y0, y0 + bh, self.cell_h, self.grid)
+        row1 = (ty1 * self.grid)[:, None]
+        row2 = (ty2 * self.grid)[:, None]
+        value = block.astype(np.intp)
+        lut = self.luts
+        top = lut[(row1 + tx1) * 256 + value] * xa1 + lut[(row1 + tx2) * 256 + value] * xa
+        bottom = lut[(row2 + tx1) * 256 + value] * xa1 + lut[(row2 + tx2) * 256 + value] * xa
+        res = top * ya1[:, None] + bottom * ya[:, None]
+        return np.clip(np.rint(res), 0, 255).astype(np.uint8)
+
+def _tiles(h, w, tile_size):
+    """Yield the (y0, y1, x0, x1) core boxes of a plain tile grid"""
+    for y0 in range(0, h, tile_size):
+        for x0 in range(0, w, tile_size):
+            yield y0, min(y0 + tile_size, h), x0, min(x0 + tile_size, w)
+
+# Smallest block handed to the OpenCV filters: their code paths for tiny
+# images do not always round like the ones used on large images
+_MIN_BLOCK = 64
+
+def _grow(start, stop, halo, n):
+    """Grow the range start..stop by halo on both sides and to at least _MIN_BLOCK, within 0..n"""
+    start, stop = max(0, start - halo), min(n, stop + halo)
+    missing = _MIN_BLOCK - (stop - start)
+    if missing > 0:
+        start = max(0, start - missing)
+        stop = min(n, start + _MIN_BLOCK)
+    return start, stop
+
+def _with_halo(y0, y1, x0, x1, halo, h, w):
+    """Grow a box by halo pixels, clipped to the image"""
+    hy0, hy1 = _grow(y0, y1, halo, h)
+    hx0, hx1 = _grow(x0, x1, halo, w)
+    return hy0, hy1, hx0, hx1
+
+class _TiledEnhancer:
+    """State shared by the passes of enhance_tiled for one image"""
+    def __init__(self, img, params):
+        self.img = img
+        self.params = params
+        self.h, self.w = img.shape
+        self.boost_halo, self.output_halo = halo_sizes(params)
+        self.norm_lut = None
+        self.gamma_lut = _gamma_lut(params['gamma'])
+        grid = params['tile_grid_size']
+        self.clahe1 = _ClaheGrid(self.h, self.w, params['clip_limit'], grid)
+        self.clahe2 = _ClaheGrid(self.h, self.w, params['second_clip_limit'], grid)
+    
+    def combined(self, y0, y1, x0, x1):
+        """Output of steps 1-6 on a box, computed from a haloed source block"""
+        hy0, hy1, hx0, hx1 = _with_halo(y0, y1, x0, x1, self.boost_halo, self.h, self.w)
+        block = cv2.LUT(np.ascontiguousarray(self.img[hy0:hy1, hx0:hx1]), self.norm_lut)
+        block = self.clahe1.apply(block, hy0, hx0)
+        block = cv2.LUT(block, self.gamma_lut)
+        block = _stage_bilateral(block, self.params)
+        block = _stage_region_boost(block, self.params)
+        return block[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+def enhance_tiled(img, tile_size=1024, params=None, out=None, spill=True, scratch_dir=None):
+    """
+    Enhance an image tile by tile, pixel-identical to enhance_array
+    
+    Every spatial filter sees a halo around its tile and CLAHE and the
+    stretch percentiles are computed over the whole image, so there are no
+    seams. Apart from the source and output arrays (which may be np.memmap),
+    memory use scales with tile_size rather than image size.
+    
+    Args:
+        img (np.ndarray): 2-D uint8 image, may be a np.memmap
+        tile_size (int): Core size of the processing tiles
+        params (dict): Overrides for the enhancement parameters
+        out (np.ndarray): Optional preallocated output, may be a np.memmap
+        spill (bool): Keep the step-6 result in a disk-backed scratch memmap
+            instead of recomputing it in passes 3 and 4
+        scratch_dir (str or Path): Directory for the scratch file
+    
+    Returns:
+        np.ndarray: The enhanced image
+    """
+    params = enhancement_params(params)
+    h, w = img.shape
+    if out is None:
+        out = np.empty((h, w), dtype=np.uint8)
+    engine = _TiledEnhancer(img, params)
+    tiles = list(_tiles(h, w, tile_size))
+    
+    # Pass 1: global min/max, then the first CLAHE histograms
+    min_val, max_val = 255, 0
+    for y0, y1, x0, x1 in tiles:
+        block_min, block_max = cv2.minMaxLoc(np.ascontiguousarray(img[y0:y1, x0:x1]))[:2]
+        min_val, max_val = min(min_val, block_min), max(max_val, block_max)
+    engine.norm_lut = _normalize_lut(min_val, max_val)
+    for y0, y1, x0, x1 in tiles:
+        engine.clahe1.accumulate(cv2.LUT(np.ascontiguousarray(img[y0:y1, x0:x1]), engine.norm_lut), y0, x0)
+    engine.clahe1.finish()
+    
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        scratch = np.memmap(Path(tmp) / 'combined.u8', dtype=np.uint8, mode='w+', shape=(h, w)) if spill else None
+        
+        def combined(y0, y1, x0, x1):
+            if scratch is not None:
+                return np.asarray(scratch[y0:y1, x0:x1])
+            return engine.combined(y0, y1, x0, x1)
+        
+        # Pass 2: steps 1-6 and the second CLAHE histograms
+        for y0, y1, x0, x1 in tiles:
+            block = engine.combined(y0, y1, x0, x1)
+            if scratch is not None:
+                scratch[y0:y1, x0:x1] = block
+            engine.clahe2.accumulate(block, y0, x0)
+        engine.clahe2.finish()
+        
+        # Pass 3: global histogram of the second CLAHE for the percentiles
+        hist = np.zeros(256, dtype=np.int64)
+        for y0, y1, x0, x1 in tiles:
+            hist += np.bincount(engine.clahe2.apply(combined(y0, y1, x0, x1), y0, x0).ravel(), minlength=256)
+        stretch_lut = _stretch_lut(np.cumsum(hist), params)
+        
+        # Pass 4: steps 7-10 with a halo, written into the output
+        for y0, y1, x0, x1 in tiles:
+            hy0, hy1, hx0, hx1 = _with_halo(y0, y1, x0, x1, engine.output_halo, h, w)
+            block = engine.clahe2.apply(combined(hy0, hy1, hx0, hx1), hy0, hx0)
+            block = cv2.LUT(block, stretch_lut)
+            block = _stage_sharpen(block, params)
+            block = _stage_final_bilateral(block, params)
+            out[y0:y1, x0:x1] = block[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+        
+        if scratch is not None:
+            del scratch
+    
+    return out
+
+def enhance_image_tiled(image_path, output_path, tile_size=1024, params=None):
+    """
+    Enhance an image file with the tiled engine
+    
+    Args:
+        image_path (str or Path): Path to the image to enhance
+        output_path (str or Path): Path to save the enhanced image
+        tile_size (int): Core size of the processing tiles
+        params (dict): Overrides for the enhancement parameters
+    """
+    img = read_image(image_path, grayscale=True)
+    if img is None:
+        raise ValueError(f"Could not read the image: {image_path}")
+    
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    write_image(output_path, enhance_tiled(img, tile_size, params))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seam-free tiled enhancement of a single image")
+    parser.add_argument('image_path')
+    parser.add_argument('output_path')
+    parser.add_argument('--tile-size', type=int, default=1024)
+    add_params_argument(parser)
+    args = parser.parse_args()
+    
+    enhance_image_tiled(args.image_path, args.output_path, args.tile_size, parse_params(args.param))
@@ -0,0 +1,103 @@
+import argparse
+import sys
+import cv2
+import numpy as np
+from pathlib import Path
+from enhance_image import enhance_array, enhance_array_reference
+from synthetic_oct import make_bscan
+
+# Shapes of the generated regression inputs, including degenerate ones
+SYNTHETIC_SHAPES = [(1, 1), (5, 700), (64, 64), (300, 517), (512, 512), (1024, 1024), (1024, 2048)]
+
+def synthetic_cases(seeds=3):
+    """
+    Yield (name, image) pairs covering typical and edge-case inputs:
+    synthetic B-scans of several shapes, low-contrast variants and
+    constant images.
+    """
+    for h, w in SYNTHETIC_SHAPES:
+        for seed in range(seeds):
+            img = make_bscan(h, w, seed)
+            yield f"bscan_{h}x{w}_{seed}", img
+            yield f"lowcontrast_{h}x{w}_{seed}", (img // 4 + 100).astype(np.uint8)
+    for value in (0, 1, 128, 254, 255):
+        yield f"constant_{value}", np.full((64, 96), value, dtype=np.uint8)
+
+def image_cases(image_dir):
+    """Yield (name, image) pairs for every image in a directory"""
+    for path in sorted(Path(image_dir).iterdir()):
+        if path.suffix.lower() in ('.jpg', '.jpeg', '.png', '.tiff', '.bmp'):
+            img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                yield path.stem, img
+
+def compare(cases):
+    """
+    Compare enhance_array against enhance_array_reference
+    
+    Returns:
+        list: Names of the cases whose outputs differ
+    """
+    failures = []
+    for name, img in cases:
+        expected = enhance_array_reference(img)
+        actual = enhance_array(img)
+        if actual.shape != expected.shape or not np.array_equal(actual, expected):
+            diff = int(np.count_nonzero(actual != expected)) if actual.shape == expected.shape else -1
+            print(f"MISMATCH {name}: {diff} pixels differ")
+            failures.append(name)
+    return failures
+
+def write_golden(cases, golden_dir):
+    """
+    Save every input and its reference output as PNG golden images
+    """
+    golden_dir = Path(golden_dir)
+    (golden_dir / 'input').mkdir(parents=True, exist_ok=True)
+    (golden_dir / 'expected').mkdir(parents=True, exist_ok=True)
+    count = 0
+    for name, img in cases:
+        cv2.imwrite(str(golden_dir / 'input' / f"{name}.png"), img)
+        cv2.imwrite(str(golden_dir / 'expected' / f"{name}.png"), enhance_array_reference(img))
+        count += 1
+    print(f"Wrote {count} golden images to {golden_dir}")
+
+def check_golden(golden_dir):
+    """
+    Check enhance_array against previously written golden images
+    
+    Returns:
+        list: Names of the golden images that do not match
+    """
+    golden_dir = Path(golden_dir)
+    failures = []
+    for input_path in sorted((golden_dir / 'input').glob('*.png')):
+        img = cv2.imread(str(input_path), cv2.IMREAD_GRAYSCALE)
+        expected = cv2.imread(str(golden_dir / 'expected' / input_path.name), cv2.IMREAD_GRAYSCALE)
+        if expected is None or not np.array_equal(enhance_array(img), expected):
+            print(f"MISMATCH {input_path.stem}")
+            failures.append(input_path.stem)
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bit-exact regression check of the fast enhancement engine")
+    parser.add_argument('--images', help="Also compare on every image in this directory")
+    parser.add_argument('--write-golden', metavar='DIR', help="Write golden inputs/outputs from the reference implementation")
+    parser.add_argument('--check-golden', metavar='DIR', help="Check the fast engine against golden images in DIR")
+    args = parser.parse_args()
+    
+    if args.write_golden:
+        write_golden(synthetic_cases(), args.write_golden)
+        sys.exit(0)
+    
+    if args.check_golden:
+        failures = check_golden(args.check_golden)
+    else:
+        failures = compare(synthetic_cases())
+        if args.images:
+            failures += compare(image_cases(args.images))
+    
+    if failures:
+        print(f"\n{len(failures)} case(s) differ from the reference")
+        sys.exit(1)
+    print("\nAll cases are pixel-identical to the reference")
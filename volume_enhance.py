@@ -0,0 +1,236 @@
+import argparse
+import functools
+from pathlib import Path
+import cv2
+import numpy as np
+from enhance_image import (enhancement_params, add_params_argument, parse_params, _boost_lut, _gamma_lut, _get_clahe,
+                           _mid_lut, _normalize_lut, _stretch_lut)
+from image_io import list_images, read_image, read_png_size, write_image
+from profiling import add_profile_argument, profile_step, profiling
+
+TIFF_SUFFIXES = ('.tif', '.tiff')
+
+def load_volume(source):
+    """
+    Load a stack of B-scans into one (N, H, W) uint8 array
+    
+    Args:
+        source (str or Path): Directory of frames (sorted by name) or a
+            multi-page TIFF file
+    
+    Returns:
+        tuple: (volume, frame names)
+    """
+    source = Path(source)
+    if source.suffix.lower() in TIFF_SUFFIXES:
+        with profile_step('imread'):
+            ok, pages = cv2.imreadmulti(str(source), flags=cv2.IMREAD_GRAYSCALE)
+        if not ok or not pages:
+            raise ValueError(f"Could not read the stack: {source}")
+        if len({page.shape for page in pages}) > 1:
+            raise ValueError(f"Pages of different sizes in {source}")
+        return np.stack(pages), [f"{source.stem}_{i:04d}" for i in range(len(pages))]
+    
+    paths = list_images(source)
+    if not paths:
+        raise ValueError(f"No frames found in {source}")
+    # Allocate the stack from the first header, then decode the frames straight into it
+    size = read_png_size(paths[0])
+    volume = None if size is None else np.empty((len(paths),) + size[:2], dtype=np.uint8)
+    for i, path in enumerate(paths):
+        frame = read_image(path, grayscale=True)
+        if frame is None:
+            raise ValueError(f"Could not read the frame: {path}")
+        if volume is None:
+            volume = np.empty((len(paths),) + frame.shape, dtype=np.uint8)
+        if frame.shape != volume.shape[1:]:
+            raise ValueError(f"Frame {path} is {frame.shape}, not {volume.shape[1:]} like the others")
+        volume[i] = frame
+    return volume, [path.stem for path in paths]
+
+def save_volume(volume, output, names=None):
+    """
+    Save a stack as a multi-page TIFF (output ends in .tif/.tiff) or as one
+    PNG per frame in the output directory
+    
+    Returns:
+        list: Paths of the files written
+    """
+    output = Path(output)
+    if output.suffix.lower() in TIFF_SUFFIXES:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with profile_step('imwrite'):
+            if not cv2.imwritemulti(str(output), list(volume)):
+                raise ValueError(f"Could not write the stack: {output}")
+        return [output]
+    output.mkdir(parents=True, exist_ok=True)
+    names = names or [f"frame_{i:04d}" for i in range(len(volume))]
+    paths = [output / f"{name}.png" for name in names]
+    for frame, path in zip(volume, paths):
+        write_image(path, frame)
+    return paths
+
+def _windowed(values, window, reduce):
+    """
+    Pool per-frame statistics over neighbouring frames
+    
+    Args:
+        values (np.ndarray): One statistic (or histogram) per frame, first axis = frames
+        window (int): None = per frame, 0 = whole volume, k = frames i-k..i+k
+        reduce (callable): Pooling function taking an array and axis=0
+    """
+    if window is None:
+        return values
+    if window == 0:
+        return np.repeat(reduce(values, axis=0)[None], len(values), axis=0)
+    return np.stack([reduce(values[max(0, i - window):i + window + 1], axis=0) for i in range(len(values))])
+
+@functools.lru_cache(maxsize=8)
+def _kernel(size):
+    return np.ones((size, size), np.uint8)
+
+def _flat(volume):
+    """View a contiguous (N, H, W) stack as one (N*H, W) image for point-wise operations"""
+    return volume.reshape(-1, volume.shape[2])
+
+def _per_frame_luts(volume, luts):
+    """Apply one lookup table per frame, or a single table to the whole stack"""
+    if len(luts) and all(lut is luts[0] for lut in luts):
+        return cv2.LUT(_flat(volume), luts[0]).reshape(volume.shape)
+    out = np.empty_like(volume)
+    for i, lut in enumerate(luts):
+        out[i] = cv2.LUT(volume[i], lut)
+    return out
+
+def _per_frame(volume, func):
+    """Apply a spatial filter frame by frame; func(frame, dst) writes into the output frame"""
+    out = np.empty_like(volume)
+    for i in range(len(volume)):
+        func(volume[i], out[i])
+    return out
+
+def enhance_volume(volume, params=None, stats_window=None):
+    """
+    Enhance a stack of B-scans
+    
+    Runs the steps of enhance_array on the whole stack: point-wise steps
+    (lookup tables, region boosts, unsharp weighting) as single operations
+    over the (N*H, W) view of the stack, spatial filters (CLAHE, bilateral,
+    erosion/dilation, blur) frame by frame with their objects and kernels
+    created once. With stats_window=None every frame is normalised and
+    stretched with its own statistics and the result equals enhance_array
+    frame by frame. Otherwise the min/max of the normalisation and the
+    stretch percentiles are pooled over neighbouring frames (0 = the whole
+    volume), so brightness does not flicker between frames.
+    
+    Batching saves little time: the bilateral filters and CLAHE are
+    per-pixel work and dominate, and the per-call overhead shared between
+    frames is small. Measured on one core against enhance_array frame by
+    frame: 1.0x for 12 frames of 256x384, 1.05x for 64 of 128x128 and 1.5x
+    for 200 of 64x64. Stacking the frames into one tall image for the
+    spatial filters (with mirrored rows between them) gives the same result
+    but was no faster. The volume mode is for treating a stack as a unit:
+    one load and save, and statistics pooled across frames.
+    
+    Args:
+        volume (np.ndarray): (N, H, W) uint8 stack
+        params (dict): Overrides for the enhancement parameters
+        stats_window (int): None, 0 or a number of neighbouring frames
+    
+    Returns:
+        np.ndarray: The enhanced (N, H, W) stack
+    """
+    params = enhancement_params(params)
+    volume = np.ascontiguousarray(volume)
+    grid = (params['tile_grid_size'], params['tile_grid_size'])
+    with profile_step('enhance_volume'):
+        # Step 1: contrast normalization
+        with profile_step('volume.normalize'):
+            flat_frames = volume.reshape(len(volume), -1)
+            mins = _windowed(flat_frames.min(axis=1), stats_window, np.min)
+            maxs = _windowed(flat_frames.max(axis=1), stats_window, np.max)
+            luts = [_normalize_lut(lo, hi) for lo, hi in zip(mins, maxs)]
+            if stats_window == 0:
+                luts = [luts[0]] * len(luts)
+            vol = _per_frame_luts(volume, luts)
+        
+        # Step 2: CLAHE
+        with profile_step('volume.clahe'):
+            vol = _per_frame(vol, _get_clahe(params['clip_limit'], grid).apply)
+        
+        # Step 3: gamma correction
+        with profile_step('volume.gamma'):
+            vol = cv2.LUT(_flat(vol), _gamma_lut(params['gamma'])).reshape(vol.shape)
+        
+        # Step 4: bilateral filter
+        with profile_step('volume.bilateral'):
+            d, sigma = params['bilateral_d'], params['bilateral_sigma']
+            vol = _per_frame(vol, lambda frame, dst: cv2.bilateralFilter(frame, d, sigma, sigma, dst))
+        
+        # Steps 5-6: region masks and boosts
+        with profile_step('volume.region_boost'):
+            kernel = _kernel(params['dilate_size'])
+            eroded = _per_frame(vol, lambda frame, dst: cv2.erode(frame, kernel, dst))
+            mid = cv2.LUT(_flat(vol), _mid_lut(params['mid_threshold'], params['bright_threshold']))
+            dilated_mid = _per_frame(mid.reshape(vol.shape), lambda frame, dst: cv2.dilate(frame, kernel, dst))
+            code = (eroded <= params['very_dark_threshold']).view(np.uint8) << 1
+            code |= (dilated_mid > 0).view(np.uint8)
+            boost_lut = _boost_lut(params['bright_threshold'], params['very_dark_boost'], params['mid_boost'])
+            vol = boost_lut[code, vol]
+        
+        # Step 7: second CLAHE
+        with profile_step('volume.second_clahe'):
+            vol = _per_frame(vol, _get_clahe(params['second_clip_limit'], grid).apply)
+        
+        # Step 8: percentile contrast stretching
+        with profile_step('volume.stretch'):
+            hists = np.stack([cv2.calcHist([frame], [0], None, [256], [0, 256]).ravel() for frame in vol])
+            hists = hists.astype(np.int64)
+            cdfs = np.cumsum(_windowed(hists, stats_window, np.sum), axis=1)
+            luts = [_stretch_lut(cdf, params) for cdf in cdfs[:1 if stats_window == 0 else len(cdfs)]]
+            vol = _per_frame_luts(vol, luts * len(vol) if stats_window == 0 else luts)
+        
+        # Step 9: unsharp mask
+        with profile_step('volume.sharpen'):
+            amount = params['sharpen_amount']
+            blur_sigma = params['blur_sigma']
+            blurred = _per_frame(vol, lambda frame, dst: cv2.GaussianBlur(frame, (0, 0), blur_sigma, dst))
+            vol = cv2.addWeighted(_flat(vol), 1 + amount, _flat(blurred), -amount, 0).reshape(vol.shape)
+        
+        # Step 10: final bilateral filter
+        with profile_step('volume.final_bilateral'):
+            d, sigma = params['final_d'], params['final_sigma']
+            vol = _per_frame(vol, lambda frame, dst: cv2.bilateralFilter(frame, d, sigma, sigma, dst))
+    return vol
+
+def enhance_volume_file(source, output, params=None, stats_window=None):
+    """
+    Load a stack, enhance it and save it
+    
+    Args:
+        source (str or Path): Directory of frames or multi-page TIFF
+        output (str or Path): Output directory of frames, or a .tif/.tiff file
+        params (dict): Overrides for the enhancement parameters
+        stats_window (int): See enhance_volume
+    
+    Returns:
+        list: Paths of the files written
+    """
+    volume, names = load_volume(source)
+    print(f"Loaded {len(volume)} frames of {volume.shape[1]}x{volume.shape[2]} from {source}")
+    return save_volume(enhance_volume(volume, params, stats_window), output, names)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enhance a stack of B-scans as one volume")
+    parser.add_argument('source', help="Directory of frames or multi-page TIFF")
+    parser.add_argument('output', help="Output directory of frames, or a .tif/.tiff file")
+    parser.add_argument('--stats-window', type=int, default=None,
+                        help="Pool normalisation and stretch statistics over this many neighbouring frames "
+                             "(0 = the whole volume; default: per frame, as enhance_image)")
+    add_params_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    
+    with profiling(args.profile):
+        paths = enhance_volume_file(args.source, args.output, parse_params(args.param), args.stats_window)
+    print(f"Saved {len(paths)} files to {args.output}")
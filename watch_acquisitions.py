@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import queue
+import re
+import signal
+import threading
+import time
+from pathlib import Path
+from concat_images import CONCAT_CODE_VERSION, concat_group, group_by_prefix
+from enhance_image import ENHANCE_CODE_VERSION, add_params_argument, enhance_image, enhancement_params, parse_params
+from extract_src_png import (EXTRACT_CODE_VERSION, LINK_METHODS, STATE_NAME, _write_json, extracted_name,
+                             link_or_copy, scan_acquisitions)
+from image_io import EXTRACTED_LISTING, list_images, png_complete
+from manifest import Manifest
+from reassemble_images import REASSEMBLE_CODE_VERSION, reassemble_image
+from split_and_enhance import split_image
+
+# Seconds a new src.png must keep its size and mtime before it is processed
+DEFAULT_SETTLE = 1.0
+# Seconds between two scans of the acquisition tree
+DEFAULT_INTERVAL = 1.0
+# Manifest of the watcher in the output root; it is the state a restart resumes from
+MANIFEST_NAME = "watch_manifest.jsonl"
+
+# Output subdirectories, named after the stages writing them
+OUTPUT_DIRS = ('extracted', 'enhanced', 'split', 'reassembled', 'concatenated_enhanced')
+
+# Concat group of an enhanced image "<parent>_<res|src>_src_enhanced.png": its parent
+# folder path up to the acquisition timestamp (e.g., '20250220_05-1_1_12-03-15-26-16')
+_GROUP_RE = re.compile(r'((?:.+_)?[\d-]+_\d+_[\d-]+-[\d-]+-[\d-]+)_.+_src_enhanced\.png$')
+
+class AcquisitionWatcher:
+    """
+    Service feeding new acquisitions through extract -> enhance ->
+    split/reassemble -> concat as soon as they are written
+    
+    The acquisition tree is rescanned every `interval` seconds with the
+    incremental scan of extract_src_png, so only directories whose mtime
+    changed are listed. A new src.png is queued once its size and mtime
+    have not changed for `settle` seconds and its PNG end chunk is present.
+    A bounded queue feeds a pool of worker threads (OpenCV releases the GIL
+    while it works); when the queue is full the scanner waits.
+    
+    Every finished step is recorded in a manifest in the output root, so
+    after a crash or restart only the steps that had not finished are run
+    again. The output root holds:
+        
+        extracted/               "<parent>_<res|src>_src.png" (extract_src_png)
+        enhanced/                "<name>_enhanced.png" (reprocess_with_improved_enhancement)
+        split/, reassembled/     tiles and reassembled images (process_improved_images)
+        concatenated_enhanced/   "<prefix>_combined.png" (concat_images)
+    
+    The enhanced images of the acquisitions sharing a timestamp folder are
+    concatenated once none of them has changed for `settle` seconds. A
+    group is never concatenated while one of its acquisitions is processed,
+    and an acquisition waits while its group is concatenated.
+    
+    Args:
+        source_dir (str or Path): Root of the acquisition tree
+        output_root (str or Path): Directory for the outputs and the state
+        settle (float): Seconds a file must stay unchanged before it is processed
+        interval (float): Seconds between two scans
+        workers (int): Worker threads
+        queue_size (int): Capacity of the work queue
+        tile_size (int): Tile size of the split/reassemble step
+        params (dict): Overrides for the enhancement parameters
+        link (str): How src.png files are placed, see extract_src_png.link_or_copy
+        scan_threads (int): Threads of the directory scan
+        concat (bool): Concatenate the enhanced images of each prefix group
+    """
+    def __init__(self, source_dir, output_root, settle=DEFAULT_SETTLE, interval=DEFAULT_INTERVAL, workers=2,
+                 queue_size=32, tile_size=1024, params=None, link='auto', scan_threads=8,
+                 concat=True):
+        self.source_dir = Path(source_dir)
+        self.output_root = Path(output_root)
+        self.dirs = {name: self.output_root / name for name in OUTPUT_DIRS}
+        for path in self.dirs.values():
+            path.mkdir(parents=True, exist_ok=True)
+        self.settle = settle
+        self.interval = interval
+        self.workers = max(1, workers)
+        self.tile_size = tile_size
+        self.params = enhancement_params(params)
+        self.link = link
+        self.scan_threads = scan_threads
+        self.concat = concat
+        
+        self.manifest = Manifest(self.output_root / MANIFEST_NAME)
+        self.queue = queue.Queue(max(1, queue_size))
+        self.stop_event = threading.Event()
+        # Guards the manifest and the bookkeeping below, shared with the workers
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._in_flight = {}
+        self._failed = {}
+        self._done = {}
+        self._dirty_groups = {}
+        self._listing_changed = False
+        
+        self.state_path = self.output_root / STATE_NAME
+        self.scan_state = None
+        if self.state_path.exists():
+            with open(self.state_path) as f:
+                saved = json.load(f)
+            if saved.get('source') == str(self.source_dir.resolve()):
+                self.scan_state = saved['dirs']
+    
+    def _paths(self, parent, dir_type):
+        """Extracted, enhanced and reassembled paths and the split directory of one acquisition"""
+        name = extracted_name(parent, dir_type)
+        enhanced = self.dirs['enhanced'] / name.replace('.png', '_enhanced.png')
+        return (self.dirs['extracted'] / name, enhanced, self.dirs['split'] / enhanced.stem,
+                self.dirs['reassembled'] / f"{enhanced.stem}_reassembled.png")
+    
+    def _up_to_date(self, key, inputs, params, version):
+        with self._lock:
+            return self.manifest.is_up_to_date(key, inputs, params, version)
+    
+    def _record(self, key, stage, inputs, outputs, params, version):
+        with self._lock:
+            self.manifest.record(key, stage, inputs, outputs, params, version)
+    
+    def _is_done(self, src_png, parent, dir_type):
+        """Whether every step of an acquisition is recorded and its files are unchanged"""
+        extracted, enhanced, _, reassembled = self._paths(parent, dir_type)
+        return (self._up_to_date(extracted, [src_png], None, EXTRACT_CODE_VERSION) and
+                self._up_to_date(enhanced, [extracted], self.params, ENHANCE_CODE_VERSION) and
+                self._up_to_date(reassembled, [enhanced], {'tile_size': self.tile_size}, REASSEMBLE_CODE_VERSION))
+    
+    def process_acquisition(self, src_png, parent, dir_type):
+        """
+        Run the steps of one acquisition that are not up to date
+        
+        Returns:
+            Path: The enhanced image
+        """
+        extracted, enhanced, split_dir, reassembled = self._paths(parent, dir_type)
+        if not self._up_to_date(extracted, [src_png], None, EXTRACT_CODE_VERSION):
+            link_or_copy(src_png, extracted, self.link)
+            self._record(extracted, 'extract', [src_png], [extracted], None, EXTRACT_CODE_VERSION)
+        
+        if not self._up_to_date(enhanced, [extracted], self.params, ENHANCE_CODE_VERSION):
+            tmp = enhanced.with_name(f".{enhanced.stem}.tmp{enhanced.suffix}")
+            enhance_image(extracted, tmp, self.params)
+            # Replace atomically, so a concatenation never reads a partial file
+            os.replace(tmp, enhanced)
+            self._record(enhanced, 'enhance', [extracted], [enhanced], self.params, ENHANCE_CODE_VERSION)
+        
+        stage_params = {'tile_size': self.tile_size}
+        if not self._up_to_date(reassembled, [enhanced], stage_params, REASSEMBLE_CODE_VERSION):
+            split_image(enhanced, split_dir, self.tile_size)
+            reassemble_image(split_dir, reassembled)
+            self._record(reassembled, 'reassemble', [enhanced], [reassembled], stage_params, REASSEMBLE_CODE_VERSION)
+        return enhanced
+    
+    def concat_prefix(self, prefix):
+        """Concatenate the enhanced images of one prefix group, if they changed"""
+        image_paths = group_by_prefix(list_images(self.dirs['enhanced']), _GROUP_RE).get(prefix)
+        if not image_paths:
+            return None
+        output_path = self.dirs['concatenated_enhanced'] / f"{prefix}_combined.png"
+        if not self._up_to_date(output_path, image_paths, None, CONCAT_CODE_VERSION):
+            concat_group(image_paths, output_path)
+            self._record(output_path, 'concat', image_paths, [output_path], None, CONCAT_CODE_VERSION)
+        return output_path
+    
+    def _prefix(self, parent, dir_type):
+        """Concat group of an acquisition, or None"""
+        if not self.concat:
+            return None
+        groups = group_by_prefix([self._paths(parent, dir_type)[1]], _GROUP_RE)
+        return next(iter(groups), None)
+    
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            kind, key, args = job
+            start = time.monotonic()
+            try:
+                if kind == 'acquisition':
+                    enhanced = self.process_acquisition(*args[:3])
+                    print(f"Enhanced {enhanced.name} in {time.monotonic() - start:.1f} s "
+                          f"({time.monotonic() - args[3]:.1f} s after it last changed)")
+                else:
+                    output_path = self.concat_prefix(key)
+                    if output_path is not None:
+                        print(f"Concatenated {output_path.name} in {time.monotonic() - start:.1f} s")
+                error = None
+            except Exception as e:
+                error = str(e) or repr(e)
+                print(f"Error processing {key}: {error}")
+            with self._lock:
+                if kind == 'acquisition':
+                    src_png, parent, dir_type, _, signature = args
+                    if error is None:
+                        self._done[key] = extracted_name(parent, dir_type)
+                        self._listing_changed = True
+                    else:
+                        # Retried when the file changes
+                        self._failed[key] = signature
+                    prefix = self._prefix(parent, dir_type)
+                    if prefix is not None:
+                        self._dirty_groups[prefix] = time.monotonic()
+                self._in_flight.pop(key, None)
+    
+    def _enqueue(self, kind, key, args, group):
+        """Put a job on the bounded queue, waiting while it is full"""
+        with self._lock:
+            # The concat group a job reads or writes, which no other job may use meanwhile
+            self._in_flight[key] = group
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put((kind, key, args), timeout=self.interval)
+                return True
+            except queue.Full:
+                continue
+        with self._lock:
+            self._in_flight.pop(key, None)
+        return False
+    
+    def poll(self, settle=None):
+        """
+        Scan the acquisition tree once and queue the files that are ready
+        
+        Args:
+            settle (float): Settle time for this scan (default: self.settle)
+        
+        Returns:
+            int: Number of jobs queued
+        """
+        settle = self.settle if settle is None else settle
+        found, self.scan_state, _ = scan_acquisitions(self.source_dir, state=self.scan_state,
+                                                      threads=self.scan_threads)
+        now = time.monotonic()
+        ready = []
+        for src_png, parent, dir_type in found:
+            key = str(src_png)
+            with self._lock:
+                if key in self._done or key in self._in_flight:
+                    continue
+            try:
+                st = os.stat(src_png)
+            except FileNotFoundError:
+                self._pending.pop(key, None)
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            if self._failed.get(key) == signature:
+                continue
+            previous = self._pending.get(key)
+            prefix = self._prefix(parent, dir_type)
+            if previous is None and self._is_done(src_png, parent, dir_type):
+                # Finished before a restart. Its group may not have been concatenated
+                # then; concat_prefix skips it if the manifest has it up to date.
+                with self._lock:
+                    self._done[key] = extracted_name(parent, dir_type)
+                    self._listing_changed = True
+                    if prefix is not None:
+                        self._dirty_groups.setdefault(prefix, now)
+                continue
+            if previous is None or previous[0] != signature:
+                self._pending[key] = (signature, now)
+                previous = self._pending[key]
+            if now - previous[1] >= settle and png_complete(src_png):
+                with self._lock:
+                    if prefix is not None and prefix in self._in_flight:
+                        # Its group is being concatenated; queued by a later scan
+                        continue
+                del self._pending[key]
+                ready.append((key, (src_png, parent, dir_type, previous[1], signature), prefix))
+        
+        queued = sum(self._enqueue('acquisition', key, args, prefix) for key, args, prefix in ready)
+        
+        # Concatenate groups whose members have all been processed and settled
+        with self._lock:
+            busy = set(self._in_flight.values())
+            groups = [prefix for prefix, changed in self._dirty_groups.items()
+                      if now - changed >= settle and prefix not in busy]
+            for prefix in groups:
+                del self._dirty_groups[prefix]
+        queued += sum(self._enqueue('concat', prefix, (), prefix) for prefix in groups)
+        self._save_state()
+        return queued
+    
+    def _save_state(self):
+        """Save the scan state and the listing of the extracted files, so a restart resumes from here"""
+        source = str(self.source_dir.resolve())
+        _write_json(self.state_path, {'source': source, 'dirs': self.scan_state})
+        with self._lock:
+            if not self._listing_changed:
+                return
+            files = [{'file': name, 'source': src} for src, name in sorted(self._done.items())]
+            self._listing_changed = False
+        _write_json(self.dirs['extracted'] / EXTRACTED_LISTING, {'source': source, 'files': files})
+    
+    def _idle(self):
+        with self._lock:
+            return not self._in_flight and not self._pending and not self._dirty_groups and self.queue.empty()
+    
+    def run(self, once=False):
+        """
+        Watch until stopped (SIGINT/SIGTERM or stop()), or with once=True
+        process the files present now and return
+        """
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        print(f"Watching {self.source_dir} -> {self.output_root}")
+        try:
+            while not self.stop_event.is_set():
+                # A single pass does not wait for files to settle, only for them to be complete
+                self.poll(0 if once else None)
+                if once and self._idle():
+                    break
+                self.stop_event.wait(self.interval)
+        finally:
+            # Let the workers finish the jobs they have started
+            self.stop_event.set()
+            for _ in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+            self._save_state()
+            self.manifest.close()
+        print("Watcher stopped")
+    
+    def stop(self, *args):
+        self.stop_event.set()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the acquisition tree and process new src.png files")
+    parser.add_argument('source_dir', nargs='?', default="/Users/xiezhijie/GML/split_512/20250220")
+    parser.add_argument('output_root', nargs='?', default="/Users/xiezhijie/GML/split_512/watch")
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE,
+                        help=f"Seconds a new file must stay unchanged (default {DEFAULT_SETTLE})")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help=f"Seconds between scans (default {DEFAULT_INTERVAL})")
+    parser.add_argument('--workers', type=int, default=2, help="Worker threads (default 2)")
+    parser.add_argument('--queue-size', type=int, default=32, help="Capacity of the work queue (default 32)")
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--link', choices=LINK_METHODS, default='auto', help="How src.png files are placed")
+    parser.add_argument('--no-concat', action='store_true', help="Do not concatenate prefix groups")
+    parser.add_argument('--once', action='store_true', help="Process the files present now and exit")
+    add_params_argument(parser)
+    args = parser.parse_args()
+    
+    watcher = AcquisitionWatcher(args.source_dir, args.output_root, args.settle, args.interval, args.workers,
+                                 args.queue_size, args.tile_size, parse_params(args.param), args.link,
+                                 concat=not args.no_concat)
+    signal.signal(signal.SIGINT, watcher.stop)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    watcher.run(once=args.once)